@@ -0,0 +1,296 @@
+# load_test.py
+"""
+Open-loop load test of the QAServer, using the stand-ins in stand_ins.py.
+
+Requests are sent on a fixed schedule whatever the server's response times,
+and latency is measured from when each request was due, so a slow server
+can't hide its queueing delay by slowing the load down.
+
+usage (from this directory):
+    python load_test.py --rate 50 --duration 30 --reader micro \\
+        --reader-latency lognormal:0.05:0.5 --reader-cpu-ms 2 \\
+        --report report.$(git rev-parse --short HEAD).json
+"""
+
+from argparse import ArgumentParser
+from argparse import Namespace
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+# util/logging_.py writes to logs/ when it is imported
+os.makedirs('logs', exist_ok=True)
+sys.path.append('..')
+
+from aiohttp import ClientError
+from aiohttp import ClientSession
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
+import aiohttp.web as web # type: ignore
+
+from qa_backend.server import QAServer
+from qa_backend.server import QAServerConfig
+from qa_backend.server import TransformersMicro
+from qa_backend.server import TransformersMicroConfig
+from qa_backend.services.qa import MicroAdapterQA
+from qa_backend.services.qa import MicroAdapterQAConfig
+from qa_backend.services.qa import QA
+from qa_backend.util import set_all_loglevels
+from stand_ins import FakeDatabase
+from stand_ins import FakeReader
+from stand_ins import Latency
+from stand_ins import make_paragraphs
+from stand_ins import make_question
+
+TRAFFIC_KINDS = ('question', 'index', 'batch')
+
+def parse_args(argv: Optional[List[str]] = None) -> Namespace:
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=20.,
+                        help='requests per second, over all traffic')
+    parser.add_argument('--duration', type=float, default=10.,
+                        help='seconds to send requests for')
+    parser.add_argument('--mix', default='question=8,index=1,batch=1',
+                        help='relative weights of the traffic kinds')
+    parser.add_argument('--arrivals', choices=['fixed', 'poisson'],
+                        default='fixed',
+                        help='evenly spaced or exponential inter-arrivals')
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='questions per request to /questions')
+    parser.add_argument('--reader', choices=['direct', 'micro'],
+                        default='direct',
+                        help='query the stand-in reader in process, or '
+                             'through a TransformersMicro and MicroAdapterQA')
+    parser.add_argument('--reader-latency', type=Latency.parse,
+                        default=Latency('lognormal', .02, .5),
+                        help='distribution:mean[:spread] in seconds')
+    parser.add_argument('--reader-cpu-ms', type=float, default=1.,
+                        help='CPU burnt by the reader per (question, context)')
+    parser.add_argument('--db-latency', type=Latency.parse,
+                        default=Latency('constant', .005),
+                        help='distribution:mean[:spread] in seconds')
+    parser.add_argument('--docs', type=int, default=200,
+                        help='number of generated documents')
+    parser.add_argument('--timeout', type=float, default=30.,
+                        help='client timeout for each request, in seconds')
+    parser.add_argument('--server-config', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='QAServerConfig fields, e.g. request_timeout=1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', default='load_test_report.json',
+                        help='where to write the json report')
+    return parser.parse_args(argv)
+
+def parse_mix(mix: str) -> Dict[str,float]:
+    weights: Dict[str,float] = {}
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in TRAFFIC_KINDS:
+            raise ValueError(f'unknown traffic kind: {kind}')
+        weights[kind] = float(weight)
+    return weights
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    if len(sorted_values) == 0:
+        return float('nan')
+    rank = max(1, int(round(p / 100 * len(sorted_values) + .5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(
+        results: List[Tuple[float,bool]],
+        sent: int,
+        elapsed: float
+    ) -> Dict[str,Any]:
+    """Summary of (latency, ok) results for requests sent over elapsed"""
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'sent': sent,
+        'completed': len(results),
+        'errors': errors,
+        'error_rate': errors / sent if sent > 0 else 0.,
+        'throughput': (len(results) - errors) / elapsed,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class LoadTest:
+    args: Namespace
+    base_url: str
+    session: ClientSession
+    rng: random.Random
+    doc_ids: List[str]
+    results: Dict[str,List[Tuple[float,bool]]]
+    sent: Dict[str,int]
+
+    def __init__(self, args: Namespace, doc_ids: List[str]):
+        self.args = args
+        self.base_url = f'http://127.0.0.1:{args.port}'
+        self.rng = random.Random(args.seed)
+        self.doc_ids = doc_ids
+        self.results = {kind: [] for kind in TRAFFIC_KINDS}
+        self.sent = {kind: 0 for kind in TRAFFIC_KINDS}
+
+    def schedule(self) -> List[Tuple[float,str]]:
+        """(offset in seconds, traffic kind) for every request to send"""
+        weights = parse_mix(self.args.mix)
+        kinds = list(weights)
+        schedule: List[Tuple[float,str]] = []
+        offset = 0.
+        while True:
+            if self.args.arrivals == 'poisson':
+                offset += self.rng.expovariate(self.args.rate)
+            else:
+                offset = len(schedule) / self.args.rate
+            if offset >= self.args.duration:
+                return schedule
+            kind = self.rng.choices(kinds, [weights[k] for k in kinds])[0]
+            schedule.append((offset, kind))
+
+    def request_for(self, kind: str) -> Tuple[str,str,Optional[Any]]:
+        """method, url and json body for a request of the kind"""
+        if kind == 'question':
+            body = {'question': make_question(self.rng)}
+            return 'POST', f'{self.base_url}/question', body
+        if kind == 'batch':
+            questions = [{'question': make_question(self.rng)}
+                         for _ in range(self.args.batch_size)]
+            return 'POST', f'{self.base_url}/questions', {'questions': questions}
+        # index traffic: reads and updates of existing documents
+        docId = self.rng.choice(self.doc_ids)
+        if self.rng.random() < .5:
+            return 'GET', f'{self.base_url}/index?docId={docId}', None
+        text = f'{make_question(self.rng)[:-1]}.'
+        body = {'operation': 'update', 'docId': docId, 'text': text}
+        return 'POST', f'{self.base_url}/index', body
+
+    async def send(
+            self, kind: str, due: float, request: Tuple[str,str,Any]
+        ) -> None:
+        method, url, body = request
+        try:
+            async with self.session.request(method, url, json=body) as response:
+                await response.read()
+                ok = response.status == 200
+        except (asyncio.TimeoutError, ClientError):
+            ok = False
+        self.results[kind].append((time.monotonic() - due, ok))
+
+    async def run(self) -> Dict[str,Any]:
+        schedule = self.schedule()
+        # requests are built ahead of time so the schedule isn't delayed
+        requests = [self.request_for(kind) for _, kind in schedule]
+        timeout = ClientTimeout(total=self.args.timeout)
+        connector = TCPConnector(limit=0)
+        async with ClientSession(timeout=timeout,
+                                 connector=connector) as session:
+            self.session = session
+            tasks = []
+            start = time.monotonic()
+            for (offset, kind), request in zip(schedule, requests):
+                due = start + offset
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.sent[kind] += 1
+                tasks.append(asyncio.ensure_future(
+                                self.send(kind, due, request)))
+            await asyncio.gather(*tasks)
+            elapsed = time.monotonic() - start
+        all_results = [result for kind in TRAFFIC_KINDS
+                       for result in self.results[kind]]
+        return {
+            'overall': summarize(all_results, len(schedule), elapsed),
+            'by_kind': {kind: summarize(self.results[kind], self.sent[kind],
+                                        elapsed)
+                        for kind in TRAFFIC_KINDS if self.sent[kind] > 0},
+            'elapsed': elapsed,
+        }
+
+async def start_app(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+async def main(args: Namespace) -> Dict[str,Any]:
+    paragraphs = make_paragraphs(args.docs, seed=args.seed)
+    database = FakeDatabase(paragraphs, latency=args.db_latency,
+                            seed=args.seed)
+    reader = FakeReader(args.reader_latency, args.reader_cpu_ms / 1000,
+                        seed=args.seed)
+    runners: List[web.AppRunner] = []
+    qa: QA = reader
+    if args.reader == 'micro':
+        micro_port = args.port + 1
+        micro_config = TransformersMicroConfig(host='127.0.0.1',
+                                               port=micro_port)
+        micro = TransformersMicro(micro_config, transformers_qa=reader)
+        runners.append(await start_app(micro.make_app(), micro_port))
+        qa = MicroAdapterQA(MicroAdapterQAConfig(host='127.0.0.1',
+                                                 port=micro_port))
+    server_config = dict(item.split('=', 1) for item in args.server_config)
+    config = QAServerConfig(host='127.0.0.1', port=args.port,
+                            **server_config)
+    server = QAServer(database, [qa], config)
+    server.add_routes()
+    runners.append(await start_app(server.app, args.port))
+    try:
+        load_test = LoadTest(args, [p.docId for p in paragraphs])
+        results = await load_test.run()
+    finally:
+        await qa.shutdown()
+        for runner in reversed(runners):
+            await runner.cleanup()
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'args': {k: str(v) if isinstance(v, Latency) else v
+                 for k, v in vars(args).items()},
+        'results': results,
+    }
+
+def print_report(report: Dict[str,Any]) -> None:
+    results = report['results']
+    rows = [('overall', results['overall'])] + list(results['by_kind'].items())
+    print(f'{"":10}{"sent":>8}{"errors":>8}{"req/s":>9}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, summary in rows:
+        latency = summary['latency_ms']
+        print(f'{name:10}{summary["sent"]:>8}{summary["errors"]:>8}'
+              f'{summary["throughput"]:>9.1f}{latency["p50"]:>10.1f}'
+              f'{latency["p95"]:>10.1f}{latency["p99"]:>10.1f}')
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_all_loglevels('error')
+    report = asyncio.get_event_loop().run_until_complete(main(args))
+    print_report(report)
+    with open(args.report, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'report written to {args.report}')
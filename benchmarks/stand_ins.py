@@ -0,0 +1,196 @@
+# stand_ins.py
+"""
+Deterministic stand-ins for the reader and the database, for load tests.
+
+`FakeReader` answers with the sentence of the context sharing the most words
+with the question.  Its latency is drawn from a configurable distribution
+(awaited, like the network hop to a micro service) and it burns a fixed
+amount of CPU per (question, context) pair, blocking the event loop the way
+the transformers pipeline does.
+"""
+
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+import asyncio
+import math
+import random
+import re
+import sys
+import time
+
+import attr
+
+sys.path.append('..')
+
+from qa_backend.services.database import DatabaseAlreadyExistsError
+from qa_backend.services.database import DatabaseDeleteError
+from qa_backend.services.database import DatabaseUpdateNotFoundError
+from qa_backend.services.database import QueryDatabase
+from qa_backend.services.qa import QA
+from qa_backend.util import Paragraph
+from qa_backend.util import QAAnswer
+
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'lognormal')
+
+@attr.s(slots=True, frozen=True)
+class Latency:
+    """Latency in seconds: constant, uniform in mean +- spread, or lognormal
+    with the given mean and sigma=spread"""
+    distribution: str = attr.ib(default='constant')
+    mean: float = attr.ib(default=0., converter=float)
+    spread: float = attr.ib(default=0., converter=float)
+
+    @distribution.validator
+    def _check_distribution(self, attribute, value):
+        if value not in LATENCY_DISTRIBUTIONS:
+            formats = ', '.join(LATENCY_DISTRIBUTIONS)
+            raise ValueError(f'distribution must be one of: {formats}')
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Latency':
+        """From distribution:mean[:spread], e.g. lognormal:0.05:0.5"""
+        return cls(*spec.split(':'))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.distribution == 'uniform':
+            return max(0., rng.uniform(self.mean - self.spread,
+                                       self.mean + self.spread))
+        if self.distribution == 'lognormal' and self.mean > 0:
+            mu = math.log(self.mean) - self.spread ** 2 / 2
+            return rng.lognormvariate(mu, self.spread)
+        return self.mean
+
+def words(text: str) -> Set[str]:
+    return set(re.findall(r'\w+', text.lower()))
+
+def burn_cpu(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class FakeReader(QA):
+    _requires_context = True
+    _supports_batch = True
+    latency: Latency
+    cpu_seconds: float
+    rng: random.Random
+
+    def __init__(
+            self,
+            latency: Latency = Latency(),
+            cpu_seconds: float = 0.,
+            seed: int = 0,
+        ):
+        self.latency = latency
+        self.cpu_seconds = cpu_seconds
+        self.rng = random.Random(seed)
+
+    def answer(self, question: str, context: str) -> QAAnswer:
+        question_words = words(question)
+        sentences = [s.strip() + '.' for s in context.split('.') if s.strip()]
+        best, overlap = '', 0
+        for sentence in sentences:
+            overlap_ = len(question_words & words(sentence))
+            if overlap_ > overlap:
+                best, overlap = sentence, overlap_
+        score = overlap / max(len(question_words), 1)
+        return QAAnswer(question, best, score, original_span=best)
+
+    async def query(self, question: str, **kwargs) -> List[QAAnswer]:
+        context = kwargs.get('context', '')
+        await asyncio.sleep(self.latency.sample(self.rng))
+        burn_cpu(self.cpu_seconds)
+        return [self.answer(question, context)]
+
+    async def query_many(
+            self,
+            questions: Sequence[Tuple[str,str]]
+        ) -> List[List[QAAnswer]]:
+        # one round trip for the batch, but the model does work per pair
+        await asyncio.sleep(self.latency.sample(self.rng))
+        burn_cpu(self.cpu_seconds * len(questions))
+        return [[self.answer(question, context)]
+                for question, context in questions]
+
+class FakeDatabase(QueryDatabase):
+    """In-memory database ranking paragraphs by words shared with a query"""
+    paragraphs: Dict[str,str]
+    latency: Latency
+    rng: random.Random
+
+    def __init__(
+            self,
+            paragraphs: Iterable[Paragraph] = (),
+            latency: Latency = Latency(),
+            seed: int = 0,
+        ):
+        self.paragraphs = {p.docId: p.text for p in paragraphs}
+        self.latency = latency
+        self.rng = random.Random(seed)
+
+    async def create(self, paragraph: Paragraph) -> None:
+        if paragraph.docId in self.paragraphs:
+            raise DatabaseAlreadyExistsError(paragraph.docId) # type: ignore
+        self.paragraphs[paragraph.docId] = paragraph.text
+
+    async def read(self, docId: str) -> List[Paragraph]:
+        if docId == '*':
+            return [Paragraph(k, v) for k, v in self.paragraphs.items()]
+        if docId not in self.paragraphs:
+            return []
+        return [Paragraph(docId, self.paragraphs[docId])]
+
+    async def update(self, paragraph: Paragraph) -> None:
+        if paragraph.docId not in self.paragraphs:
+            raise DatabaseUpdateNotFoundError(paragraph.docId) # type: ignore
+        self.paragraphs[paragraph.docId] = paragraph.text
+
+    async def delete(self, docId: str) -> None:
+        if docId not in self.paragraphs:
+            raise DatabaseDeleteError(docId) # type: ignore
+        del self.paragraphs[docId]
+
+    async def query(
+            self,
+            query_string: str,
+            size: int = 10,
+            qid: str = '',
+        ) -> List[Paragraph]:
+        await asyncio.sleep(self.latency.sample(self.rng))
+        query_words = words(query_string)
+        scored = sorted(((len(query_words & words(text)), docId)
+                         for docId, text in self.paragraphs.items()),
+                        key=lambda scored: (-scored[0], scored[1]))
+        return [Paragraph(docId, self.paragraphs[docId])
+                for overlap, docId in scored[:size] if overlap > 0]
+
+VOCABULARY = '''
+    http protocol server client request response header cache proxy socket
+    packet router address network latency bandwidth browser cookie session
+    token secret key cipher certificate handshake stream frame buffer queue
+    thread process kernel memory disk file index query document search rank
+'''.split()
+
+def make_paragraphs(
+        n: int,
+        sentences: int = 8,
+        seed: int = 0,
+    ) -> List[Paragraph]:
+    """Deterministic generated documents"""
+    rng = random.Random(seed)
+    paragraphs = []
+    for i in range(n):
+        text = ' '.join(
+                    ' '.join(rng.choice(VOCABULARY)
+                             for _ in range(rng.randint(6, 14))).capitalize()
+                    + '.'
+                    for _ in range(sentences))
+        paragraphs.append(Paragraph(f'bench_{i}.txt', text))
+    return paragraphs
+
+def make_question(rng: random.Random) -> str:
+    return 'what is the ' + ' '.join(rng.sample(VOCABULARY, 3)) + '?'
@@ -23,7 +23,8 @@ from qa_backend.services.database.es_database import Explanation
 
 es = elasticsearch.Elasticsearch()
 log = logging.getLogger('test')
-endpoint = 'http://localhost:8080/question'
+endpoint = 'http://localhost:8080/questions'
+batch_size = 50
 index = 'deployment-index'
 output_file = open('test_test.txt','w')
 atexit.register(lambda : output_file.close())
@@ -88,18 +89,20 @@ class Answer:
 def get_answers(questions: List[str]) -> Tuple[List[Answer],List[str]]:
     answers: List[Answer] = []
     no_answers: List[str] = []
-    for question in questions:
+    for i in range(0, len(questions), batch_size):
+        batch = questions[i:i+batch_size]
         try:
-            body = {'question':question}
+            body = {'questions':[{'question':question} for question in batch]}
             response = requests.post(endpoint, json=body)
-            chosen_answer = response.json()['chosen_answer']
-            if chosen_answer is None:
-                no_answers.append(question)
-            else:
-                qid = response.cookies['qa_server.qid']
-                answers.append(Answer(chosen_answer, qid))
+            qid = response.cookies['qa_server.qid']
+            for question, result in zip(batch, response.json()):
+                chosen_answer = result['chosen_answer']
+                if chosen_answer is None:
+                    no_answers.append(question)
+                else:
+                    answers.append(Answer(chosen_answer, qid))
         except JSONDecodeError as e:
-            log.exception(f'[Error answering question: {question}, {e}')
+            log.exception(f'[Error answering questions: {batch}, {e}')
     return answers, no_answers
 
 if __name__ == '__main__':
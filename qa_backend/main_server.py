@@ -24,7 +24,10 @@ import aiohttp.web as web
 from qa_backend.server import QAServer
 from qa_backend.server import QAServerConfig
 from qa_backend.server import TransformersMicro
+from qa_backend.services.database import BM25Database
+from qa_backend.services.database import DenseDatabase
 from qa_backend.services.database import ElasticsearchDatabase
+from qa_backend.services.database import PassageDatabase
 from qa_backend.services.database import QueryDatabase
 from qa_backend.services.qa import MicroAdapterQA
 from qa_backend.services.qa import QA
@@ -52,6 +55,7 @@ def load_qas_from_config(config: ConfigParser) -> List[QA]:
 #   QAServer
 #
 #       ElasticsearchDatabase       |
+#       (or BM25Database)           |
 #                                   |
 #       QAs:                        |
 #           - RegexQA               |
@@ -84,9 +88,22 @@ class MainServer:
         # database
         log.info(f'Initializing database services')
         #
-        es_config = config['es database']
-        es_database = ElasticsearchDatabase.from_config(es_config)
-        self.database = es_database
+        if config.has_section('bm25 database'):
+            bm25_config = config['bm25 database']
+            self.database = BM25Database.from_config(bm25_config)
+        else:
+            es_config = config['es database']
+            es_database = ElasticsearchDatabase.from_config(es_config)
+            self.database = es_database
+        if config.has_section('dense retrieval'):
+            dense_config = config['dense retrieval']
+            self.database = DenseDatabase.wrap_from_config(
+                                self.database, dense_config)
+        # outermost, so the passages are what gets encoded
+        if config.has_section('passages'):
+            passages_config = config['passages']
+            self.database = PassageDatabase.wrap_from_config(
+                                self.database, passages_config)
         # micro
 #        if True or 'enabled' in config['transformers micro service']:
 #            log.info(f'Initializing transformers micro service')
@@ -104,11 +121,15 @@ class MainServer:
         # qa_server
         qa_server_config = QAServerConfig(**config['qa server'])
         self.qa_server = QAServer(self.database, self.qas, qa_server_config)
+        self.qa_server.app.on_startup.append(self.startup)
         self.qa_server.app.on_shutdown.append(self.shutdown)
         # miscellaneous
         set_all_loglevels(config['miscellaneous'].get('log_level','info'))
         log.info(f'Initialization complete.')
 
+    async def startup(self, app: web.Application):
+        await self.database.start()
+
     async def shutdown(self, app: web.Application):
         log.info('<main server> shutting down')
         await asyncio.tasks.gather(*[qa.shutdown() for qa in self.qas])
@@ -0,0 +1,149 @@
+# admission.py
+"""
+Admission control for the expensive endpoints of the QAServer.
+
+At most `max_in_flight` requests are answered at once, and at most
+`max_queued` more wait for a slot, in arrival order.  Requests beyond that are
+shed straight away with 503 and Retry-After, so that a spike makes some
+requests fail fast rather than every request slow down until they all time
+out.
+"""
+
+from collections import deque
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Optional
+import asyncio
+import logging
+
+from aiohttp.web import Request # type: ignore
+from aiohttp.web import Response # type: ignore
+from aiohttp.web import StreamResponse # type: ignore
+import attr
+
+from qa_backend.util.metrics import registry
+
+log = logging.getLogger('server')
+
+Handler = Callable[[Request], Awaitable[StreamResponse]]
+
+IN_FLIGHT = registry.gauge('qa_admission_in_flight',
+                           'Admitted requests being answered')
+QUEUED = registry.gauge('qa_admission_queued',
+                        'Requests waiting to be admitted')
+SHED = registry.counter('qa_admission_shed_total',
+                        'Requests rejected by admission control',
+                        ['reason'])
+
+@attr.s(slots=True)
+class AdmissionStats:
+    admitted: int = attr.ib(default=0)
+    # admitted after waiting in the queue
+    queued: int = attr.ib(default=0)
+    # rejected because the queue was full
+    shed: int = attr.ib(default=0)
+    # rejected after waiting max_queue_wait seconds
+    queue_timeouts: int = attr.ib(default=0)
+
+class AdmissionController:
+    max_in_flight: Optional[int]
+    max_queued: int
+    max_queue_wait: Optional[float]
+    retry_after: int
+    in_flight: int
+    stats: AdmissionStats
+    _waiters: 'Deque[asyncio.Future[None]]'
+
+    def __init__(
+            self,
+            max_in_flight: Optional[int] = None,
+            max_queued: int = 0,
+            max_queue_wait: Optional[float] = None,
+            retry_after: int = 1,
+        ):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.stats = AdmissionStats()
+        self._waiters = deque()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight is not None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """Wait for a slot if there's room in the queue, False if shed"""
+        if self.max_in_flight is None or self.in_flight < self.max_in_flight:
+            self.in_flight += 1
+            self.stats.admitted += 1
+            self._update_gauges()
+            return True
+        if len(self._waiters) >= self.max_queued:
+            self.stats.shed += 1
+            SHED.inc(reason='queue_full')
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self._update_gauges()
+        try:
+            # release hands its slot straight to the waiter
+            await asyncio.wait_for(waiter, self.max_queue_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot arrived as we gave up, pass it on
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self._update_gauges()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.stats.queue_timeouts += 1
+            SHED.inc(reason='queue_timeout')
+            return False
+        self.stats.admitted += 1
+        self.stats.queued += 1
+        self._update_gauges()
+        return True
+
+    def release(self) -> None:
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self.in_flight -= 1
+        self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        IN_FLIGHT.set(self.in_flight)
+        QUEUED.set(len(self._waiters))
+
+    def admitted(self, handler: Handler) -> Handler:
+        """Wrap handler so that it only runs once admitted"""
+        if not self.enabled:
+            return handler
+        async def admitted_handler(request: Request) -> StreamResponse:
+            if not await self.acquire():
+                headers = {'Retry-After': str(self.retry_after)}
+                return Response(status=503, headers=headers,
+                                text='server is overloaded, try again later')
+            try:
+                return await handler(request)
+            finally:
+                self.release()
+        return admitted_handler
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats = attr.asdict(self.stats)
+        stats.update({'in_flight': self.in_flight, 'queue_depth': self.queued})
+        return stats
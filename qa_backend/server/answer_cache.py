@@ -0,0 +1,168 @@
+# answer_cache.py
+"""
+Cache of /question responses, invalidated by the documents they depend on.
+
+A cached response depends on every paragraph retrieved for the question, not
+only those which produced an answer, since a change to any of them could
+change the answers.  Creating a new document can also change what is retrieved
+for a question, but there is no way to know which questions, so such changes
+are only picked up when the entry expires (see `ttl`).
+
+A response computed while one of its documents is written may be stale, so
+it isn't cached: `begin` returns the invalidation generation when a request
+starts, and `put` skips the response if a document it depends on has been
+invalidated since then, or less than `settle` seconds ago (while the database
+may still serve the old text, e.g. until elasticsearch refreshes or a
+write-behind flushes).
+"""
+
+from collections import defaultdict
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+import logging
+import time
+
+import attr
+
+from qa_backend.util.cache import LRUCache
+
+log = logging.getLogger('server')
+
+AnswerKey = Tuple[str,Optional[str]]
+
+def normalize_question(question: str) -> str:
+    return ' '.join(question.lower().split())
+
+@attr.s(slots=True, auto_attribs=True)
+class CachedResponse:
+    response: Dict[str,Any]
+    # retrieved docIds, in the order they were retrieved
+    docIds: List[str]
+
+class AnswerCache:
+    cache: LRUCache[AnswerKey,CachedResponse]
+    dependents: Dict[str,Set[AnswerKey]]
+    dependencies: Dict[AnswerKey,Set[str]]
+    settle: float
+    clock: Callable[[],float]
+    # number of invalidations so far
+    generation: int
+    # generation and time of the latest invalidation of each docId, oldest
+    # first
+    invalidated: Dict[str,Tuple[int,float]]
+    # invalidations before this one were dropped from invalidated
+    forgotten: int
+    # responses not cached because a document changed meanwhile
+    stale: int
+
+    def __init__(
+            self,
+            max_size: int,
+            ttl: Optional[float] = None,
+            settle: float = 0.,
+            clock: Callable[[],float] = time.monotonic,
+        ):
+        self.cache = LRUCache(max_size, ttl=ttl, on_remove=self._forget)
+        self.dependents = defaultdict(set)
+        self.dependencies = {}
+        self.settle = settle
+        self.clock = clock
+        self.generation = 0
+        self.invalidated = {}
+        self.forgotten = 0
+        self.stale = 0
+
+    @staticmethod
+    def key(question: str, context: Optional[str] = None) -> AnswerKey:
+        return (normalize_question(question), context)
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache.enabled
+
+    def get(self, key: AnswerKey) -> Optional[CachedResponse]:
+        if not self.enabled:
+            return None
+        return self.cache.get(key)
+
+    def begin(self) -> int:
+        """The generation to pass to put, for a response computed from now"""
+        return self.generation
+
+    def changed_since(self, docIds: List[str], generation: int) -> bool:
+        if generation < self.forgotten:
+            # which documents were invalidated is no longer known
+            return True
+        now = self.clock()
+        for docId in docIds:
+            invalidated = self.invalidated.get(docId)
+            if invalidated is None:
+                continue
+            invalidation, at = invalidated
+            if invalidation > generation or now - at < self.settle:
+                return True
+        return False
+
+    def put(
+            self,
+            key: AnswerKey,
+            response: Dict[str,Any],
+            docIds: Iterable[str],
+            generation: Optional[int] = None,
+        ) -> None:
+        """Cache response, unless one of docIds was invalidated after
+        generation (from begin)"""
+        if not self.enabled:
+            return
+        docIds = list(docIds)
+        if generation is not None and self.changed_since(docIds, generation):
+            log.debug('not caching a response computed during a write')
+            self.stale += 1
+            return
+        self.cache.put(key, CachedResponse(response, docIds))
+        if key not in self.cache:
+            return
+        self.dependencies[key] = set(docIds)
+        for docId in docIds:
+            self.dependents[docId].add(key)
+
+    def invalidate(self, docId: str) -> None:
+        self.generation += 1
+        now = self.clock()
+        # kept in order of invalidation
+        self.invalidated.pop(docId, None)
+        self.invalidated[docId] = (self.generation, now)
+        # as many as there are cached responses, but those in the settle
+        # window are needed whatever their number
+        while len(self.invalidated) > max(1, self.cache.max_size):
+            oldest = next(iter(self.invalidated))
+            invalidation, at = self.invalidated[oldest]
+            if now - at < self.settle:
+                break
+            del self.invalidated[oldest]
+            self.forgotten = invalidation
+        keys = self.dependents.pop(docId, set())
+        if len(keys) > 0:
+            log.debug(f'invalidating {len(keys)} answers depending on {docId}')
+        for key in keys:
+            self.cache.invalidate(key)
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def _forget(self, key: AnswerKey) -> None:
+        for docId in self.dependencies.pop(key, set()):
+            keys = self.dependents.get(docId)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.dependents[docId]
+
+    def get_stats(self) -> Dict[str,int]:
+        return dict(self.cache.get_stats(), stale=self.stale)
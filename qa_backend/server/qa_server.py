@@ -8,18 +8,25 @@
 
 from traceback import print_tb
 from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import MutableMapping
 from typing import Optional
-from typing import TextIO
+from typing import Tuple
 from uuid import uuid4
+import asyncio
 import json
 import logging
 import os
+import math
 import random
 import sys
+import time
 
+from aiohttp import StreamReader # type: ignore
 from aiohttp.web import Request # type: ignore
 from aiohttp.web import Response # type: ignore
 from aiohttp.web import HTTPNotFound # type: ignore
@@ -29,20 +36,48 @@ from markdown import markdown # type: ignore
 import aiohttp.web as web # type: ignore
 import attr
 
+from .admission import AdmissionController
+from .answer_cache import AnswerCache
+from .response_encoding import ResponseEncoder
+from .response_encoding import ResponseFormat
 from qa_backend.util import APIError
 from qa_backend.util import exception_middleware
 from qa_backend.services.database import DatabaseAlreadyExistsError
 from qa_backend.services.database import DatabaseReadNotFoundError
 from qa_backend.services.database import QueryDatabase
+from qa_backend.services.database import WriteOperation
 from qa_backend.services.qa import QA
 from qa_backend.services.qa import QAQueryError
+from qa_backend.util import JsonBulkOperation
 from qa_backend.util import JsonCrudOperation
 from qa_backend.util import JsonQuestionOptionalContext
+from qa_backend.util import JsonQuestions
 from qa_backend.util import Paragraph
 from qa_backend.util import QAAnswer
+from qa_backend.util import convert_bool
+from qa_backend.util.log_writer import LogWriter
+from qa_backend.util.metrics import metrics_handler
+from qa_backend.util.metrics import metrics_middleware
+from qa_backend.util.metrics import record_stage
+from qa_backend.util.metrics import registry
+from qa_backend.util.metrics import timed
 
 log = logging.getLogger('server')
 
+QA_SECONDS = registry.histogram('qa_service_query_duration_seconds',
+                                'Time taken by each query to a qa service',
+                                ['qa'])
+QA_ERRORS = registry.counter('qa_service_errors_total',
+                             'QAQueryErrors raised by each qa service',
+                             ['qa'])
+SERIALIZE_SECONDS = registry.histogram('qa_serialize_duration_seconds',
+                                       'Time taken to encode responses')
+LOG_QA_SECONDS = registry.histogram('qa_log_qa_duration_seconds',
+                                    'Time taken by QAServer.log_qa')
+
+def qa_name(qa: QA) -> str:
+    return type(qa).__name__
+
 #
 # Middlewares
 #
@@ -59,9 +94,99 @@ async def attach_uuid_middleware(
     qid = str(uuid4())
     request['qid'] = qid
     response = await handler(request)
-    response.set_cookie('qa_server.qid',qid)
+    # streamed responses set the cookie themselves before sending headers
+    if not response.prepared:
+        response.set_cookie('qa_server.qid',qid)
     return response
 
+#
+# Streaming
+#
+# /question can stream its result as frames: first the retrieved docIds, then
+# the answers as each qa service finishes, then the chosen answer.
+#
+
+Emitter = Callable[[Dict[str,Any]], Awaitable[None]]
+
+STREAM_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+def get_stream_format(request: Request) -> Optional[str]:
+    """Streaming format requested with ?stream=... or the Accept header"""
+    stream = request.query.get('stream')
+    if stream is not None:
+        if stream not in STREAM_CONTENT_TYPES:
+            formats = ', '.join(STREAM_CONTENT_TYPES)
+            raise APIError(request, f'stream must be one of: {formats}')
+        return stream
+    accept = request.headers.get('Accept', '')
+    for stream, content_type in STREAM_CONTENT_TYPES.items():
+        if content_type in accept:
+            return stream
+    return None
+
+def encode_frame(frame: Dict[str,Any], stream: str) -> bytes:
+    data = json.dumps(frame)
+    if stream == 'sse':
+        return f'event: {frame["event"]}\ndata: {data}\n\n'.encode()
+    return (data + '\n').encode()
+
+#
+# Latency budget
+#
+# /question may be given a deadline (QAServerConfig.request_timeout, or
+# ?timeout=... on the request).  Retrieval and qa queries still running when
+# it expires are cancelled, and the response is built from the answers which
+# have arrived, marked as partial.
+#
+
+def get_request_timeout(
+        request: Request, default: Optional[float]
+    ) -> Optional[float]:
+    """Latency budget in seconds requested with ?timeout=..."""
+    timeout = request.query.get('timeout')
+    if timeout is None:
+        return default
+    try:
+        seconds = float(timeout)
+    except ValueError:
+        seconds = math.nan
+    if not seconds > 0 or math.isinf(seconds):
+        raise APIError(request, 'timeout must be a positive number of seconds')
+    return seconds
+
+class Deadline:
+    """Time left in a request's latency budget, if it has one"""
+    budget: Optional[float]
+    start: float
+
+    def __init__(self, budget: Optional[float] = None):
+        self.budget = budget
+        self.start = time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def remaining(self) -> Optional[float]:
+        if self.budget is None:
+            return None
+        return max(0., self.budget - self.elapsed())
+
+@attr.s(slots=True)
+class QAResults:
+    """Answers from querying qa services, and how many queries didn't finish"""
+    answers: List[QAAnswer] = attr.ib(factory=list)
+    failures: int = attr.ib(default=0)
+    # queries cancelled at the deadline
+    timeouts: int = attr.ib(default=0)
+
+    def extend(self, other: 'QAResults') -> None:
+        self.answers.extend(other.answers)
+        self.failures += other.failures
+        self.timeouts += other.timeouts
+
 #
 # API
 #
@@ -71,18 +196,99 @@ class QAServerConfig:
     host: str = attr.ib(default='0.0.0.0')
     port: int = attr.ib(default=8080, converter=int)
     qa_log_file: Optional[str] = attr.ib(default=None)
+    # entries waiting to be written to qa_log_file, beyond which they are
+    # dropped
+    qa_log_queue_size: int = attr.ib(default=10000, converter=int)
+    # rotate qa_log_file after this many bytes or seconds
+    qa_log_max_bytes: Optional[int] = attr.ib(
+                                default=None,
+                                converter=attr.converters.optional(int)
+                            )
+    qa_log_max_age: Optional[float] = attr.ib(
+                                default=None,
+                                converter=attr.converters.optional(float)
+                            )
+    # gzip rotated segments of qa_log_file
+    qa_log_compress: bool = attr.ib(default=False, converter=convert_bool)
+    # default bulkhead size for each qa service (see QA.max_concurrency)
+    qa_concurrency: int = attr.ib(default=4, converter=int)
+    # if a qa service not requiring context answers with at least this score,
+    # retrieval and the services requiring context are skipped
+    short_circuit_score: Optional[float] = attr.ib(
+                                default=None,
+                                converter=attr.converters.optional(float)
+                            )
+    # number of /question responses to cache, 0 disables the cache
+    answer_cache_size: int = attr.ib(default=0, converter=int)
+    # seconds before a cached response expires
+    answer_cache_ttl: Optional[float] = attr.ib(
+                                default=300.,
+                                converter=attr.converters.optional(float)
+                            )
+    # seconds after a write during which the database may still return the
+    # old document, so responses using it aren't cached
+    answer_cache_settle: float = attr.ib(default=0., converter=float)
+    # maximum number of questions in one request to /questions
+    max_batch_questions: int = attr.ib(default=1000, converter=int)
+    # default latency budget in seconds for /question, None for no limit
+    request_timeout: Optional[float] = attr.ib(
+                                default=None,
+                                converter=attr.converters.optional(float)
+                            )
+    # number of serialized paragraphs kept for encoding responses, and their
+    # memory budget
+    fragment_cache_size: int = attr.ib(default=1024, converter=int)
+    fragment_cache_bytes: int = attr.ib(default=16*2**20, converter=int)
+    # requests to /question and /questions answered at once, None for no
+    # limit.  Up to max_queued more wait, for at most max_queue_wait seconds,
+    # and the rest are rejected with 503
+    max_in_flight: Optional[int] = attr.ib(
+                                default=None,
+                                converter=attr.converters.optional(int)
+                            )
+    max_queued: int = attr.ib(default=64, converter=int)
+    max_queue_wait: Optional[float] = attr.ib(
+                                default=None,
+                                converter=attr.converters.optional(float)
+                            )
+    # seconds clients are asked to wait after a 503
+    retry_after: int = attr.ib(default=1, converter=int)
+    # lines of a request to /index/bulk sent to the database at once
+    bulk_batch_size: int = attr.ib(default=500, converter=int)
+    # paragraphs read from the database at once for /index?docId=*
+    read_page_size: int = attr.ib(default=1000, converter=int)
 
     @property
     def origin(self) -> str:
         return f'http://{self.host}:{self.port}'
 
+async def ndjson_lines(
+        content: StreamReader
+    ) -> AsyncIterator[Tuple[int,bytes]]:
+    """(line number, line) for the non-blank lines of a streamed body"""
+    buffer = b''
+    line_number = 0
+    async for chunk in content.iter_any():
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            line_number += 1
+            if line.strip() != b'':
+                yield line_number, line
+    if buffer.strip() != b'':
+        yield line_number + 1, buffer
+
 class QAServer:
     database: QueryDatabase
     qas: List[QA]
     app: web.Application
     config: QAServerConfig
-    qa_log: Optional[TextIO] = None
+    qa_log: Optional[LogWriter] = None
     no_answers: List[str]
+    bulkheads: Dict[int,asyncio.Semaphore]
+    answer_cache: AnswerCache
+    encoder: ResponseEncoder
+    admission: AdmissionController
 
     def __init__(
             self,
@@ -94,35 +300,215 @@ class QAServer:
         self.database = database
         self.qas = qas
         self.config = config
+        self.bulkheads = {}
+        self.answer_cache = AnswerCache(config.answer_cache_size,
+                                        config.answer_cache_ttl,
+                                        config.answer_cache_settle)
+        self.encoder = ResponseEncoder(config.fragment_cache_size,
+                                       config.fragment_cache_bytes)
+        self.admission = AdmissionController(config.max_in_flight,
+                                             config.max_queued,
+                                             config.max_queue_wait,
+                                             config.retry_after)
         if isinstance(config.qa_log_file, str):
-            self.qa_log = open(config.qa_log_file, 'a')
+            self.qa_log = LogWriter(config.qa_log_file,
+                                    queue_size=config.qa_log_queue_size,
+                                    max_bytes=config.qa_log_max_bytes,
+                                    max_age=config.qa_log_max_age,
+                                    compress=config.qa_log_compress)
         self.no_answers = [
             "I'm sorry, I couldn't find an answer to your question.",
             "I was unable to answer your query.",
             "Unfortunately I don't know how to answer that question.",
         ]
         middlewares = [
+            metrics_middleware,
             exception_middleware,
             attach_uuid_middleware,
         ]
         self.app = web.Application(middlewares=middlewares)
+        self.app.on_cleanup.append(self.close_logs)
 
     def __del__(self):
         log.debug('deleting qa server')
-        if isinstance(self.qa_log, TextIO):
+        if self.qa_log is not None:
             self.qa_log.close()
 
-    def log_qa(self, qa_answers: List[QAAnswer], qid: str):
+    async def close_logs(self, app: web.Application) -> None:
+        if self.qa_log is not None:
+            self.qa_log.close()
+
+    def log_qa(
+            self,
+            qa_answers: List[QAAnswer],
+            qid: str,
+            timings: Optional[Dict[str,Any]] = None,
+        ):
         log.debug('logging qa')
         if self.qa_log is not None:
             try:
-                answers = [attr.asdict(qa_answer) 
-                           for qa_answer in qa_answers]
-                entry = {'qid': qid, 'answers':answers}
-                print(json.dumps(entry), file=self.qa_log, flush=True)
+                with timed(LOG_QA_SECONDS, 'log_qa'):
+                    answers = [attr.asdict(qa_answer) 
+                               for qa_answer in qa_answers]
+                    entry: Dict[str,Any] = {'qid': qid, 'answers':answers}
+                    if timings is not None:
+                        entry['timings'] = timings
+                    # serialized and written by the log writer's thread
+                    self.qa_log.write(entry)
             except Exception as e:
                 log.error(f'Error while logging: {e}')
 
+    def bulkhead(self, qa: QA) -> asyncio.Semaphore:
+        """Semaphore limiting the number of concurrent queries to qa"""
+        # created lazily so that the semaphore belongs to the running loop
+        key = id(qa)
+        if key not in self.bulkheads:
+            limit = qa.max_concurrency or self.config.qa_concurrency
+            self.bulkheads[key] = asyncio.Semaphore(limit)
+        return self.bulkheads[key]
+
+    async def query_qa(
+            self,
+            qa: QA,
+            question: str,
+            paragraph: Optional[Paragraph] = None,
+        ) -> Optional[List[QAAnswer]]:
+        """Query a single qa service, optionally with a paragraph as context.
+
+        Errors are logged and result in None.
+        """
+        async with self.bulkhead(qa):
+            try:
+                with timed(QA_SECONDS, qa=qa_name(qa)):
+                    if paragraph is None:
+                        return await qa.query(question)
+                    new_answers = await qa.query(question,
+                                                 context=paragraph.text)
+            except QAQueryError as e:
+                msg = f'[QAQueryError]: {str(e)}'
+                log.exception(msg)
+                QA_ERRORS.inc(qa=qa_name(qa))
+                return None
+        return self.attribute_answers(new_answers, paragraph)
+
+    async def query_qa_many(
+            self,
+            qa: QA,
+            question: str,
+            paragraphs: List[Paragraph],
+        ) -> Optional[List[QAAnswer]]:
+        """Query a qa service supporting batches with all paragraphs at once"""
+        pairs = [(question, paragraph.text) for paragraph in paragraphs]
+        async with self.bulkhead(qa):
+            try:
+                with timed(QA_SECONDS, qa=qa_name(qa)):
+                    answers_per_paragraph = await qa.query_many(pairs)
+            except QAQueryError as e:
+                msg = f'[QAQueryError]: {str(e)}'
+                log.exception(msg)
+                QA_ERRORS.inc(qa=qa_name(qa))
+                return None
+        answers: List[QAAnswer] = []
+        for new_answers, paragraph in zip(answers_per_paragraph, paragraphs):
+            answers.extend(self.attribute_answers(new_answers, paragraph))
+        return answers
+
+    def attribute_answers(
+            self,
+            new_answers: List[QAAnswer],
+            paragraph: Paragraph,
+        ) -> List[QAAnswer]:
+        """Drop empty answers and attach the paragraph they came from"""
+        log.debug('[NEW ANSWERS]')
+        log.debug(f'{new_answers}')
+        answers: List[QAAnswer] = []
+        for new_answer in new_answers:
+            if new_answer.answer != '':
+                new_answer.docId = paragraph.docId
+                new_answer.paragraph = paragraph
+                answers.append(new_answer)
+        return answers
+
+    async def retrieve(
+            self,
+            question: str,
+            context: Optional[str],
+            ir_size: int,
+            qid: str,
+        ) -> List[Paragraph]:
+        """Get the paragraphs to use as context for the question"""
+        if context is None:
+            log.info('no context, querying db...')
+            paragraphs = list(await self.database.query(question, ir_size, qid))
+            log.debug(f'got {len(paragraphs)} paragraphs of context')
+            log.debug(f'{paragraphs}')
+        else:
+            paragraphs = [Paragraph(docId='provided.txt',text=context)]
+        retrieved_docids = "\n".join([p.docId for p in paragraphs])
+        log.info(f'Retrieved: \n{retrieved_docids}')
+        return paragraphs
+
+    async def query_qas(
+            self,
+            qas: List[QA],
+            question: str,
+            paragraphs: List[Paragraph],
+            emit: Optional[Emitter] = None,
+            timeout: Optional[float] = None,
+        ) -> QAResults:
+        """Query all qas concurrently, using paragraphs as context.
+
+        If given, emit is called with each answer as soon as its query
+        completes.  Queries still running after timeout seconds are cancelled.
+        """
+        queries = []
+        for qa in qas:
+            log.info(f'QA: {qa}')
+            if qa.requires_context and len(paragraphs) > 0:
+                if qa.supports_batch:
+                    queries.append(self.query_qa_many(qa, question, paragraphs))
+                    continue
+                for paragraph in paragraphs:
+                    queries.append(self.query_qa(qa, question, paragraph))
+            else:
+                queries.append(self.query_qa(qa, question))
+        results = QAResults()
+        if len(queries) == 0:
+            return results
+        deadline = Deadline(timeout)
+        tasks = [asyncio.ensure_future(query) for query in queries]
+        if emit is not None:
+            try:
+                for next_done in asyncio.as_completed(tasks, timeout=timeout):
+                    for answer in await next_done or []:
+                        await emit({'event': 'answer',
+                                    'answer': attr.asdict(answer)})
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # emitting failed (the client may be gone), or this was
+                # cancelled: the queries still running would be orphaned
+                for task in tasks:
+                    task.cancel()
+                raise
+        _, pending = await asyncio.wait(tasks, timeout=deadline.remaining())
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            log.warning(f'cancelled {len(pending)} qa queries at deadline')
+            results.timeouts = len(pending)
+        # results are collected in the order of the queries, so sorting (which
+        # is stable) yields the same ordering as querying one at a time
+        for task in tasks:
+            if task in pending:
+                continue
+            new_answers = task.result()
+            if new_answers is None:
+                results.failures += 1
+            else:
+                results.answers.extend(new_answers)
+        return results
+
     def no_answer_reply(self) -> str:
         log.debug('getting reply instead of answer')
         return random.choice(self.no_answers)
@@ -135,12 +521,9 @@ class QAServer:
         #log.debug(answers)
         answers_: List[Dict[str,Any]] = []
         for answer in answers:
+            # asdict recurses into the paragraph (which may be None)
             answer_ = attr.asdict(answer)
             #log.debug(answer_)
-            if hasattr(answer,'paragraph'):
-                answer_['paragraph'] = attr.asdict(answer.paragraph)
-            else:
-                answer_['paragraph'] = None
             answers_.append(answer_)
         if len(answers_) > 0:
             chosen_answer: Optional[Dict[str,Any]] = answers_[0]
@@ -153,7 +536,7 @@ class QAServer:
 
     async def answer_question(
             self, request: Request, qa_size=3, ir_size=5
-        ) -> Response:
+        ) -> web.StreamResponse:
         log.debug('answering question')
         json_question: JsonQuestionOptionalContext\
                 = await JsonQuestionOptionalContext.from_request(request)
@@ -161,53 +544,292 @@ class QAServer:
         question = json_question.question
         context = json_question.context
         qid = request['qid']
-        if context is None:
-            log.info('no context, querying db...')
-            paragraphs = list(await self.database.query(question, ir_size, qid))
-            log.debug(f'got {len(paragraphs)} paragraphs of context')
-            log.debug(f'{paragraphs}')
+        timeout = get_request_timeout(request, self.config.request_timeout)
+        stream = get_stream_format(request)
+        if stream is not None:
+            return await self.stream_answers(request, stream, question,
+                                             context, ir_size, timeout)
+        response_format = ResponseFormat.from_request(request)
+        response_answers = await self.get_response(question, context, qid,
+                                                   ir_size, timeout=timeout)
+        log.debug(f'response_answers: type: {type(response_answers)}, val: {response_answers}')
+        with timed(SERIALIZE_SECONDS, 'serialize'):
+            body = self.encoder.encode(response_answers, response_format)
+        return web.Response(text=body, content_type='application/json')
+
+    async def stream_answers(
+            self,
+            request: Request,
+            stream: str,
+            question: str,
+            context: Optional[str],
+            ir_size: int,
+            timeout: Optional[float] = None,
+        ) -> web.StreamResponse:
+        qid = request['qid']
+        response = web.StreamResponse()
+        response.content_type = STREAM_CONTENT_TYPES[stream]
+        response.set_cookie('qa_server.qid',qid)
+        await response.prepare(request)
+        async def emit(frame: Dict[str,Any]) -> None:
+            await response.write(encode_frame(frame, stream))
+        try:
+            response_answers = await self.get_response(question, context, qid,
+                                                       ir_size, emit, timeout)
+        # the headers are sent, so the exception_middleware can't respond
+        except Exception as e:
+            log.exception(e)
+            msg = 'an internal error has occurred'
+            await emit({'event': 'error', 'message': msg})
         else:
-            paragraphs = [Paragraph(docId='provided.txt',text=context)]
-        retrieved_docids = "\n".join([p.docId for p in paragraphs])
-        log.info(f'Retrieved: \n{retrieved_docids}')
-        answers: List[QAAnswer] = []
-        for qa in self.qas:
-            log.info(f'QA: {qa}')
-            if qa.requires_context and len(paragraphs) > 0:
-                for paragraph in paragraphs:
-                    try:
-                        new_answers = await qa.query(question, context=paragraph.text)
-                        log.debug('[NEW ANSWERS]')
-                        log.debug(f'{new_answers}')
-                        for new_answer in new_answers:
-                            if new_answer.answer != '':
-                                new_answer.docId = paragraph.docId
-                                new_answer.paragraph = paragraph
-                                answers.append(new_answer)
-                    except QAQueryError as e:
-                        msg = f'[QAQueryError]: {str(e)}'
-                        log.exception(msg)
+            await emit({'event': 'chosen_answer',
+                        'question': question,
+                        'chosen_answer': response_answers['chosen_answer'],
+                        'partial': response_answers['partial']})
+        await response.write_eof()
+        return response
+
+    async def get_response(
+            self,
+            question: str,
+            context: Optional[str],
+            qid: str,
+            ir_size: int,
+            emit: Optional[Emitter] = None,
+            timeout: Optional[float] = None,
+        ) -> Dict[str,Any]:
+        """Answer the question, using the answer cache when possible.
+
+        If emit is given, it is called with the retrieved docIds and then
+        with each answer as it becomes available.  If timeout is given, the
+        answer is built from what has arrived after that many seconds.
+        """
+        cache_key = AnswerCache.key(question, context)
+        cached = self.answer_cache.get(cache_key)
+        if cached is not None:
+            log.info('answer cache hit')
+            if emit is not None:
+                await emit({'event': 'retrieved', 'docIds': cached.docIds})
+                for answer in cached.response['answers']:
+                    await emit({'event': 'answer', 'answer': answer})
+            return dict(cached.response, question=question, partial=False)
+        generation = self.answer_cache.begin()
+        deadline = Deadline(timeout)
+        # seconds spent in each stage, logged with the answers
+        timings: Dict[str,Any] = {'budget': timeout}
+        qas = self.qas
+        results = QAResults()
+        paragraphs: List[Paragraph] = []
+        retrieval_timed_out = False
+        threshold = self.config.short_circuit_score
+        if threshold is not None:
+            started = deadline.elapsed()
+            context_free = [qa for qa in qas if not qa.requires_context]
+            results = await self.query_qas(context_free, question, paragraphs,
+                                           timeout=deadline.remaining())
+            timings['short_circuit'] = deadline.elapsed() - started
+            record_stage('short_circuit', timings['short_circuit'])
+            qas = [qa for qa in qas if qa.requires_context]
+            if any(answer.score >= threshold for answer in results.answers):
+                log.info(f'short circuit: answer with score >= {threshold}')
+                qas = []
+        if len(qas) > 0:
+            started = deadline.elapsed()
+            try:
+                paragraphs = await asyncio.wait_for(
+                        self.retrieve(question, context, ir_size, qid),
+                        deadline.remaining())
+            except asyncio.TimeoutError:
+                log.warning('retrieval cancelled at deadline')
+                retrieval_timed_out = True
+            timings['retrieve'] = deadline.elapsed() - started
+            record_stage('retrieve', timings['retrieve'])
+        if emit is not None:
+            docIds = [p.docId for p in paragraphs]
+            await emit({'event': 'retrieved', 'docIds': docIds})
+            # answers from before retrieval (see short_circuit_score)
+            for answer in results.answers:
+                await emit({'event': 'answer', 'answer': attr.asdict(answer)})
+        if not retrieval_timed_out:
+            started = deadline.elapsed()
+            results.extend(await self.query_qas(qas, question, paragraphs,
+                                                emit, deadline.remaining()))
+            timings['qa'] = deadline.elapsed() - started
+            record_stage('qa', timings['qa'])
+        timings['total'] = deadline.elapsed()
+        partial = retrieval_timed_out or results.timeouts > 0
+        timings['partial'] = partial
+        answers = results.answers
+        self.log_qa(answers, qid, timings)
+        log.debug(f'got {len(answers)} answers')
+        response_answers = self.get_answers_for_response(answers)
+        # don't keep degraded responses around
+        if not partial and results.failures == 0:
+            # provided context doesn't depend on the database
+            docIds = [p.docId for p in paragraphs] if context is None else []
+            self.answer_cache.put(cache_key, response_answers, docIds,
+                                  generation)
+        return dict(response_answers, question=question, partial=partial)
+
+    async def answer_questions(
+            self, request: Request, ir_size=5
+        ) -> Response:
+        """Answer a batch of questions, responding with a list of answers.
+
+        Retrieval for all questions is done in one database round trip, and
+        all (question, paragraph) pairs are sent to each qa service which
+        supports batches in one call.
+        """
+        log.debug('answering questions')
+        json_questions: JsonQuestions = \
+                await JsonQuestions.from_request(request)
+        response_format = ResponseFormat.from_request(request)
+        items = json_questions.questions
+        if len(items) > self.config.max_batch_questions:
+            msg = f'at most {self.config.max_batch_questions} questions allowed'
+            raise APIError(request, msg)
+        log.info(f'answering {len(items)} questions')
+        qid = request['qid']
+        responses: List[Optional[Dict[str,Any]]] = [None] * len(items)
+        cache_keys = [AnswerCache.key(item.question, item.context)
+                      for item in items]
+        pending: List[int] = []
+        generation = self.answer_cache.begin()
+        for i, (item, cache_key) in enumerate(zip(items, cache_keys)):
+            cached = self.answer_cache.get(cache_key)
+            if cached is not None:
+                responses[i] = dict(cached.response, question=item.question)
+            else:
+                pending.append(i)
+        results: Dict[int,QAResults] = {i: QAResults() for i in pending}
+        qas = self.qas
+        to_retrieve = pending
+        threshold = self.config.short_circuit_score
+        if threshold is not None:
+            context_free = [qa for qa in qas if not qa.requires_context]
+            results.update(zip(pending, await asyncio.gather(*[
+                self.query_qas(context_free, items[i].question, [])
+                for i in pending])))
+            qas = [qa for qa in qas if qa.requires_context]
+            to_retrieve = [i for i in pending
+                           if not any(answer.score >= threshold
+                                      for answer in results[i].answers)]
+        paragraphs: Dict[int,List[Paragraph]] = {i: [] for i in pending}
+        if len(qas) > 0 and len(to_retrieve) > 0:
+            retrieved = await self.retrieve_many(
+                            [items[i] for i in to_retrieve], ir_size, qid)
+            paragraphs.update(zip(to_retrieve, retrieved))
+        questions = [(i, items[i].question, paragraphs[i]) for i in to_retrieve]
+        per_qa = await asyncio.gather(*[
+            self.query_qa_questions(qa, questions) for qa in qas])
+        for results_ in per_qa:
+            for i, result in results_.items():
+                results[i].extend(result)
+        for i in pending:
+            answers = results[i].answers
+            self.log_qa(answers, qid)
+            response_answers = self.get_answers_for_response(answers)
+            if results[i].failures == 0:
+                docIds = [p.docId for p in paragraphs[i]] \
+                            if items[i].context is None else []
+                self.answer_cache.put(cache_keys[i], response_answers, docIds,
+                                      generation)
+            responses[i] = dict(response_answers, question=items[i].question)
+        # every question is either cached or pending, so none is missing
+        answered = [response for response in responses
+                    if response is not None]
+        with timed(SERIALIZE_SECONDS, 'serialize'):
+            body = self.encoder.encode_many(answered, response_format)
+        return web.Response(text=body, content_type='application/json')
+
+    async def retrieve_many(
+            self,
+            items: List[JsonQuestionOptionalContext],
+            ir_size: int,
+            qid: str,
+        ) -> List[List[Paragraph]]:
+        """Get the paragraphs to use as context for each question"""
+        to_query = [item.question for item in items if item.context is None]
+        log.info(f'querying db for {len(to_query)} questions')
+        queried = iter(await self.database.query_many(to_query, ir_size, qid))
+        paragraphs: List[List[Paragraph]] = []
+        for item in items:
+            if item.context is None:
+                paragraphs.append(next(queried))
             else:
+                provided = Paragraph(docId='provided.txt',text=item.context)
+                paragraphs.append([provided])
+        return paragraphs
+
+    async def query_qa_questions(
+            self,
+            qa: QA,
+            questions: List[Tuple[int,str,List[Paragraph]]],
+        ) -> Dict[int,QAResults]:
+        """Query qa with many questions, each with their own paragraphs.
+
+        Returns the results for each question.
+        """
+        results: Dict[int,QAResults] = {}
+        if qa.requires_context and qa.supports_batch:
+            with_context = [(i, question, paragraph)
+                            for i, question, paragraphs in questions
+                            for paragraph in paragraphs]
+            async with self.bulkhead(qa):
                 try:
-                    new_answers = await qa.query(question)
-                    answers.extend(new_answers)
+                    with timed(QA_SECONDS, qa=qa_name(qa)):
+                        answers_per_pair = await qa.query_many(
+                                [(question, paragraph.text)
+                                 for _, question, paragraph in with_context])
                 except QAQueryError as e:
                     msg = f'[QAQueryError]: {str(e)}'
                     log.exception(msg)
-        self.log_qa(answers, qid)
-        log.debug(f'got {len(answers)} answers')
-        response_answers = self.get_answers_for_response(answers)
-        response_answers.update({'question':question})
-        log.debug(f'response_answers: type: {type(response_answers)}, val: {response_answers}')
-        return web.json_response(response_answers)
+                    QA_ERRORS.inc(qa=qa_name(qa))
+                    answers_per_pair = None
+            for i, _, _ in questions:
+                failures = 1 if answers_per_pair is None else 0
+                results[i] = QAResults(failures=failures)
+            if answers_per_pair is not None:
+                for (i, _, paragraph), new_answers in zip(with_context,
+                                                          answers_per_pair):
+                    answers = self.attribute_answers(new_answers, paragraph)
+                    results[i].answers.extend(answers)
+            # questions without context are handled one at a time below
+            questions = [(i, question, paragraphs)
+                         for i, question, paragraphs in questions
+                         if len(paragraphs) == 0]
+        rest = await asyncio.gather(*[
+                    self.query_qas([qa], question, paragraphs)
+                    for _, question, paragraphs in questions])
+        results.update(zip([i for i, _, _ in questions], rest))
+        return results
 
-    async def crud_read(self, request: Request) -> Response:
+    async def get_stats(self, request: Request) -> Response:
+        stats = {'answer_cache': self.answer_cache.get_stats(),
+                 'fragment_cache': self.encoder.get_stats(),
+                 'admission': self.admission.get_stats(),
+                 'database': self.database.get_stats()}
+        if self.qa_log is not None:
+            stats['qa_log'] = self.qa_log.get_stats()
+        return web.json_response(stats)
+
+    async def crud_read(self, request: Request) -> web.StreamResponse:
         api_message = 'read requires a querystring parameter: /index?docId=...'
-        query = request.query
-        try:
-            docId = query['docId']
-        except KeyError as e:
+        docIds = request.query.getall('docId', [])
+        if len(docIds) == 0:
             raise APIError(request, api_message)
+        if len(docIds) > 1:
+            if '*' in docIds:
+                raise APIError(request, 'docId=* must be the only docId')
+            log.info(f'[READ] {len(docIds)} docIds')
+            paragraphs = await self.database.read_many(docIds)
+            if len(paragraphs) == 0:
+                return HTTPNotFound()
+            return web.json_response([attr.asdict(paragraph)
+                                      for paragraph in paragraphs])
+        docId = docIds[0]
+        if docId == '*':
+            return await self.stream_all(request)
         log.info(f'[READ] docId={docId}')
         try:
             paragraphs = await self.database.read(docId)
@@ -219,6 +841,48 @@ class QAServer:
         paragraphs_ = [attr.asdict(paragraph) for paragraph in paragraphs]
         return web.json_response(paragraphs_)
 
+    async def stream_all(self, request: Request) -> web.StreamResponse:
+        """Every paragraph as NDJSON, in docId order, starting after
+        ?after=... and stopping after ?limit=... paragraphs.  If stopped by
+        the limit, the last line is {"cursor": ...}, to be passed as after
+        to continue."""
+        after = request.query.get('after')
+        try:
+            limit = request.query.get('limit')
+            limit_ = None if limit is None else int(limit)
+            if limit_ is not None and limit_ <= 0:
+                raise ValueError
+        except ValueError:
+            raise APIError(request, 'limit must be a positive integer')
+        log.info(f'[READ] all, after={after}, limit={limit_}')
+        response = web.StreamResponse()
+        response.content_type = STREAM_CONTENT_TYPES['ndjson']
+        await response.prepare(request)
+        page_size = self.config.read_page_size
+        sent = 0
+        try:
+            while limit_ is None or sent < limit_:
+                size = page_size if limit_ is None \
+                       else min(page_size, limit_ - sent)
+                page = await self.database.read_page(after, size)
+                lines = ''.join(json.dumps(attr.asdict(paragraph)) + '\n'
+                                for paragraph in page)
+                await response.write(lines.encode())
+                sent += len(page)
+                if len(page) < size:
+                    break
+                after = page[-1].docId
+            else:
+                cursor = json.dumps({'cursor': after}) + '\n'
+                await response.write(cursor.encode())
+        # the headers are sent, so the exception_middleware can't respond
+        except Exception as e:
+            log.exception(e)
+            error = {'error': 'an internal error has occurred'}
+            await response.write((json.dumps(error) + '\n').encode())
+        await response.write_eof()
+        return response
+
     async def crud_create_update(self, request: Request) -> Response:
         crud_op = await JsonCrudOperation.from_request(request)
         paragraph = Paragraph(crud_op.docId, crud_op.text)
@@ -226,10 +890,12 @@ class QAServer:
         if crud_op.operation == 'create':
             log.info(f'creating: {crud_op.docId}')
             await self.database.create(paragraph)
+            self.answer_cache.invalidate(crud_op.docId)
             return Response()
         else: # crud_op.operation == 'update':
             log.info(f'updating: {crud_op.docId}')
             await self.database.update(paragraph)
+            self.answer_cache.invalidate(crud_op.docId)
             return Response()
 
     async def crud_delete(self, request: Request) -> Response:
@@ -241,14 +907,63 @@ class QAServer:
             raise APIError(request, api_message)
         log.info(f'deleting: {docId}')
         await self.database.delete(docId)
+        self.answer_cache.invalidate(docId)
         return Response()
 
-    def run(self):
-        log.info('running qa_server')
+    async def write_batch(
+            self,
+            batch: List[Tuple[int,WriteOperation]]
+        ) -> List[Dict[str,Any]]:
+        results = await self.database.write_many([op for _, op in batch])
+        items = []
+        for (line, _), result in zip(batch, results):
+            if result.ok:
+                self.answer_cache.invalidate(result.docId)
+            item = {'line': line, **attr.asdict(result)}
+            if result.error is None:
+                del item['error']
+            items.append(item)
+        return items
+
+    async def crud_bulk(self, request: Request) -> Response:
+        """NDJSON operations, written batch_size at a time as they arrive.
+        Each line gets a result; a bad line doesn't stop the others."""
+        items: List[Dict[str,Any]] = []
+        batch: List[Tuple[int,WriteOperation]] = []
+        async for line_number, line in ndjson_lines(request.content):
+            try:
+                op = JsonBulkOperation.from_line(line)
+            except ValueError as e:
+                items.append({'line': line_number, 'status': 400,
+                              'error': str(e)})
+                continue
+            batch.append((line_number,
+                          WriteOperation(op.operation, op.docId, op.text)))
+            if len(batch) >= self.config.bulk_batch_size:
+                items.extend(await self.write_batch(batch))
+                batch = []
+        if len(batch) > 0:
+            items.extend(await self.write_batch(batch))
+        items.sort(key=lambda item: item['line'])
+        log.info(f'[BULK] {len(items)} operations')
+        errors = sum(1 for item in items if item['status'] >= 300)
+        return web.json_response({'errors': errors, 'items': items})
+
+    def add_routes(self):
         self.app.add_routes([
             web.get('/index', self.crud_read),
             web.post('/index', self.crud_create_update),
+            web.post('/index/bulk', self.crud_bulk),
             web.delete('/index', self.crud_delete),
-            web.post('/question', self.answer_question),
+            web.post('/question',
+                     self.admission.admitted(self.answer_question)),
+            web.post('/questions',
+                     self.admission.admitted(self.answer_questions)),
+            web.get('/stats', self.get_stats),
+            web.get('/metrics', metrics_handler),
         ])
+
+    def run(self):
+        log.info('running qa_server')
+        self.add_routes()
         web.run_app(self.app, host=self.config.host, port=self.config.port)
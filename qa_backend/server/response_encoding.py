@@ -0,0 +1,146 @@
+# response_encoding.py
+"""
+JSON encoding of /question responses.
+
+Paragraph text dominates the size of a response, and the same paragraph is
+usually attached to several answers.  Each paragraph is serialized once into
+a JSON fragment, which is cached and spliced into the response text.
+
+With ?format=compact, each paragraph is sent once in a `paragraphs` list and
+answers refer to theirs by its index in the list: passages of one document,
+and provided contexts, share a docId.  ?fields=... selects the answer
+fields to send; leaving out `paragraph` drops paragraph text altogether.
+"""
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
+import logging
+import sys
+
+from aiohttp.web import Request # type: ignore
+import attr
+
+from qa_backend.util import APIError
+from qa_backend.util import QAAnswer
+from qa_backend.util.cache import LRUCache
+
+log = logging.getLogger('server')
+
+ANSWER_FIELDS = tuple(field.name for field in attr.fields(QAAnswer))
+
+RESPONSE_FORMATS = ('full', 'compact')
+
+# paragraphs are keyed by their text as well, since provided contexts all
+# share a docId, and by their offsets, if they are passages
+FragmentKey = Tuple[str,str,int,int]
+
+@attr.s(slots=True, frozen=True)
+class ResponseFormat:
+    compact: bool = attr.ib(default=False)
+    fields: Tuple[str,...] = attr.ib(default=ANSWER_FIELDS)
+
+    @classmethod
+    def from_request(cls, request: Request) -> 'ResponseFormat':
+        """Format requested with ?format=...&fields=..."""
+        format_ = request.query.get('format', 'full')
+        if format_ not in RESPONSE_FORMATS:
+            formats = ', '.join(RESPONSE_FORMATS)
+            raise APIError(request, f'format must be one of: {formats}')
+        fields = ANSWER_FIELDS
+        if 'fields' in request.query:
+            fields = tuple(field for field in request.query['fields'].split(',')
+                           if field != '')
+            unknown = [field for field in fields if field not in ANSWER_FIELDS]
+            if len(unknown) > 0:
+                allowed = ', '.join(ANSWER_FIELDS)
+                raise APIError(request, f'fields must be among: {allowed}')
+        return cls(compact=format_ == 'compact', fields=fields)
+
+    @property
+    def with_paragraphs(self) -> bool:
+        return 'paragraph' in self.fields
+
+def fragment_sizeof(fragment: str) -> int:
+    return sys.getsizeof(fragment)
+
+class ResponseEncoder:
+    fragments: LRUCache[FragmentKey,str]
+
+    def __init__(self, cache_size: int, cache_bytes: Optional[int] = None):
+        self.fragments = LRUCache(cache_size, max_bytes=cache_bytes,
+                                  sizeof=fragment_sizeof)
+
+    def fragment(self, paragraph: Dict[str,Any]) -> str:
+        """JSON for a paragraph (as in a response), serialized at most once"""
+        key = (paragraph['docId'], paragraph['text'],
+               paragraph.get('start', 0), paragraph.get('end', 0))
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragment = json.dumps(paragraph)
+            self.fragments.put(key, fragment)
+        return fragment
+
+    def encode_answer(
+            self,
+            answer: Dict[str,Any],
+            response_format: ResponseFormat,
+            paragraphs: Optional[Dict[str,int]] = None,
+        ) -> str:
+        """With the compact format, the paragraph is encoded as its index in
+        paragraphs, a map of fragments to indexes"""
+        items: List[str] = []
+        for field in response_format.fields:
+            value = answer[field]
+            if field != 'paragraph':
+                items.append(f'"{field}": {json.dumps(value)}')
+            elif value is None:
+                items.append(f'"{field}": null')
+            elif paragraphs is None:
+                items.append(f'"{field}": {self.fragment(value)}')
+            else:
+                index = paragraphs.setdefault(self.fragment(value),
+                                              len(paragraphs))
+                items.append(f'"{field}": {index}')
+        return '{' + ', '.join(items) + '}'
+
+    def encode(
+            self, response: Dict[str,Any], response_format: ResponseFormat
+        ) -> str:
+        """Encode a response from QAServer.get_response"""
+        items: List[str] = []
+        # fragment -> index in the paragraphs list, in order of first use
+        paragraphs: Optional[Dict[str,int]] = None
+        if response_format.compact:
+            paragraphs = {}
+        for key, value in response.items():
+            if key == 'answers':
+                answers = [self.encode_answer(answer, response_format,
+                                              paragraphs)
+                           for answer in value]
+                encoded = '[' + ', '.join(answers) + ']'
+            elif key == 'chosen_answer' and value is not None:
+                encoded = self.encode_answer(value, response_format,
+                                             paragraphs)
+            else:
+                encoded = json.dumps(value)
+            items.append(f'{json.dumps(key)}: {encoded}')
+        if paragraphs is not None and response_format.with_paragraphs:
+            # dicts keep insertion order, which is the order of the indexes
+            items.append(f'"paragraphs": [{", ".join(paragraphs)}]')
+        return '{' + ', '.join(items) + '}'
+
+    def encode_many(
+            self,
+            responses: List[Dict[str,Any]],
+            response_format: ResponseFormat,
+        ) -> str:
+        encoded = [self.encode(response, response_format)
+                   for response in responses]
+        return '[' + ', '.join(encoded) + ']'
+
+    def get_stats(self) -> Dict[str,int]:
+        return self.fragments.get_stats()
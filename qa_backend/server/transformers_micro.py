@@ -13,7 +13,6 @@ from typing import List
 from typing import MutableMapping
 from typing import Optional
 from typing import Tuple
-from typing import cast
 import logging
 import os
 import sys
@@ -27,6 +26,7 @@ import aiohttp.web as web # type: ignore
 import attr
 
 from qa_backend.services.qa import LazyPipeline
+from qa_backend.services.qa import QA
 from qa_backend.services.qa import TransformersQA
 from qa_backend.services.qa import TransformersQAConfig
 from qa_backend.util import APIError
@@ -34,10 +34,18 @@ from qa_backend.util import Configurable
 from qa_backend.util import ConfigurationError
 from qa_backend.util import ConfigurationError
 from qa_backend.util import JsonQuestion
+from qa_backend.util import JsonQuestionBatch
 from qa_backend.util import exception_middleware
+from qa_backend.util.metrics import metrics_handler
+from qa_backend.util.metrics import metrics_middleware
+from qa_backend.util.metrics import registry
+from qa_backend.util.metrics import timed
 
 log = logging.getLogger('server')
 
+SERIALIZE_SECONDS = registry.histogram('qa_serialize_duration_seconds',
+                                       'Time taken to encode responses')
+
 @attr.s(kw_only=True)
 class TransformersMicroConfig(Configurable):
     host: str = attr.ib(default='0.0.0.0')
@@ -51,6 +59,10 @@ class TransformersMicroConfig(Configurable):
     def url(self) -> str:
         return f'http://{self.host}:{self.port}/{self.path}'
 
+    @property
+    def batch_path(self) -> str:
+        return f'{self.path}/batch'
+
 def _extract_keys(
         dict_: MutableMapping[str,str],
         keys: List[str]
@@ -64,22 +76,23 @@ def split_micro_config(
     """Split config into keys for the micro service and the TransformersQA"""
     micro_keys = ['host','port']
     micro_config = _extract_keys(config, micro_keys)
-    transformer_keys = ['model_name','use_gpu','device']
+    transformer_keys = ['model_name','use_gpu','device','batch_size']
     transformer_config = _extract_keys(config, transformer_keys)
     return micro_config, transformer_config
 
 class TransformersMicro:
     config: TransformersMicroConfig
-    transformers_qa: TransformersQA
+    # any qa service can be served, e.g. a stand-in for benchmarks
+    transformers_qa: QA
 
     def __init__(
             self,
             config: TransformersMicroConfig,
-            transformers_qa: Optional[TransformersQA] = None,
+            transformers_qa: Optional[QA] = None,
             transformers_qa_config: Optional[TransformersQAConfig] = None
         ):
         self.config = config
-        if isinstance(transformers_qa, TransformersQA):
+        if isinstance(transformers_qa, QA):
             self.transformers_qa = transformers_qa
         elif isinstance(transformers_qa_config, TransformersQAConfig):
             log.info(f'TransformersMicro: creating from config:{transformers_qa_config}')
@@ -114,17 +127,41 @@ class TransformersMicro:
         # QAQueryError will pass to middleware
         answers = await self.transformers_qa.query(question, context=context)
         log.debug(f'micro got answer: {answers}')
-        answers_ = [attr.asdict(answer) for answer in answers]
-        return web.json_response(answers_)
+        with timed(SERIALIZE_SECONDS, 'serialize'):
+            answers_ = [attr.asdict(answer) for answer in answers]
+            return web.json_response(answers_)
 
-    def run(self, create_pipeline_now = False) -> None:
-        if create_pipeline_now and isinstance(self.transformers_qa.pipeline,
-                                              LazyPipeline):
-            self.transformers_qa.pipeline.create_now()
-        app = web.Application(middlewares=[exception_middleware])
+    async def answer_questions(self, request: Request) -> Response:
+        """Answer a batch of questions with a single call to the pipeline"""
+        log.debug('answering question batch')
+        json_batch: JsonQuestionBatch = \
+                await JsonQuestionBatch.from_request(request)
+        pairs = json_batch.pairs
+        log.info(f'json_batch: {len(pairs)} questions')
+        # QAQueryError will pass to middleware
+        answers = await self.transformers_qa.query_many(pairs)
+        log.debug(f'micro got answers: {answers}')
+        with timed(SERIALIZE_SECONDS, 'serialize'):
+            answers_ = [[attr.asdict(answer) for answer in answers_for_pair]
+                        for answers_for_pair in answers]
+            return web.json_response(answers_)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[metrics_middleware,
+                                           exception_middleware])
         app.add_routes([
             web.post(f'/{self.config.path}', self.answer_question),
+            web.post(f'/{self.config.batch_path}', self.answer_questions),
+            web.get('/metrics', metrics_handler),
         ])
+        return app
+
+    def run(self, create_pipeline_now = False) -> None:
+        if create_pipeline_now \
+                and isinstance(self.transformers_qa, TransformersQA) \
+                and isinstance(self.transformers_qa.pipeline, LazyPipeline):
+            self.transformers_qa.pipeline.create_now()
+        app = self.make_app()
         log.info(f'Running transformers_micro: pid: {os.getpid()}')
         #self.transformers_qa = TransformersQA(
                                     #model_name=self.model_name,
@@ -4,10 +4,29 @@ GIT and ES crud frontends
 
 from .abstract_database import Database
 from .abstract_database import DocId
+from .abstract_database import IngestReport
 from .abstract_database import QueryDatabase
+from .abstract_database import WriteOperation
+from .abstract_database import WriteResult
 
 from .database_error import *
 
+from .backup import BackupManager
+from .backup import BackupManifest
+from .write_behind import WriteBehind
+
+from .dense_database import DenseConfig
+from .dense_database import DenseDatabase
+from .dense_database import Encoder
+from .dense_database import HashingEncoder
+from .vector_index import VectorIndex
+
+from .passages import PassageConfig
+from .passages import PassageDatabase
+
+from .bm25_database import BM25Database
+from .bm25_database import BM25DatabaseConfig
+
 from .es_database import ElasticsearchDatabase
 from .es_database import ElasticsearchDatabaseConfig
 from .es_database import ElasticsearchDatabaseError
@@ -6,21 +6,89 @@ Abstract database requires basic CRUD functionality:
 from abc import abstractmethod
 from pathlib import Path
 from typing import Any
+from typing import AsyncIterator
 from typing import Callable
 from typing import Coroutine
+from typing import Dict
 from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import cast
+import asyncio
 import functools
 import logging
+import re
+
+import attr
 
 from .database_error import *
 from qa_backend.util import Configurable
+from qa_backend.util import DOC_ID_PATTERN
 from qa_backend.util import Paragraph
 
 log = logging.getLogger('database')
 
 DocId = str
 
+@attr.s(slots=True)
+class IngestReport:
+    """What happened to each document of a bulk ingestion"""
+    created: int = attr.ib(default=0)
+    # docIds that already existed
+    skipped: List[DocId] = attr.ib(factory=list)
+    # docId -> reason
+    failed: Dict[DocId,str] = attr.ib(factory=dict)
+
+    def extend(self, other: 'IngestReport') -> None:
+        self.created += other.created
+        self.skipped.extend(other.skipped)
+        self.failed.update(other.failed)
+
+    def __str__(self) -> str:
+        return f'created: {self.created}, skipped: {len(self.skipped)}, ' \
+               f'failed: {len(self.failed)}'
+
+@attr.s(slots=True)
+class WriteOperation:
+    # create, update or delete
+    operation: str = attr.ib()
+    docId: DocId = attr.ib()
+    # not used by delete
+    text: Optional[str] = attr.ib(default=None)
+
+@attr.s(slots=True)
+class WriteResult:
+    """Outcome of a WriteOperation, status as in http"""
+    operation: str = attr.ib()
+    docId: DocId = attr.ib()
+    status: int = attr.ib()
+    error: Optional[str] = attr.ib(default=None)
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 300
+
+def invalid_operation(op: WriteOperation) -> Optional[WriteResult]:
+    """A failed result for an operation no database can apply"""
+    if re.fullmatch(DOC_ID_PATTERN, op.docId) is None:
+        return WriteResult(op.operation, op.docId, 400,
+                           f'invalid docId: {op.docId}')
+    return None
+
+def read_text(path: Path) -> str:
+    with open(path) as file:
+        return file.read()
+
+def write_text(path: Path, text: str) -> None:
+    with open(path, 'w') as file:
+        file.write(text)
+
+def chunked(items: Sequence[Any], size: int) -> Iterator[Sequence[Any]]:
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
 class Database(Configurable):
     @abstractmethod
     async def create(
@@ -51,35 +119,178 @@ class Database(Configurable):
         ) -> None:
         ...
 
+    async def start(self):
+        """Called in the server's event loop before it serves requests"""
+        pass
+
     async def shutdown(self):
         pass
 
+    def get_stats(self) -> Dict[str,Any]:
+        """Counters describing the database, e.g. cache statistics"""
+        return {}
+
     async def get_all(self) -> List[Paragraph]:
+        return await self.read('*')
+
+    async def read_page(
+            self,
+            after: Optional[DocId],
+            size: int
+        ) -> List[Paragraph]:
+        """Up to size paragraphs with docIds after `after`, in docId order.
+        Databases should override this to avoid reading everything, and
+        must if their read('*') uses iter_all."""
+        paragraphs = sorted(await self.read('*'), key=lambda p: p.docId)
+        if after is not None:
+            paragraphs = [p for p in paragraphs if p.docId > after]
+        return paragraphs[:size]
+
+    async def iter_all(
+            self,
+            page_size: int = 1000,
+            after: Optional[DocId] = None
+        ) -> AsyncIterator[Paragraph]:
+        """Every paragraph, in docId order, read page_size at a time.
+        Writes made while iterating may or may not be seen."""
+        while True:
+            page = await self.read_page(after, page_size)
+            for paragraph in page:
+                yield paragraph
+            if len(page) < page_size:
+                return
+            after = page[-1].docId
+
+    async def read_many(
+            self,
+            docIds: Sequence[DocId]
+        ) -> List[Paragraph]:
+        """The paragraphs found, once each and in the order of docIds.
+        Databases may do this in one round trip"""
+        reads = await asyncio.gather(*[self.read(docId)
+                                       for docId in dict.fromkeys(docIds)])
+        return [paragraph for paragraphs in reads for paragraph in paragraphs]
+
+    async def write_many(
+            self,
+            operations: Sequence[WriteOperation]
+        ) -> List[WriteResult]:
+        """Apply operations in order, returning a result for each rather
+        than raising.  Databases may do this in one round trip, and not make
+        the writes searchable until refresh"""
+        results = []
+        for op in operations:
+            status = 200
+            error: Optional[str] = None
+            try:
+                if op.operation == 'create':
+                    await self.create(Paragraph(op.docId, cast(str, op.text)))
+                    status = 201
+                elif op.operation == 'update':
+                    await self.update(Paragraph(op.docId, cast(str, op.text)))
+                else: # op.operation == 'delete'
+                    await self.delete(op.docId)
+            except DatabaseAlreadyExistsError as e:
+                status, error = 409, e.message
+            except (DatabaseUpdateNotFoundError, DatabaseDeleteError) as e:
+                status, error = 404, e.message
+            except DatabaseError as e:
+                status, error = 500, e.message
+            except ValueError as e:
+                # not a valid Paragraph
+                status, error = 400, str(e)
+            results.append(WriteResult(op.operation, op.docId, status, error))
+        return results
+
+    async def create_many(
+            self,
+            paragraphs: Sequence[Paragraph]
+        ) -> IngestReport:
+        """Create paragraphs, skipping those that exist"""
+        operations = [WriteOperation('create', p.docId, p.text)
+                      for p in paragraphs]
+        report = IngestReport()
+        for result in await self.write_many(operations):
+            if result.ok:
+                report.created += 1
+            elif result.status == 409:
+                report.skipped.append(result.docId)
+            else:
+                report.failed[result.docId] = str(result.error)
+        return report
+
+    async def refresh(self) -> None:
+        """Make everything written so far searchable"""
         pass
 
-    # TODO: test, add to api
-    async def add_directory(self, directory_name):
+    async def read_files(
+            self,
+            paths: Sequence[Path],
+            report: IngestReport
+        ) -> List[Paragraph]:
+        """Read paths concurrently in the default executor"""
+        loop = asyncio.get_event_loop()
+        texts = await asyncio.gather(
+                    *[loop.run_in_executor(None, read_text, path)
+                      for path in paths],
+                    return_exceptions=True)
+        paragraphs = []
+        for path, text in zip(paths, texts):
+            if isinstance(text, BaseException):
+                log.error(f'failed to read {path}: {text}')
+                report.failed[path.name] = f'read error: {text}'
+                continue
+            try:
+                paragraphs.append(Paragraph(path.name, text))
+            except ValueError as e:
+                log.error(f'not adding {path}: {e}')
+                report.failed[path.name] = f'invalid docId: {e}'
+        return paragraphs
+
+    async def add_directory(
+            self,
+            directory_name: str,
+            chunk_size: int = 500
+        ) -> IngestReport:
+        """Create a paragraph for each *.txt file, chunk_size at a time.
+        The next chunk is read while the current one is being created."""
         directory_path = Path(directory_name)
         if not directory_path.exists():
             msg = f'{directory_name} does not exist'
             raise DatabaseCreateError(msg)
-        paths = directory_path.glob('*.txt')
-        for path in paths:
-            log.debug(f'adding path: {path}')
-            with open(path) as file:
-                text = file.read()
+        paths = sorted(directory_path.glob('*.txt'))
+        log.info(f'adding {len(paths)} files from {directory_name}')
+        report = IngestReport()
+        chunks = chunked(paths, chunk_size)
+        reading: Optional[asyncio.Future] = None
+        chunk = next(chunks, None)
+        if chunk is not None:
+            reading = asyncio.ensure_future(self.read_files(chunk, report))
+        while reading is not None:
+            paragraphs = await reading
+            chunk = next(chunks, None)
+            reading = None if chunk is None \
+                      else asyncio.ensure_future(self.read_files(chunk, report))
             try:
-                await self.create(Paragraph(path.name, text))
-            except DatabaseAlreadyExistsError as e:
-                msg = f'{path.name} alread exists'
-                log.info(msg)
+                report.extend(await self.create_many(paragraphs))
+            except BaseException:
+                if reading is not None:
+                    reading.cancel()
+                raise
+        await self.refresh()
+        log.info(f'added {directory_name}: {report}')
+        return report
 
-    # TODO: test, add to api
     async def dump_to_directory(self, directory_path: Path):
-        all_paragraphs = await self.get_all()
-        for paragraph in all_paragraphs:
-            with open(directory_path / paragraph.docId,'w') as file:
-                file.write(paragraph.text)
+        """Write a file per paragraph, streaming them from the database"""
+        loop = asyncio.get_event_loop()
+        n = 0
+        async for paragraph in self.iter_all():
+            await loop.run_in_executor(None, write_text,
+                                       directory_path / paragraph.docId,
+                                       paragraph.text)
+            n += 1
+        log.info(f'dumped {n} paragraphs to {directory_path}')
 
 class QueryDatabase(Database):
     @abstractmethod
@@ -90,3 +301,14 @@ class QueryDatabase(Database):
             qid: str = ''
         ) -> Iterable[Paragraph]:
         ...
+
+    async def query_many(
+            self,
+            query_strings: Sequence[str],
+            size: int,
+            qid: str = ''
+        ) -> List[List[Paragraph]]:
+        """Run several queries, databases may do this in one round trip"""
+        queries = [self.query(query_string, size, qid)
+                   for query_string in query_strings]
+        return [list(paragraphs) for paragraphs in await asyncio.gather(*queries)]
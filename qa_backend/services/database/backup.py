@@ -0,0 +1,335 @@
+# services/database/backup.py
+"""
+Incremental backups of a Database.
+
+Each backup is one tar.gz archive in the backup directory, holding the text of
+the documents added or changed since the previous backup (found by comparing
+content hashes) and a manifest.json.  The manifest maps every docId in the
+database at the time of the backup to the hash of its text and the archive
+holding that text, so the latest state is restored by reading the documents
+from the chain of archives it refers to.
+
+Every `full_every`th backup holds every document and starts a new chain.  Only
+the newest `keep_chains` chains are kept.
+"""
+
+from datetime import datetime
+from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+import asyncio
+import json
+import logging
+import os
+import tarfile
+import time
+
+import attr
+
+from .abstract_database import Database
+from .abstract_database import DocId
+from .abstract_database import IngestReport
+from qa_backend.util import Paragraph
+
+log = logging.getLogger('database')
+
+MANIFEST = 'manifest.json'
+DOCS = 'docs/'
+# holds the name of the newest archive
+LATEST = 'latest'
+
+def text_hash(text: str) -> str:
+    return sha256(text.encode()).hexdigest()
+
+@attr.s(slots=True, auto_attribs=True)
+class BackupManifest:
+    name: str
+    # the previous archive in the chain, None for a full backup
+    parent: Optional[str]
+    # backups since the last full backup
+    depth: int
+    created: float
+    # docId -> (hash of the text, archive holding the text)
+    documents: Dict[DocId,Tuple[str,str]]
+    # documents stored in this archive, and removed since the parent
+    changed: int = 0
+    deleted: int = 0
+
+    @classmethod
+    def from_json(cls, data: Dict[str,Any]) -> 'BackupManifest':
+        data['documents'] = {docId: tuple(location) for docId, location
+                             in data['documents'].items()}
+        return cls(**data)
+
+class ArchiveWriter:
+    """Writes an archive to a temporary file, renamed into place on close"""
+    path: Path
+    _tmp: Path
+    _tar: tarfile.TarFile
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._tmp = path.with_name(path.name + '.tmp')
+        self._tar = tarfile.open(self._tmp, 'w:gz')
+
+    def _add(self, name: str, data: bytes) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, BytesIO(data))
+
+    def add(self, paragraphs: Sequence[Paragraph]) -> None:
+        for paragraph in paragraphs:
+            self._add(DOCS + paragraph.docId, paragraph.text.encode())
+
+    def close(self, manifest: BackupManifest) -> None:
+        self._add(MANIFEST, json.dumps(attr.asdict(manifest)).encode())
+        self._tar.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        self._tar.close()
+        self._tmp.unlink()
+
+def read_manifest(path: Path) -> BackupManifest:
+    # the manifest is written last, after the documents
+    with tarfile.open(path, 'r|gz') as tar:
+        for member in tar:
+            if member.name == MANIFEST:
+                file = tar.extractfile(member)
+                assert file is not None
+                return BackupManifest.from_json(json.load(file))
+    raise ValueError(f'{path} has no {MANIFEST}')
+
+def read_documents(path: Path, docIds: Set[DocId]) -> Iterator[Paragraph]:
+    """The documents of the archive that are in docIds"""
+    with tarfile.open(path, 'r|gz') as tar:
+        for member in tar:
+            if not member.name.startswith(DOCS):
+                continue
+            docId = member.name[len(DOCS):]
+            if docId in docIds:
+                file = tar.extractfile(member)
+                assert file is not None
+                yield Paragraph(docId, file.read().decode())
+
+@attr.s(slots=True)
+class BackupStats:
+    backups: int = attr.ib(default=0)
+    # backups skipped as nothing had changed
+    unchanged: int = attr.ib(default=0)
+    errors: int = attr.ib(default=0)
+    last_backup: Optional[str] = attr.ib(default=None)
+    last_changed: int = attr.ib(default=0)
+    last_deleted: int = attr.ib(default=0)
+    last_seconds: float = attr.ib(default=0.)
+
+class BackupManager:
+    directory: Path
+    database: Database
+    interval: Optional[float]
+    full_every: int
+    keep_chains: int
+    page_size: int
+    latest: Optional[BackupManifest] = None
+    stats: BackupStats
+    _lock: Optional[asyncio.Lock] = None
+    _task: Optional['asyncio.Task[None]'] = None
+
+    def __init__(
+            self,
+            directory: str,
+            database: Database,
+            interval: Optional[float] = None,
+            full_every: int = 24,
+            keep_chains: int = 2,
+            page_size: int = 1000,
+        ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.database = database
+        self.interval = interval
+        self.full_every = full_every
+        self.keep_chains = keep_chains
+        self.page_size = page_size
+        self.stats = BackupStats()
+        latest = self.directory / LATEST
+        if latest.exists():
+            name = latest.read_text().strip()
+            self.latest = read_manifest(self.directory / name)
+            log.info(f'latest backup: {name}, '
+                     f'{len(self.latest.documents)} documents')
+
+    def new_name(self, full: bool) -> str:
+        """Names sort in the order the backups were made"""
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        kind = 'full' if full else 'delta'
+        return f'{stamp}.{kind}.tar.gz'
+
+    async def backup(self) -> Optional[BackupManifest]:
+        """Archive the documents changed since the last backup, None if
+        nothing changed"""
+        # created here, in the loop that uses it
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            start = time.monotonic()
+            manifest = await self._backup()
+            if manifest is None:
+                self.stats.unchanged += 1
+                return None
+            self.stats.backups += 1
+            self.stats.last_backup = manifest.name
+            self.stats.last_changed = manifest.changed
+            self.stats.last_deleted = manifest.deleted
+            self.stats.last_seconds = time.monotonic() - start
+            log.info(f'backed up {manifest.changed} changed and '
+                     f'{manifest.deleted} deleted documents to '
+                     f'{manifest.name}')
+            return manifest
+
+    async def _backup(self) -> Optional[BackupManifest]:
+        loop = asyncio.get_event_loop()
+        previous = self.latest
+        full = previous is None or previous.depth + 1 >= self.full_every
+        name = self.new_name(full)
+        old: Dict[DocId,Tuple[str,str]] = {} if previous is None \
+                                          else previous.documents
+        documents: Dict[DocId,Tuple[str,str]] = {}
+        writer: Optional[ArchiveWriter] = None
+        try:
+            page: List[Paragraph] = []
+            async for paragraph in self.database.iter_all(self.page_size):
+                digest = text_hash(paragraph.text)
+                location = old.get(paragraph.docId)
+                if not full and location is not None \
+                        and location[0] == digest:
+                    documents[paragraph.docId] = location
+                    continue
+                documents[paragraph.docId] = (digest, name)
+                page.append(paragraph)
+                if len(page) >= self.page_size:
+                    if writer is None:
+                        writer = await loop.run_in_executor(
+                                    None, ArchiveWriter, self.directory / name)
+                    await loop.run_in_executor(None, writer.add, page)
+                    page = []
+            changed = sum(1 for _, archive in documents.values()
+                          if archive == name)
+            deleted = len(set(old) - set(documents))
+            if not full and changed == 0 and deleted == 0:
+                return None
+            manifest = BackupManifest(
+                            name=name,
+                            parent=None if full else previous.name, # type: ignore
+                            depth=0 if full else previous.depth + 1, # type: ignore
+                            created=time.time(),
+                            documents=documents,
+                            changed=changed,
+                            deleted=deleted)
+            if writer is None:
+                writer = await loop.run_in_executor(
+                            None, ArchiveWriter, self.directory / name)
+            await loop.run_in_executor(None, writer.add, page)
+            await loop.run_in_executor(None, writer.close, manifest)
+            writer = None
+        finally:
+            if writer is not None:
+                writer.abort()
+        await loop.run_in_executor(None, self._set_latest, name)
+        self.latest = manifest
+        if full:
+            await loop.run_in_executor(None, self.prune)
+        return manifest
+
+    def _set_latest(self, name: str) -> None:
+        tmp = self.directory / (LATEST + '.tmp')
+        tmp.write_text(name + '\n')
+        os.replace(tmp, self.directory / LATEST)
+
+    def prune(self) -> None:
+        """Remove the archives of all but the newest keep_chains chains"""
+        archives = sorted(path.name for path in self.directory.iterdir()
+                          if path.name.endswith('.tar.gz'))
+        fulls = [i for i, name in enumerate(archives)
+                 if name.endswith('.full.tar.gz')]
+        if len(fulls) <= self.keep_chains:
+            return
+        for name in archives[:fulls[-self.keep_chains]]:
+            log.info(f'removing old backup: {name}')
+            (self.directory / name).unlink()
+
+    async def restore(self, chunk_size: int = 500) -> IngestReport:
+        """Create the documents of the latest backup in the database, which
+        should be empty"""
+        report = IngestReport()
+        if self.latest is None:
+            log.warning(f'no backups in {self.directory} to restore')
+            return report
+        loop = asyncio.get_event_loop()
+        by_archive: Dict[str,Set[DocId]] = {}
+        for docId, (_, archive) in self.latest.documents.items():
+            by_archive.setdefault(archive, set()).add(docId)
+        log.info(f'restoring {len(self.latest.documents)} documents from '
+                 f'{len(by_archive)} backups')
+        found: Set[DocId] = set()
+        for archive, docIds in sorted(by_archive.items()):
+            paragraphs = read_documents(self.directory / archive, docIds)
+            while True:
+                chunk = await loop.run_in_executor(None, next_chunk,
+                                                   paragraphs, chunk_size)
+                if len(chunk) == 0:
+                    break
+                found.update(paragraph.docId for paragraph in chunk)
+                report.extend(await self.database.create_many(chunk))
+        await self.database.refresh()
+        for docId in set(self.latest.documents) - found:
+            report.failed[docId] = 'missing from backup'
+        log.info(f'restored {self.latest.name}: {report}')
+        return report
+
+    async def run(self) -> None:
+        assert self.interval is not None
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.backup()
+            except Exception as e:
+                self.stats.errors += 1
+                log.exception(f'backup failed: {e}')
+
+    def start(self) -> None:
+        """Back up every interval seconds in the running loop"""
+        if self.interval is not None and self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats = attr.asdict(self.stats)
+        stats['documents'] = 0 if self.latest is None \
+                             else len(self.latest.documents)
+        return stats
+
+def next_chunk(paragraphs: Iterator[Paragraph], size: int) -> List[Paragraph]:
+    chunk: List[Paragraph] = []
+    for paragraph in paragraphs:
+        chunk.append(paragraph)
+        if len(chunk) >= size:
+            break
+    return chunk
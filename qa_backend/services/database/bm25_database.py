@@ -0,0 +1,390 @@
+# bm25_database.py
+"""
+In-process QueryDatabase ranking paragraphs with BM25
+"""
+
+from array import array
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import MutableMapping
+from typing import Optional
+from typing import Tuple
+import asyncio
+import logging
+import math
+import re
+
+import attr
+import numpy as np # type: ignore
+
+from .abstract_database import DocId
+from .abstract_database import Paragraph
+from .backup import BackupManager
+from .database_error import *
+from .segment import Segment
+from .segment import current_snapshot
+from .segment import write_snapshot
+from qa_backend.util import convert_bool
+from qa_backend.util.metrics import registry
+from qa_backend.util.metrics import timed
+
+log = logging.getLogger('database')
+
+from . import QueryDatabase
+
+BM25_SECONDS = registry.histogram('qa_bm25_duration_seconds',
+                                  'Time taken to score a query with BM25')
+
+TOKEN = re.compile(r'\w+')
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+@attr.s(slots=True, auto_attribs=True)
+class BM25DatabaseConfig:
+    # term frequency saturation and length normalization
+    k1: float = attr.ib(default=1.2, kw_only=True, converter=float)
+    b: float = attr.ib(default=.75, kw_only=True, converter=float)
+    # rebuild the postings once this fraction of them belong to deleted or
+    # updated paragraphs
+    compact_ratio: float = attr.ib(default=.5, kw_only=True, converter=float)
+    index_on_startup_dir: Optional[str] = attr.ib(default=None, kw_only=True)
+    backup_dir: Optional[str] = attr.ib(default=None, kw_only=True)
+    backup_interval: Optional[float] = attr.ib(
+                                default=None, kw_only=True,
+                                converter=attr.converters.optional(float)
+                            )
+    backup_full_every: int = attr.ib(default=24, kw_only=True, converter=int)
+    backup_keep_chains: int = attr.ib(default=2, kw_only=True, converter=int)
+    restore_on_startup: bool = attr.ib(default=False, kw_only=True,
+                                       converter=convert_bool)
+    # snapshots of the index, mapped on startup and written on shutdown
+    snapshot_dir: Optional[str] = attr.ib(default=None, kw_only=True)
+    snapshot_keep: int = attr.ib(default=2, kw_only=True, converter=int)
+
+class Postings:
+    """Slots of the paragraphs containing a term, and the term's frequency in
+    each, in arrays that grow in place"""
+    __slots__ = ['slots', 'tfs']
+    slots: array
+    tfs: array
+
+    def __init__(self):
+        self.slots = array('i')
+        self.tfs = array('f')
+
+class BM25Database(QueryDatabase):
+    """
+    Paragraphs are stored in slots.  The first slots belong to the base
+    Segment, read-only and usually mapped from a snapshot; paragraphs written
+    since are added after it, with Postings for each of their terms.  A query
+    is scored for every slot at once with numpy.
+
+    Deleting or updating a paragraph only frees its slot.  Compacting merges
+    the live paragraphs into a new base segment, which drops the postings
+    that point to freed slots.
+    """
+    config: BM25DatabaseConfig
+    backups: Optional[BackupManager] = None
+    base: Segment
+    slots: Dict[DocId,int]
+    # per slot: docId, None if freed
+    docIds: List[Optional[DocId]]
+    # per slot: text, None if freed or in the base segment
+    texts: List[Optional[str]]
+    lengths: np.ndarray
+    alive: np.ndarray
+    # postings of the paragraphs added after the base segment
+    postings: Dict[str,Postings]
+    # live paragraphs containing each term, less those counted by the base
+    df: Dict[str,int]
+    total_length: int = 0
+    dead_postings: int = 0
+    n_postings: int = 0
+    # changed since the snapshot was written
+    dirty: bool = False
+
+    def __init__(self, config: BM25DatabaseConfig):
+        log.info(f'creating BM25Database: {config}')
+        self.config = config
+        self.use(Segment.empty())
+        if isinstance(config.backup_dir, str):
+            self.backups = BackupManager(config.backup_dir, self,
+                                         config.backup_interval,
+                                         config.backup_full_every,
+                                         config.backup_keep_chains)
+        loop = asyncio.get_event_loop()
+        directory = config.index_on_startup_dir
+        snapshot = None if config.snapshot_dir is None \
+                   else current_snapshot(Path(config.snapshot_dir))
+        if snapshot is not None:
+            log.info(f'mapping snapshot {snapshot}')
+            self.use(Segment.load(snapshot))
+        elif config.restore_on_startup and self.backups is not None \
+                and self.backups.latest is not None:
+            loop.run_until_complete(self.backups.restore())
+        elif isinstance(directory, str):
+            loop.run_until_complete(self.add_directory(directory))
+        if self.dirty:
+            self.save()
+
+    @staticmethod
+    def from_config(config: MutableMapping[str,str]) -> 'BM25Database':
+        return BM25Database(BM25DatabaseConfig(**config))
+
+    def use(self, base: Segment) -> None:
+        """Start over from base"""
+        n = len(base)
+        self.base = base
+        self.docIds = list(base.docIds)
+        self.slots = {docId: slot for slot, docId in enumerate(base.docIds)}
+        self.texts = [None] * n
+        self.lengths = np.zeros(max(16, 2 * n), dtype=np.float32)
+        self.lengths[:n] = base.lengths
+        self.alive = np.zeros(len(self.lengths), dtype=bool)
+        self.alive[:n] = True
+        self.postings = {}
+        self.df = {}
+        self.total_length = int(self.lengths.sum())
+        self.dead_postings = 0
+        self.n_postings = len(base.slots)
+
+    async def start(self) -> None:
+        if self.backups is not None:
+            self.backups.start()
+
+    async def shutdown(self) -> None:
+        log.info('shutting down')
+        if self.backups is not None:
+            await self.backups.stop()
+            await self.backups.backup()
+        if self.dirty:
+            self.save()
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats: Dict[str,Any] = {'paragraphs': len(self.slots),
+                                'base_paragraphs': len(self.base),
+                                'base_terms': len(self.base.terms),
+                                'snapshot': None if self.base.path is None
+                                            else str(self.base.path),
+                                'postings': self.n_postings,
+                                'dead_postings': self.dead_postings}
+        if self.backups is not None:
+            stats['backups'] = self.backups.get_stats()
+        return stats
+
+    #
+    # index maintenance
+    #
+
+    def get_text(self, slot: int) -> str:
+        text = self.texts[slot]
+        if text is None:
+            return self.base.get_text(slot)
+        return text
+
+    def doc_freq(self, term: str) -> int:
+        return self.base.df(term) + self.df.get(term, 0)
+
+    def term_postings(self, term: str) -> List[Tuple[np.ndarray,np.ndarray]]:
+        """Slots and frequencies of term, in the base segment and after it"""
+        parts = []
+        base = self.base.postings(term)
+        if base is not None:
+            parts.append(base)
+        postings = self.postings.get(term)
+        if postings is not None:
+            parts.append((np.frombuffer(postings.slots, dtype=np.int32),
+                          np.frombuffer(postings.tfs, dtype=np.float32)))
+        return parts
+
+    def add(self, docId: DocId, text: str) -> None:
+        slot = len(self.docIds)
+        if slot == len(self.lengths):
+            self.lengths = np.resize(self.lengths, 2 * slot)
+            self.alive = np.resize(self.alive, 2 * slot)
+        counts: Dict[str,int] = {}
+        tokens = tokenize(text)
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, count in counts.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = Postings()
+            postings.slots.append(slot)
+            postings.tfs.append(count)
+            self.df[term] = self.df.get(term, 0) + 1
+        self.n_postings += len(counts)
+        self.docIds.append(docId)
+        self.texts.append(text)
+        self.lengths[slot] = len(tokens)
+        self.alive[slot] = True
+        self.slots[docId] = slot
+        self.total_length += len(tokens)
+        self.dirty = True
+
+    def remove(self, docId: DocId) -> None:
+        slot = self.slots.pop(docId)
+        terms = set(tokenize(self.get_text(slot)))
+        for term in terms:
+            self.df[term] = self.df.get(term, 0) - 1
+            if self.df[term] == 0:
+                del self.df[term]
+        self.dead_postings += len(terms)
+        self.total_length -= int(self.lengths[slot])
+        self.docIds[slot] = None
+        self.texts[slot] = None
+        self.alive[slot] = False
+        self.dirty = True
+        if self.dead_postings > self.config.compact_ratio * self.n_postings:
+            self.compact()
+
+    def merge(self) -> Segment:
+        """A segment of the live paragraphs"""
+        n_slots = len(self.docIds)
+        alive = self.alive[:n_slots]
+        # new number of each live slot
+        renumber = (np.cumsum(alive) - 1).astype(np.int32)
+        live = np.flatnonzero(alive).tolist()
+        texts = [self.get_text(slot).encode() for slot in live]
+        text_offsets = np.zeros(len(live) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+        terms: Dict[str,int] = {}
+        all_slots: List[np.ndarray] = []
+        all_tfs: List[np.ndarray] = []
+        for term in list(self.base.terms) + [term for term in self.postings
+                                             if term not in self.base.terms]:
+            parts = self.term_postings(term)
+            slots = np.concatenate([slots for slots, _ in parts])
+            tfs = np.concatenate([tfs for _, tfs in parts])
+            keep = alive[slots]
+            if not keep.any():
+                continue
+            terms[term] = len(terms)
+            all_slots.append(renumber[slots[keep]])
+            all_tfs.append(tfs[keep])
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(slots) for slots in all_slots], out=offsets[1:])
+        return Segment(
+            terms, offsets,
+            np.concatenate(all_slots) if all_slots
+                else np.zeros(0, dtype=np.int32),
+            np.concatenate(all_tfs) if all_tfs
+                else np.zeros(0, dtype=np.float32),
+            self.lengths[:n_slots][alive].copy(),
+            [self.docIds[slot] for slot in live], # type: ignore
+            text_offsets,
+            np.frombuffer(b''.join(texts), dtype=np.uint8))
+
+    def compact(self) -> None:
+        """Merge the live paragraphs into a new base segment"""
+        log.info(f'compacting: {self.dead_postings} of {self.n_postings} '
+                 f'postings are dead')
+        self.use(self.merge())
+
+    def save(self) -> None:
+        """Write the index as a snapshot and map it as the base segment"""
+        if self.config.snapshot_dir is None:
+            return
+        path = write_snapshot(Path(self.config.snapshot_dir), self.merge(),
+                              self.config.snapshot_keep)
+        log.info(f'wrote snapshot {path}')
+        self.use(Segment.load(path))
+        self.dirty = False
+
+    #
+    # CRUD
+    #
+
+    async def create(self, paragraph: Paragraph) -> None:
+        log.info(f'creating docId: {paragraph.docId}')
+        if paragraph.docId in self.slots:
+            msg = f'docId: {paragraph.docId} already exists'
+            raise DatabaseAlreadyExistsError(msg) # type: ignore
+        self.add(paragraph.docId, paragraph.text)
+
+    async def read(self, docId: DocId) -> List[Paragraph]:
+        log.info(f'read docId: {docId}')
+        if docId == '*':
+            return [paragraph async for paragraph in self.iter_all()]
+        slot = self.slots.get(docId)
+        if slot is None:
+            return []
+        return [Paragraph(docId, self.get_text(slot))]
+
+    async def read_page(
+            self,
+            after: Optional[DocId],
+            size: int
+        ) -> List[Paragraph]:
+        docIds = sorted(docId for docId in self.slots
+                        if after is None or docId > after)
+        return [Paragraph(docId, self.get_text(self.slots[docId]))
+                for docId in docIds[:size]]
+
+    async def update(self, paragraph: Paragraph) -> None:
+        log.info(f'updating {paragraph.docId}')
+        if paragraph.docId not in self.slots:
+            msg = f"docId: {paragraph.docId} doesn't exist"
+            raise DatabaseUpdateNotFoundError(msg) # type: ignore
+        self.remove(paragraph.docId)
+        self.add(paragraph.docId, paragraph.text)
+
+    async def delete(self, docId: DocId) -> None:
+        log.info(f'delete docId: {docId}')
+        if docId not in self.slots:
+            msg = f"docId: {docId} doesn't exist"
+            raise DatabaseDeleteError(msg) # type: ignore
+        self.remove(docId)
+
+    #
+    # query
+    #
+
+    def idf(self, term: str) -> float:
+        n = len(self.slots)
+        df = self.doc_freq(term)
+        return math.log(1 + (n - df + .5) / (df + .5))
+
+    def scores(self, query_string: str) -> np.ndarray:
+        """BM25 score of every slot"""
+        n_slots = len(self.docIds)
+        scores = np.zeros(n_slots, dtype=np.float32)
+        if len(self.slots) == 0:
+            return scores
+        k1, b = self.config.k1, self.config.b
+        avgdl = self.total_length / len(self.slots)
+        # length normalization, shared by every term
+        norm = k1 * (1 - b + b * self.lengths[:n_slots] / max(avgdl, 1e-9))
+        weights: Dict[str,int] = {}
+        for term in tokenize(query_string):
+            weights[term] = weights.get(term, 0) + 1
+        for term, weight in weights.items():
+            if self.doc_freq(term) <= 0:
+                continue
+            idf = self.idf(term)
+            for slots, tfs in self.term_postings(term):
+                # each slot occurs once in a term's postings
+                scores[slots] += weight * idf \
+                                 * tfs * (k1 + 1) / (tfs + norm[slots])
+        scores[~self.alive[:n_slots]] = 0
+        return scores
+
+    async def query(
+            self,
+            query_string: str,
+            size: int = 10,
+            qid: str = '',
+        ) -> List[Paragraph]:
+        log.info(f'query: {query_string}, size: {size}')
+        with timed(BM25_SECONDS, 'bm25'):
+            scores = self.scores(query_string)
+            if len(scores) > size:
+                top = np.argpartition(-scores, size)[:size]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind='stable')]
+        return [Paragraph(self.docIds[slot], self.get_text(slot)) # type: ignore
+                for slot in top.tolist() if scores[slot] > 0]
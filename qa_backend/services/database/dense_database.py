@@ -0,0 +1,396 @@
+# services/database/dense_database.py
+"""
+Dense retrieval: paragraphs are also found by the similarity of their
+embeddings to the question's, so paraphrased questions find them too.
+
+DenseDatabase wraps another QueryDatabase, which stores the paragraphs and
+does the lexical search.  Every paragraph written through it is encoded
+(in batches, in the default executor) and added to a VectorIndex.  In
+`hybrid` mode, the results of both searches are merged with reciprocal rank
+fusion; in `dense` mode, only the vector search is used.
+
+The vectors can be saved to `vectors_file` on shutdown.  On startup, only
+the paragraphs whose text changed since then are encoded again.
+"""
+
+from abc import ABC
+from abc import abstractmethod
+from hashlib import sha256
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import MutableMapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import asyncio
+import logging
+import os
+import re
+import zlib
+
+from attr.validators import in_
+import attr
+import numpy as np # type: ignore
+
+from .abstract_database import DocId
+from .abstract_database import QueryDatabase
+from .abstract_database import WriteOperation
+from .abstract_database import WriteResult
+from .vector_index import VectorIndex
+from qa_backend.util import ConfigurationError
+from qa_backend.util import Paragraph
+from qa_backend.util import convert_bool
+
+log = logging.getLogger('database')
+
+WORD = re.compile(r'\w+')
+
+class Encoder(ABC):
+    """Turns texts into unit vectors"""
+    # identifies the encoder's vectors in the vectors file
+    name: str
+    dim: int
+
+    @abstractmethod
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        ...
+
+class HashingEncoder(Encoder):
+    """
+    Words, word bigrams and the character trigrams of words, hashed into dim
+    buckets with a random sign.  Needs no model, and matches different forms
+    of a word through their shared trigrams.
+    """
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def features(self, text: str) -> List[str]:
+        words = WORD.findall(text.lower())
+        features = list(words)
+        features.extend(f'{a} {b}' for a, b in zip(words, words[1:]))
+        for word in words:
+            padded = f'<{word}>'
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            # crc32, unlike hash(), is the same in every process
+            hashes = np.array([zlib.crc32(feature.encode())
+                               for feature in self.features(text)],
+                              dtype=np.uint32)
+            signs = np.where(hashes & 0x80000000, -1., 1.)
+            np.add.at(vectors[row], hashes % self.dim, signs)
+        # dampen repeated features
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+class SentenceTransformerEncoder(Encoder):
+    def __init__(self, model_name: str, batch_size: int = 64):
+        try:
+            from sentence_transformers import SentenceTransformer # type: ignore
+        except ImportError:
+            msg = ('the sentence_transformers encoder needs the '
+                   'sentence-transformers package')
+            raise ConfigurationError(msg)
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        return self.model.encode(list(texts), batch_size=self.batch_size,
+                                 convert_to_numpy=True,
+                                 normalize_embeddings=True) \
+                         .astype(np.float32)
+
+def text_hash(text: str) -> str:
+    return sha256(text.encode()).hexdigest()
+
+@attr.s(slots=True, auto_attribs=True)
+class DenseConfig:
+    mode: str = attr.ib(default='hybrid', kw_only=True,
+                        validator=in_(['hybrid','dense']))
+    encoder: str = attr.ib(default='hashing', kw_only=True,
+                           validator=in_(['hashing',
+                                          'sentence_transformers']))
+    model_name: str = attr.ib(default='sentence-transformers/all-MiniLM-L6-v2',
+                              kw_only=True)
+    # dimension of the hashing encoder
+    dim: int = attr.ib(default=512, kw_only=True, converter=int)
+    # paragraphs encoded at once
+    batch_size: int = attr.ib(default=64, kw_only=True, converter=int)
+    # store vectors as int8
+    quantize: bool = attr.ib(default=False, kw_only=True,
+                             converter=convert_bool)
+    nlist: Optional[int] = attr.ib(default=None, kw_only=True,
+                                   converter=attr.converters.optional(int))
+    nprobe: int = attr.ib(default=8, kw_only=True, converter=int)
+    # results taken from each search before fusing them
+    fusion_depth: int = attr.ib(default=50, kw_only=True, converter=int)
+    rrf_k: float = attr.ib(default=60., kw_only=True, converter=float)
+    lexical_weight: float = attr.ib(default=1., kw_only=True, converter=float)
+    dense_weight: float = attr.ib(default=1., kw_only=True, converter=float)
+    vectors_file: Optional[str] = attr.ib(default=None, kw_only=True)
+
+class DenseDatabase(QueryDatabase):
+    database: QueryDatabase
+    config: DenseConfig
+    encoder: Encoder
+    index: VectorIndex
+    # hash of the text each vector was encoded from
+    hashes: Dict[DocId,str]
+    # the latest write of each docId being encoded, so an older write that
+    # finishes encoding later doesn't replace its vector
+    writes: Dict[DocId,int]
+    seq: int = 0
+
+    def __init__(
+            self,
+            database: QueryDatabase,
+            config: DenseConfig,
+            encoder: Optional[Encoder] = None,
+        ):
+        log.info(f'dense retrieval: {config}')
+        self.database = database
+        self.config = config
+        if encoder is not None:
+            self.encoder = encoder
+        elif config.encoder == 'hashing':
+            self.encoder = HashingEncoder(config.dim)
+        else:
+            self.encoder = SentenceTransformerEncoder(config.model_name,
+                                                      config.batch_size)
+        self.index = VectorIndex(self.encoder.dim, config.quantize,
+                                 config.nlist, config.nprobe)
+        self.hashes = {}
+        self.writes = {}
+
+    @staticmethod
+    def wrap_from_config(
+            database: QueryDatabase,
+            config: MutableMapping[str,str]
+        ) -> 'DenseDatabase':
+        return DenseDatabase(database, DenseConfig(**config))
+
+    #
+    # vectors
+    #
+
+    async def encode(self, texts: Sequence[str]) -> np.ndarray:
+        loop = asyncio.get_event_loop()
+        batches = []
+        for i in range(0, len(texts), self.config.batch_size):
+            batch = texts[i:i + self.config.batch_size]
+            batches.append(await loop.run_in_executor(
+                                None, self.encoder.encode, batch))
+        if len(batches) == 0:
+            return np.zeros((0, self.encoder.dim), dtype=np.float32)
+        return np.concatenate(batches)
+
+    async def embed(self, paragraphs: Sequence[Paragraph]) -> None:
+        """Add or replace the vectors of paragraphs"""
+        if len(paragraphs) == 0:
+            return
+        self.seq += 1
+        seq = self.seq
+        for paragraph in paragraphs:
+            self.writes[paragraph.docId] = seq
+        try:
+            vectors = await self.encode([p.text for p in paragraphs])
+        finally:
+            latest = [i for i, paragraph in enumerate(paragraphs)
+                      if self.writes.get(paragraph.docId) == seq]
+            for i in latest:
+                del self.writes[paragraphs[i].docId]
+        self.index.add([paragraphs[i].docId for i in latest], vectors[latest])
+        for i in latest:
+            self.hashes[paragraphs[i].docId] = text_hash(paragraphs[i].text)
+
+    def forget(self, docId: DocId) -> None:
+        self.writes.pop(docId, None)
+        if docId in self.index.slots:
+            self.index.remove(docId)
+        self.hashes.pop(docId, None)
+
+    def load_vectors(self) -> Dict[DocId,Tuple[str,np.ndarray]]:
+        """docId -> (text hash, vector) from the vectors file"""
+        path = self.config.vectors_file
+        if path is None or not os.path.exists(path):
+            return {}
+        with np.load(path) as data:
+            if str(data['encoder']) != self.encoder.name:
+                log.warning(f'{path} was encoded by {data["encoder"]}, '
+                            f'not {self.encoder.name}; encoding again')
+                return {}
+            return {docId: (hash_, vector) for docId, hash_, vector
+                    in zip(data['docIds'].tolist(), data['hashes'].tolist(),
+                           data['vectors'])}
+
+    def save_vectors(self) -> None:
+        path = self.config.vectors_file
+        if path is None:
+            return
+        docIds = list(self.index.slots)
+        slots = np.array([self.index.slots[docId] for docId in docIds],
+                         dtype=np.int64)
+        tmp = f'{path}.tmp.npz'
+        np.savez(tmp, encoder=np.array(self.encoder.name),
+                 docIds=np.array(docIds, dtype=str),
+                 hashes=np.array([self.hashes[docId] for docId in docIds],
+                                 dtype=str),
+                 vectors=self.index.rows(slots))
+        os.replace(tmp, path)
+        log.info(f'saved {len(docIds)} vectors to {path}')
+
+    async def load(self) -> None:
+        """Index the paragraphs of the wrapped database, reusing the saved
+        vectors of those that haven't changed"""
+        saved = self.load_vectors()
+        reused: List[Tuple[DocId,str,np.ndarray]] = []
+        changed: List[Paragraph] = []
+        async for paragraph in self.database.iter_all():
+            hash_ = text_hash(paragraph.text)
+            vector = saved.get(paragraph.docId)
+            if vector is not None and vector[0] == hash_:
+                reused.append((paragraph.docId, hash_, vector[1]))
+            else:
+                changed.append(paragraph)
+            if len(changed) >= self.config.batch_size * 16:
+                await self.embed(changed)
+                changed = []
+        await self.embed(changed)
+        if len(reused) > 0:
+            self.index.add([docId for docId, _, _ in reused],
+                           np.stack([vector for _, _, vector in reused]))
+            self.hashes.update((docId, hash_) for docId, hash_, _ in reused)
+        log.info(f'indexed {len(self.index)} vectors, '
+                 f'{len(reused)} of them saved')
+
+    async def start(self) -> None:
+        await self.database.start()
+        await self.load()
+
+    async def shutdown(self) -> None:
+        await self.database.shutdown()
+        self.save_vectors()
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats = self.database.get_stats()
+        stats['vectors'] = self.index.get_stats()
+        stats['vectors']['encoder'] = self.encoder.name
+        return stats
+
+    async def refresh(self) -> None:
+        await self.database.refresh()
+
+    #
+    # CRUD: the wrapped database, then the vectors
+    #
+
+    async def write_many(
+            self,
+            operations: Sequence[WriteOperation]
+        ) -> List[WriteResult]:
+        results = await self.database.write_many(operations)
+        written: Dict[DocId,Paragraph] = {}
+        for op, result in zip(operations, results):
+            if not result.ok:
+                continue
+            if op.operation == 'delete':
+                written.pop(op.docId, None)
+                self.forget(op.docId)
+            else:
+                written[op.docId] = Paragraph(op.docId, str(op.text))
+        await self.embed(list(written.values()))
+        return results
+
+    async def create(self, paragraph: Paragraph) -> None:
+        await self.database.create(paragraph)
+        await self.embed([paragraph])
+
+    async def read(self, docId: DocId) -> List[Paragraph]:
+        return await self.database.read(docId)
+
+    async def read_many(
+            self,
+            docIds: Sequence[DocId]
+        ) -> List[Paragraph]:
+        return await self.database.read_many(docIds)
+
+    async def read_page(
+            self,
+            after: Optional[DocId],
+            size: int
+        ) -> List[Paragraph]:
+        return await self.database.read_page(after, size)
+
+    async def update(self, paragraph: Paragraph) -> None:
+        await self.database.update(paragraph)
+        await self.embed([paragraph])
+
+    async def delete(self, docId: DocId) -> None:
+        await self.database.delete(docId)
+        self.forget(docId)
+
+    #
+    # queries
+    #
+
+    async def fuse(
+            self,
+            lexical: Sequence[Paragraph],
+            dense: Sequence[Tuple[DocId,float]],
+            size: int,
+        ) -> List[Paragraph]:
+        """Reciprocal rank fusion: each list adds weight / (rrf_k + rank)"""
+        config = self.config
+        scores: Dict[DocId,float] = {}
+        found: Dict[DocId,Paragraph] = {}
+        for rank, paragraph in enumerate(lexical, 1):
+            scores[paragraph.docId] = scores.get(paragraph.docId, 0.) \
+                                      + config.lexical_weight \
+                                      / (config.rrf_k + rank)
+            found.setdefault(paragraph.docId, paragraph)
+        for rank, (docId, _) in enumerate(dense, 1):
+            scores[docId] = scores.get(docId, 0.) \
+                            + config.dense_weight / (config.rrf_k + rank)
+        docIds = sorted(scores, key=lambda docId: -scores[docId])[:size]
+        missing = [docId for docId in docIds if docId not in found]
+        for paragraph in await self.database.read_many(missing):
+            found[paragraph.docId] = paragraph
+        return [found[docId] for docId in docIds if docId in found]
+
+    async def query(
+            self,
+            query_string: str,
+            size: int,
+            qid: str = ''
+        ) -> List[Paragraph]:
+        results, = await self.query_many([query_string], size, qid)
+        return results
+
+    async def query_many(
+            self,
+            query_strings: Sequence[str],
+            size: int,
+            qid: str = ''
+        ) -> List[List[Paragraph]]:
+        """The questions are encoded together"""
+        depth = max(size, self.config.fusion_depth)
+        if self.config.mode == 'hybrid':
+            lexical_results = asyncio.ensure_future(
+                self.database.query_many(query_strings, depth, qid))
+        vectors = await self.encode(query_strings)
+        dense = [self.index.search(vector, depth) for vector in vectors]
+        if self.config.mode == 'hybrid':
+            lexical = await lexical_results
+        else:
+            lexical = [[] for _ in query_strings]
+        return list(await asyncio.gather(*[self.fuse(l, d, size)
+                                           for l, d in zip(lexical, dense)]))
@@ -3,45 +3,67 @@
 CRUD frontend to git repository
 """
 
-from datetime import datetime
-from pathlib import Path
 from typing import Any
 from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import MutableMapping
 from typing import Optional
-from typing import TextIO
+from typing import Sequence
+from typing import Set
 from typing import Tuple
 from typing import Union
+from typing import cast
 import asyncio
 import json
 import logging
-import os
+import random
 import re
+import sys
+import time
 import yaml
 
-from elasticsearch import Elasticsearch # type: ignore
+from elasticsearch import AsyncElasticsearch # type: ignore
 from elasticsearch.exceptions import ConflictError # type: ignore
 from elasticsearch.exceptions import NotFoundError # type: ignore
-from elasticsearch.exceptions import ElasticsearchException
+from elasticsearch.exceptions import TransportError # type: ignore
+from attr.validators import in_
+from attr.validators import optional
 import attr
 
 from .abstract_database import Database
 from .abstract_database import DocId
+from .abstract_database import WriteOperation
+from .abstract_database import invalid_operation
+from .backup import BackupManager
+from .narrowing import HIGHLIGHT_END
+from .narrowing import HIGHLIGHT_START
+from .narrowing import highlight_spans
+from .narrowing import narrow
+from .narrowing import query_spans
+from .write_behind import WalEntry
+from .write_behind import WriteBehind
+from .abstract_database import WriteResult
 from .abstract_database import Paragraph
 from .database_error import *
 from qa_backend.util import ConfigurationError
 from qa_backend.util import JsonRepresentation
 from qa_backend.util import convert_bool
+from qa_backend.util.cache import LRUCache
+from qa_backend.util.log_writer import LogWriter
+from qa_backend.util.metrics import registry
+from qa_backend.util.metrics import timed
 
 log = logging.getLogger('database')
 
 from . import QueryDatabase
 
-es = Elasticsearch()
+ES_SECONDS = registry.histogram('qa_es_duration_seconds',
+                                'Time taken by Elasticsearch requests',
+                                ['operation'])
 
 class Explanation(JsonRepresentation):
+    """Scoring details of a hit from a search made with `explain: true`"""
     __slots__ = ['body','scores','docId','index','total_score','qid']
     query: Dict[str,Any]
     total_score: float
@@ -51,8 +73,15 @@ class Explanation(JsonRepresentation):
     qid: str
     text_re = re.compile(r'.*\(text:?(\w+|"[^"]*")? .*')
 
-    def __init__(self, body: Dict[str,Any], docId: str, index: str, qid: str):
-        log.info(f'getting explanation for: {body}')
+    def __init__(
+            self,
+            body: Dict[str,Any],
+            explanation: Dict[str,Any],
+            docId: str,
+            index: str,
+            qid: str,
+        ):
+        log.debug(f'getting explanation for: {body}')
         try:
             self.body = body['query']
         except KeyError as e:
@@ -65,17 +94,12 @@ class Explanation(JsonRepresentation):
         self.index = index
         self.qid = qid
         try:
-            explanation = es.explain(index, id=docId, body={'query':self.body})
-        except ElasticsearchException as e:
-            log.exception('ES Exception: {e}')
-            raise RuntimeError(str(e))
-        try:
-            self.total_score = float(explanation['explanation']['value'])
-            if explanation['explanation']['description'] == 'sum of:':
-                for detail in explanation['explanation']['details']:
+            self.total_score = float(explanation['value'])
+            if explanation['description'] == 'sum of:':
+                for detail in explanation['details']:
                     self.scores.append(self.get_score_tuple(detail))
             else:
-                self.scores = [self.get_score_tuple(explanation['explanation'])]
+                self.scores = [self.get_score_tuple(explanation)]
         # KeyError, something in re, etc
         except Exception as e:
             log.exception(e)
@@ -102,6 +126,12 @@ class Explanation(JsonRepresentation):
             freq = -1
         return (text,score,freq)
 
+ExplainEntry = Tuple[Dict[str,Any],Dict[str,Any],str,str,str]
+
+def serialize_explanation(entry: ExplainEntry) -> str:
+    """Parse a hit's explanation, on the explain log's writer thread"""
+    return repr(Explanation(*entry))
+
 class ElasticsearchDatabaseError(RuntimeError):
     message: str
 
@@ -115,50 +145,180 @@ class ElasticsearchDatabaseError(RuntimeError):
         msg = self.message
         return f'<{cls}:(message={msg})>'
 
+def to_hosts(hosts: Union[str,List[str]]) -> List[str]:
+    """Comma separated host[:port]s"""
+    if isinstance(hosts, str):
+        hosts = hosts.split(',')
+    return [host.strip() for host in hosts if host.strip() != '']
+
 @attr.s(slots=True, auto_attribs=True)
 class ElasticsearchDatabaseConfig:
     init_file: str
+    hosts: List[str] = attr.ib(factory=lambda: ['localhost:9200'],
+                               kw_only=True, converter=to_hosts)
+    # connections kept open to each host
+    pool_size: int = attr.ib(default=10, kw_only=True, converter=int)
+    # seconds before a request to elasticsearch is abandoned (and retried)
+    request_timeout: float = attr.ib(default=10., kw_only=True,
+                                     converter=float)
+    max_retries: int = attr.ib(default=3, kw_only=True, converter=int)
+    retry_on_timeout: bool = attr.ib(default=True, kw_only=True,
+                                     converter=convert_bool)
     erase_if_exists: Union[bool,str] = attr.ib(default=False, kw_only=True,
                                        converter=convert_bool)
     explain_filename: Optional[str] = attr.ib(default=None, kw_only=True)
+    # fraction of searches whose hits are explained in the explain log
+    explain_sample_rate: float = attr.ib(default=1., kw_only=True,
+                                         converter=float)
     backup_dir: Optional[str] = attr.ib(default=None, kw_only=True)
+    # seconds between background backups to backup_dir, None to only back up
+    # on shutdown
+    backup_interval: Optional[float] = attr.ib(
+                                default=None, kw_only=True,
+                                converter=attr.converters.optional(float)
+                            )
+    # every backup_full_every-th backup stores every document, the others
+    # only what changed.  The newest backup_keep_chains full backups, and the
+    # changes since them, are kept
+    backup_full_every: int = attr.ib(default=24, kw_only=True, converter=int)
+    backup_keep_chains: int = attr.ib(default=2, kw_only=True, converter=int)
+    # restore the latest backup in backup_dir when the server starts, falling
+    # back to index_on_startup_dir if there are no backups
+    restore_on_startup: bool = attr.ib(default=False, kw_only=True,
+                                       converter=convert_bool)
     index_on_startup_dir: Optional[str] = attr.ib(default=None, kw_only=True)
+    # documents per _bulk request when adding a directory
+    bulk_chunk_size: int = attr.ib(default=500, kw_only=True, converter=int)
+    # number of query/read results to cache, 0 disables the cache
+    query_cache_size: int = attr.ib(default=0, kw_only=True, converter=int)
+    # memory budget for the cached paragraphs
+    query_cache_bytes: int = attr.ib(default=64*2**20, kw_only=True,
+                                     converter=int)
+    # bounds staleness from writes to the index made by other clients
+    query_cache_ttl: Optional[float] = attr.ib(
+                                default=60., kw_only=True,
+                                converter=attr.converters.optional(float)
+                            )
+    # the index's refresh_interval: writes take this long to become searchable
+    refresh_interval: float = attr.ib(default=1., kw_only=True, converter=float)
+    # if set, writes are acknowledged once appended to this local log, and
+    # sent to elasticsearch in batches every write_behind_interval seconds
+    # (or once write_behind_batch_size are pending) with one refresh
+    write_ahead_log: Optional[str] = attr.ib(default=None, kw_only=True)
+    write_behind_interval: float = attr.ib(default=1., kw_only=True,
+                                           converter=float)
+    write_behind_batch_size: int = attr.ib(default=1000, kw_only=True,
+                                           converter=int)
+    # give the reader the sentences around the best match in each hit rather
+    # than the whole paragraph, finding the matches with elasticsearch's
+    # highlighter ('highlight') or the query's words ('local')
+    narrow_context: Optional[str] = attr.ib(
+                                default=None, kw_only=True,
+                                validator=optional(in_(['highlight','local']))
+                            )
+    # sentences kept on either side of the best matching one
+    narrow_window: int = attr.ib(default=1, kw_only=True, converter=int)
+
+CacheKey = Tuple[str,str,int,int]
+
+def paragraphs_sizeof(paragraphs: List[Paragraph]) -> int:
+    return sum(sys.getsizeof(p.docId) + sys.getsizeof(p.text)
+               for p in paragraphs)
 
 class ElasticsearchDatabase(QueryDatabase):
+    """
+    Query and read results are cached.  Every write through this instance
+    bumps `generation`, which is part of the cache key, so results computed
+    before a write are never served after it.  Searches only see writes after
+    the index refreshes, so query results are not cached within
+    `refresh_interval` of a write.
+
+    With write_ahead_log set, writes pending in the log are seen by read and
+    read_many, but not by query or iter_all until they are flushed.
+    """
     config: ElasticsearchDatabaseConfig
+    es: AsyncElasticsearch
     init_data: Dict[str,Any] = {}
-    explain_log: Optional[TextIO] = None
+    explain_log: Optional[LogWriter] = None
+    backups: Optional[BackupManager] = None
+    write_behind: Optional[WriteBehind] = None
+    query_cache: LRUCache[CacheKey,List[Paragraph]]
+    generation: int = 0
+    last_write: float = float('-inf')
 
     def __init__(self, config: ElasticsearchDatabaseConfig):
         log.info(f'creating ElasticsearchDatabase: {config}')
         self.config = config
-        self.initialize()
+        self.query_cache = LRUCache(config.query_cache_size,
+                                    ttl=config.query_cache_ttl,
+                                    max_bytes=config.query_cache_bytes,
+                                    sizeof=paragraphs_sizeof)
         if isinstance(config.explain_filename, str):
             log.debug(f'opening explain_log: {config.explain_filename}')
-            self.explain_log = open(config.explain_filename, 'a')
-        if isinstance(config.index_on_startup_dir, str):
-            log.debug(f'adding directory: {config.index_on_startup_dir}')
-            coro = self.add_directory(config.index_on_startup_dir)
-            asyncio.get_event_loop().run_until_complete(coro)
+            self.explain_log = LogWriter(config.explain_filename,
+                                         serialize=serialize_explanation)
+        if isinstance(config.write_ahead_log, str):
+            self.write_behind = WriteBehind(config.write_ahead_log,
+                                            self.apply_entries,
+                                            config.write_behind_interval,
+                                            config.write_behind_batch_size)
+        if isinstance(config.backup_dir, str):
+            self.backups = BackupManager(config.backup_dir, self,
+                                         config.backup_interval,
+                                         config.backup_full_every,
+                                         config.backup_keep_chains)
+        # a client's connections belong to the loop they were opened in, and
+        # the server may run in a different loop than the one used here
+        self.es = self.make_client()
+        asyncio.get_event_loop().run_until_complete(self.setup())
+        self.es = self.make_client()
+
+    def make_client(self) -> AsyncElasticsearch:
+        """Connections are opened on first use, up to pool_size per host"""
+        return AsyncElasticsearch(self.config.hosts,
+                                  maxsize=self.config.pool_size,
+                                  timeout=self.config.request_timeout,
+                                  max_retries=self.config.max_retries,
+                                  retry_on_timeout=self.config.retry_on_timeout)
+
+    async def setup(self) -> None:
+        """Create the index and fill it, run before the server starts"""
+        try:
+            await self.initialize()
+            directory = self.config.index_on_startup_dir
+            if self.config.restore_on_startup and self.backups is not None \
+                    and self.backups.latest is not None:
+                await self.backups.restore(self.config.bulk_chunk_size)
+            elif isinstance(directory, str):
+                log.debug(f'adding directory: {directory}')
+                await self.add_directory(directory,
+                                         self.config.bulk_chunk_size)
+            if self.write_behind is not None:
+                # writes acknowledged before a crash
+                await self.write_behind.replay()
+        finally:
+            await self.es.close()
+
+    async def start(self) -> None:
+        if self.write_behind is not None:
+            self.write_behind.start()
+        if self.backups is not None:
+            self.backups.start()
 
     async def shutdown(self) -> None:
         log.info('shutting down')
-        if isinstance(self.config.backup_dir, str):
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_dir = Path(self.config.backup_dir) / timestamp
-            backup_dir.mkdir(parents=True)
-            log.info(f'back up at: {str(backup_dir.resolve())}')
-            await self.dump_to_directory(backup_dir)
-            link = backup_dir / '../last_backup'
-            if link.is_symlink():
-                log.debug(f'unlinking existing symlink: {link}')
-                link.unlink()
-            elif link.exists():
-                log.error(f'tried to overwrite file with symlink to backup')
-                return
-            log.info(f'updating symlink: {backup_dir} <- {link}')
-            os.symlink(backup_dir.name, link)
-            log.info(f'back up complete')
+        if self.explain_log is not None:
+            self.explain_log.close()
+        try:
+            if self.write_behind is not None:
+                await self.write_behind.stop()
+                self.write_behind.close()
+            if self.backups is not None:
+                await self.backups.stop()
+                # only what changed since the last background backup
+                await self.backups.backup()
+        finally:
+            await self.es.close()
 
     @staticmethod
     def from_config(
@@ -167,17 +327,17 @@ class ElasticsearchDatabase(QueryDatabase):
         es_config = ElasticsearchDatabaseConfig(**config)
         return ElasticsearchDatabase(es_config)
 
-    def initialize(self, erase_if_exists: bool = False):
+    async def initialize(self, erase_if_exists: bool = False):
         with open(self.config.init_file) as file:
             self.init_data = yaml.full_load(file)
         self.check_init_data()
         log.info(f'init file: {self.config.init_file}, index: {self.index}')
-        if not es.indices.exists(self.index):
-            es.indices.create(self.index, self.creation)
+        if not await self.es.indices.exists(self.index):
+            await self.es.indices.create(self.index, self.creation)
         elif self.config.erase_if_exists:
             log.warn(f'erasing old index')
-            es.indices.delete(self.index)
-            es.indices.create(self.index, self.creation)
+            await self.es.indices.delete(self.index)
+            await self.es.indices.create(self.index, self.creation)
 
     def check_init_data(self):
         for k in ['index','creation']:
@@ -185,6 +345,45 @@ class ElasticsearchDatabase(QueryDatabase):
                 msg = f'{k} required to be in init_file: {self.init_file}'
                 raise ElasticsearchDatabaseError(msg)
 
+    def bump_generation(self) -> None:
+        """Called after every write, makes all cached results stale"""
+        self.generation += 1
+        self.last_write = time.monotonic()
+        self.query_cache.clear()
+
+    def cache_get(self, key: CacheKey) -> Optional[List[Paragraph]]:
+        paragraphs = self.query_cache.get(key)
+        if paragraphs is None:
+            return None
+        log.debug(f'cache hit: {key}')
+        # callers may modify the list
+        return list(paragraphs)
+
+    def cache_put(
+            self,
+            key: CacheKey,
+            paragraphs: List[Paragraph],
+            searched: bool = False
+        ) -> None:
+        _, _, _, generation = key
+        if generation != self.generation:
+            return
+        since_write = time.monotonic() - self.last_write
+        if searched and since_write < self.config.refresh_interval:
+            return
+        self.query_cache.put(key, list(paragraphs))
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats = {'query_cache': self.query_cache.get_stats(),
+                 'generation': self.generation}
+        if self.explain_log is not None:
+            stats['explain_log'] = self.explain_log.get_stats()
+        if self.backups is not None:
+            stats['backups'] = self.backups.get_stats()
+        if self.write_behind is not None:
+            stats['write_behind'] = self.write_behind.get_stats()
+        return stats
+
     @property
     def index(self) -> str:
         return self.init_data['index']
@@ -199,34 +398,227 @@ class ElasticsearchDatabase(QueryDatabase):
         ) -> None:
         body = {'text': paragraph.text}
         log.info(f'creating docId: {paragraph.docId}')
+        if self.write_behind is not None:
+            async with self.write_behind.locked([paragraph.docId]):
+                if paragraph.docId in await self.existing([paragraph.docId]):
+                    msg = f'docId: {paragraph.docId} already exists'
+                    raise DatabaseAlreadyExistsError(msg) # type: ignore
+                await self.write_behind.write(paragraph.docId, paragraph.text)
+            self.bump_generation()
+            return
         try:
-            es.create(self.index, paragraph.docId, body, refresh=True)
+            await self.es.create(self.index, paragraph.docId, body,
+                                 refresh=True)
         except ConflictError as e:
             msg = f'docId: {paragraph.docId} already exists'
             raise DatabaseAlreadyExistsError(msg) # type: ignore
+        self.bump_generation()
+
+    async def write_many(
+            self,
+            operations: Sequence[WriteOperation]
+        ) -> List[WriteResult]:
+        """One _bulk request, searchable after the next refresh"""
+        if len(operations) == 0:
+            return []
+        # elasticsearch takes any _id, so invalid docIds are failed here
+        checked = [invalid_operation(op) for op in operations]
+        if any(result is not None for result in checked):
+            valid = [op for op, result in zip(operations, checked)
+                     if result is None]
+            written = iter(await self.write_many(valid))
+            return [next(written) if result is None else result
+                    for result in checked]
+        if self.write_behind is not None:
+            return await self.write_many_behind(operations)
+        actions: List[Dict[str,Any]] = []
+        for op in operations:
+            actions.append({op.operation: {'_id': op.docId}})
+            if op.operation == 'create':
+                actions.append({'text': op.text})
+            elif op.operation == 'update':
+                actions.append({'doc': {'text': op.text}})
+        log.info(f'bulk writing {len(operations)} docIds')
+        try:
+            with timed(ES_SECONDS, 'es', operation='bulk'):
+                response = await self.es.bulk(body=actions, index=self.index)
+        except TransportError as e:
+            log.error(f'bulk write failed: {e}')
+            return [WriteResult(op.operation, op.docId, 500, str(e))
+                    for op in operations]
+        results = []
+        for op, item in zip(operations, response['items']):
+            status = item[op.operation]['status']
+            error = item[op.operation].get('error')
+            message: Optional[str] = None
+            if status == 404:
+                message = f"docId: {op.docId} doesn't exist"
+            elif status == 409:
+                message = f'docId: {op.docId} already exists'
+            elif error is not None:
+                message = error.get('reason', str(error))
+            results.append(WriteResult(op.operation, op.docId, status,
+                                       message))
+        if any(result.ok for result in results):
+            self.bump_generation()
+        return results
+
+    async def refresh(self) -> None:
+        await self.es.indices.refresh(index=self.index)
+        self.bump_generation()
+
+    async def existing(self, docIds: Sequence[DocId]) -> Set[DocId]:
+        """The docIds that exist, counting pending writes"""
+        existing: Set[DocId] = set()
+        missing: List[DocId] = []
+        for docId in docIds:
+            entry = None if self.write_behind is None \
+                    else self.write_behind.lookup(docId)
+            if entry is None:
+                missing.append(docId)
+            elif entry.text is not None:
+                existing.add(docId)
+        if len(missing) > 0:
+            with timed(ES_SECONDS, 'es', operation='mget'):
+                response = await self.es.mget(body={'ids': missing},
+                                              index=self.index,
+                                              _source=False)
+            existing.update(doc['_id'] for doc in response['docs']
+                            if doc.get('found', False))
+        return existing
+
+    async def write_many_behind(
+            self,
+            operations: Sequence[WriteOperation]
+        ) -> List[WriteResult]:
+        """Check operations against the current state, and log the valid
+        ones as one write, holding the docIds' locks in between"""
+        assert self.write_behind is not None
+        docIds = [op.docId for op in operations]
+        results = []
+        writes: List[Tuple[DocId,Optional[str]]] = []
+        async with self.write_behind.locked(docIds):
+            existing = await self.existing(docIds)
+            exists = {docId: True for docId in existing}
+            for op in operations:
+                if op.operation == 'create' and exists.get(op.docId, False):
+                    results.append(WriteResult(op.operation, op.docId, 409,
+                                   f'docId: {op.docId} already exists'))
+                    continue
+                if op.operation != 'create' \
+                        and not exists.get(op.docId, False):
+                    results.append(WriteResult(op.operation, op.docId, 404,
+                                   f"docId: {op.docId} doesn't exist"))
+                    continue
+                text = None if op.operation == 'delete' else op.text
+                exists[op.docId] = text is not None
+                writes.append((op.docId, text))
+                status = 201 if op.operation == 'create' else 200
+                results.append(WriteResult(op.operation, op.docId, status))
+            if len(writes) > 0:
+                await self.write_behind.write_many(writes)
+        if len(writes) > 0:
+            self.bump_generation()
+        return results
+
+    async def apply_entries(self, entries: List[WalEntry]) -> None:
+        """Write-behind flush: index or delete each document, then one
+        refresh.  Raises to have the whole batch retried."""
+        actions: List[Dict[str,Any]] = []
+        for entry in entries:
+            if entry.text is None:
+                actions.append({'delete': {'_id': entry.docId}})
+            else:
+                actions.append({'index': {'_id': entry.docId}})
+                actions.append({'text': entry.text})
+        log.info(f'flushing {len(entries)} writes')
+        with timed(ES_SECONDS, 'es', operation='bulk'):
+            response = await self.es.bulk(body=actions, index=self.index)
+        for item in response['items']:
+            (operation, result), = item.items()
+            # deleting a document that's already gone is fine
+            if result['status'] >= 300 and result['status'] != 404:
+                # retrying won't help, so the write is dropped
+                log.error(f'failed to {operation} {result["_id"]}: '
+                          f'{result.get("error")}')
+        await self.refresh()
 
-    async def get_all(
-            self
+    async def read_page(
+            self,
+            after: Optional[DocId],
+            size: int
         ) -> List[Paragraph]:
-        return await self.read('*')
+        """search_after pagination on _id, so pages aren't capped by
+        max_result_window and need no scroll context kept open"""
+        body: Dict[str,Any] = {'query': {'match_all': {}},
+                               'size': size,
+                               'sort': [{'_id': 'asc'}]}
+        if after is not None:
+            body['search_after'] = [after]
+        with timed(ES_SECONDS, 'es', operation='search'):
+            response = await self.es.search(index=self.index, body=body)
+        return [Paragraph(hit['_id'], hit['_source']['text'])
+                for hit in response['hits']['hits']]
 
     async def read(
             self,
             docId: DocId
         ) -> List[Paragraph]:
         log.info(f'read docId: {docId}')
+        if docId == '*':
+            # the whole index is too big to be worth caching
+            return [paragraph async for paragraph in self.iter_all()]
+        entry = None if self.write_behind is None \
+                else self.write_behind.lookup(docId)
+        if entry is not None:
+            return [] if entry.text is None else [Paragraph(docId, entry.text)]
+        key = ('read', docId, 0, self.generation)
+        cached = self.cache_get(key)
+        if cached is not None:
+            return cached
         try:
-            if docId == '*':
-                body: Dict[str,Any] = {'query':{'match_all':{}},'size':10000}
-                response = es.search(index=self.index, body=body)
-                paragraphs = [Paragraph(hit['_id'], hit['_source']['text'])
-                              for hit in response['hits']['hits']]
-                return paragraphs
-            else:
-                response = es.get(index=self.index, id=docId)
-                return [Paragraph(docId, response['_source']['text'])]
+            with timed(ES_SECONDS, 'es', operation='get'):
+                response = await self.es.get(index=self.index, id=docId)
+            paragraphs = [Paragraph(docId, response['_source']['text'])]
         except NotFoundError as e:
             return []
+        self.cache_put(key, paragraphs)
+        return paragraphs
+
+    async def read_many(
+            self,
+            docIds: Sequence[DocId]
+        ) -> List[Paragraph]:
+        """One _mget for the docIds that aren't cached"""
+        log.info(f'read {len(docIds)} docIds')
+        found: Dict[DocId,Paragraph] = {}
+        missing: List[DocId] = []
+        for docId in dict.fromkeys(docIds):
+            entry = None if self.write_behind is None \
+                    else self.write_behind.lookup(docId)
+            if entry is not None:
+                if entry.text is not None:
+                    found[docId] = Paragraph(docId, entry.text)
+                continue
+            cached = self.cache_get(('read', docId, 0, self.generation))
+            if cached is None:
+                missing.append(docId)
+            elif len(cached) > 0:
+                found[docId] = cached[0]
+        if len(missing) > 0:
+            generation = self.generation
+            with timed(ES_SECONDS, 'es', operation='mget'):
+                response = await self.es.mget(body={'ids': missing},
+                                              index=self.index)
+            for doc in response['docs']:
+                if not doc.get('found', False):
+                    continue
+                paragraph = Paragraph(doc['_id'], doc['_source']['text'])
+                found[paragraph.docId] = paragraph
+                self.cache_put(('read', paragraph.docId, 0, generation),
+                               [paragraph])
+        return [found[docId] for docId in dict.fromkeys(docIds)
+                if docId in found]
 
     async def update(
             self,
@@ -234,25 +626,44 @@ class ElasticsearchDatabase(QueryDatabase):
         ) -> None:
         log.info(f'updating {paragraph.docId}')
         log.debug(f'text: {paragraph.text}')
+        if self.write_behind is not None:
+            async with self.write_behind.locked([paragraph.docId]):
+                if paragraph.docId not in \
+                        await self.existing([paragraph.docId]):
+                    msg = f"docId: {paragraph.docId} doesn't exist"
+                    raise DatabaseUpdateNotFoundError(msg) # type: ignore
+                await self.write_behind.write(paragraph.docId, paragraph.text)
+            self.bump_generation()
+            return
         try:
             body = {'doc': {'text': paragraph.text}}
-            es.update(self.index, paragraph.docId, body)
+            await self.es.update(self.index, paragraph.docId, body)
             log.info('update complete')
         except NotFoundError as e:
             msg = f"docId: {paragraph.docId} doesn't exist"
             log.info(msg)
             raise DatabaseUpdateNotFoundError(msg) # type: ignore
+        self.bump_generation()
 
     async def delete(
             self,
             docId: DocId
         ) -> None:
         log.info(f'delete docId: {docId}')
+        if self.write_behind is not None:
+            async with self.write_behind.locked([docId]):
+                if docId not in await self.existing([docId]):
+                    msg = f"docId: {docId} doesn't exist"
+                    raise DatabaseDeleteError(msg) # type: ignore
+                await self.write_behind.write(docId, None)
+            self.bump_generation()
+            return
         try:
-            es.delete(self.index, docId)
+            await self.es.delete(self.index, docId)
         except NotFoundError as e:
             msg = f"docId: {docId} doesn't exist"
             raise DatabaseDeleteError(msg) # type: ignore
+        self.bump_generation()
 
     async def query(
             self,
@@ -261,22 +672,102 @@ class ElasticsearchDatabase(QueryDatabase):
             qid: str = '',
         ) -> Iterable[Paragraph]:
         log.info(f'query[:{size}] {query_string}')
-        body = {'query': {'match': {'text': query_string}}, 'size':size}
-        response = es.search(index=self.index, body=body)
+        key = ('query', query_string, size, self.generation)
+        cached = self.cache_get(key)
+        if cached is not None:
+            return cached
+        body = self.query_body(query_string, size)
+        with timed(ES_SECONDS, 'es', operation='search'):
+            response = await self.es.search(index=self.index, body=body)
+        paragraphs = self.paragraphs_from_hits(body, response, qid,
+                                               query_string)
+        if paragraphs is not None:
+            self.cache_put(key, paragraphs, searched=True)
+        return paragraphs or []
+
+    async def query_many(
+            self,
+            query_strings: Sequence[str],
+            size: int = 10,
+            qid: str = '',
+        ) -> List[List[Paragraph]]:
+        """Run all uncached queries with a single multi-search"""
+        log.info(f'query_many[:{size}] {len(query_strings)} queries')
+        keys = [('query', query_string, size, self.generation)
+                for query_string in query_strings]
+        results = [self.cache_get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) == 0:
+            return cast(List[List[Paragraph]], results)
+        bodies = [self.query_body(query_strings[i], size) for i in missing]
+        searches: List[Dict[str,Any]] = []
+        for body in bodies:
+            searches.extend([{}, body])
+        with timed(ES_SECONDS, 'es', operation='msearch'):
+            response = await self.es.msearch(body=searches, index=self.index)
+        for i, body, response_ in zip(missing, bodies, response['responses']):
+            if 'error' in response_:
+                log.error(f'query failed: {response_["error"]}')
+                results[i] = []
+                continue
+            paragraphs = self.paragraphs_from_hits(body, response_, qid,
+                                                   query_strings[i])
+            if paragraphs is not None:
+                self.cache_put(keys[i], paragraphs, searched=True)
+            results[i] = paragraphs or []
+        return cast(List[List[Paragraph]], results)
+
+    def query_body(self, query_string: str, size: int) -> Dict[str,Any]:
+        body: Dict[str,Any] = {'query': {'match': {'text': query_string}},
+                               'size': size}
+        # explanations come back with the hits, see paragraphs_from_hits
+        if self.explain_log is not None \
+                and random.random() < self.config.explain_sample_rate:
+            body['explain'] = True
+        if self.config.narrow_context == 'highlight':
+            # the whole text, with the matched terms marked
+            body['highlight'] = {'fields': {'text': {
+                                    'number_of_fragments': 0,
+                                    'pre_tags': [HIGHLIGHT_START],
+                                    'post_tags': [HIGHLIGHT_END]}}}
+        return body
+
+    def narrow(
+            self,
+            paragraph: Paragraph,
+            hit: Dict[str,Any],
+            query_string: str,
+        ) -> Paragraph:
+        matches = None
+        highlighted = hit.get('highlight', {}).get('text')
+        if highlighted:
+            matches = highlight_spans(highlighted[0], paragraph.text)
+        if matches is None:
+            matches = query_spans(query_string, paragraph.text)
+        return narrow(paragraph, matches, self.config.narrow_window)
+
+    def paragraphs_from_hits(
+            self,
+            body: Dict[str,Any],
+            response: Dict[str,Any],
+            qid: str,
+            query_string: str = '',
+        ) -> Optional[List[Paragraph]]:
+        """Paragraphs from a search response, None if it was malformed"""
         paragraphs = []
         for hit in response['hits']['hits']:
             try:
                 _id = hit['_id']
                 hit_text = hit['_source']['text']
             except KeyError as e:
-                log.exception(f'explain failed: {str(e)}')
-                return []
-            paragraphs.append(Paragraph(_id, hit_text))
-            try:
-                if self.explain_log is not None:
-                        print(Explanation(body,_id,self.index,qid),
-                              file=self.explain_log,
-                              flush=True)
-            except RuntimeError as e:
-                log.error(f'explain failed: {e}')
+                log.exception(f'malformed hit: {str(e)}')
+                return None
+            paragraph = Paragraph(_id, hit_text)
+            if self.config.narrow_context is not None:
+                paragraph = self.narrow(paragraph, hit, query_string)
+            paragraphs.append(paragraph)
+            explanation = hit.get('_explanation')
+            if self.explain_log is not None and explanation is not None:
+                self.explain_log.write((body, explanation, _id,
+                                        self.index, qid))
         return paragraphs
@@ -0,0 +1,110 @@
+# services/database/narrowing.py
+"""
+Narrow a retrieved paragraph to the sentences around its best match, so the
+reader runs on a short context.
+
+The matches are spans of the paragraph: the terms highlighted by
+elasticsearch, or the query's words found locally.  Each sentence scores the
+distinct terms it matches, weighted by how few of the paragraph's sentences
+match them, and the context is the best sentence with `window` sentences on
+either side.  It is returned as a Passage, with its offsets in the
+paragraph, so answers are still attributed to the paragraph's docId and
+`complete_sentence` still finds whole sentences in it.
+"""
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+import math
+import re
+
+from .passages import Span
+from .passages import sentence_spans
+from qa_backend.util import Paragraph
+from qa_backend.util import Passage
+
+WORD = re.compile(r'\w+')
+# not worth matching locally
+STOPWORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do',
+             'does', 'for', 'from', 'how', 'i', 'in', 'is', 'it', 'of', 'on',
+             'or', 'that', 'the', 'to', 'was', 'what', 'when', 'where',
+             'which', 'who', 'why', 'with', 'you'}
+SUFFIXES = ['ing', 'ed', 'es', 's']
+
+def stem(word: str) -> str:
+    """Enough to match the plural and tenses of most words"""
+    word = word.lower()
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+# private use characters, unlikely to be in any paragraph
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_END = '\ue001'
+
+def highlight_spans(highlighted: str, text: str) -> Optional[List[Span]]:
+    """Spans of text highlighted with HIGHLIGHT_START/END, None if the
+    highlighted text isn't text"""
+    spans = []
+    pieces = []
+    offset = 0
+    start = 0
+    for piece in re.split(f'([{HIGHLIGHT_START}{HIGHLIGHT_END}])',
+                          highlighted):
+        if piece == HIGHLIGHT_START:
+            start = offset
+        elif piece == HIGHLIGHT_END:
+            spans.append((start, offset))
+        else:
+            pieces.append(piece)
+            offset += len(piece)
+    if ''.join(pieces) != text:
+        return None
+    return spans
+
+def query_spans(query_string: str, text: str) -> List[Span]:
+    """Spans of the words of text that are in query_string, but for their
+    endings"""
+    stems = {stem(word) for word in WORD.findall(query_string)
+             if word.lower() not in STOPWORDS}
+    return [match.span() for match in WORD.finditer(text)
+            if stem(match.group()) in stems]
+
+def narrow(
+        paragraph: Paragraph,
+        matches: Sequence[Span],
+        window: int = 1,
+    ) -> Paragraph:
+    """The sentences around the best match, the paragraph itself if nothing
+    matched"""
+    text = paragraph.text
+    if len(matches) == 0:
+        return paragraph
+    sentences = sentence_spans(text)
+    if len(sentences) <= 2 * window + 1:
+        return paragraph
+    terms: List[Set[str]] = [set() for _ in sentences]
+    i = 0
+    for start, end in sorted(matches):
+        while i + 1 < len(sentences) and sentences[i][1] <= start:
+            i += 1
+        terms[i].add(stem(text[start:end]))
+    matching: Dict[str,int] = {}
+    for sentence_terms in terms:
+        for term in sentence_terms:
+            matching[term] = matching.get(term, 0) + 1
+    weights = {term: math.log(1 + len(sentences) / count)
+               for term, count in matching.items()}
+    scores = [sum(weights[term] for term in sentence_terms)
+              for sentence_terms in terms]
+    best = max(range(len(sentences)), key=lambda i: scores[i])
+    first = max(0, best - window)
+    last = min(len(sentences) - 1, best + window)
+    start, end = sentences[first][0], sentences[last][1]
+    # offsets in the document the paragraph is part of
+    offset = paragraph.start if isinstance(paragraph, Passage) else 0
+    return Passage(paragraph.docId, text[start:end],
+                   offset + start, offset + end)
@@ -0,0 +1,429 @@
+# services/database/passages.py
+"""
+Store documents as passages, so questions are answered against short contexts.
+
+PassageDatabase wraps another QueryDatabase.  Each document written through
+it is split at sentence boundaries into passages of at most `max_tokens`
+tokens (and `max_sentences` sentences), stored in the wrapped database as
+`<name>--p0000.txt`, `<name>--p0001.txt`, ...  The passages partition the
+document, so it is read back by concatenating them, and a passage's offsets
+in its document are the lengths of the passages before it.
+
+Reads and writes use the documents' docIds.  Writing a document replaces all
+of its passages in one `write_many` of the wrapped database, holding the
+document's lock.  If some of them fail, the passages a create wrote are
+deleted, and the passages actually stored become the document's, so writing
+it again converges.  Queries return a Passage per passage found, with its
+document's docId and offsets.
+"""
+
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import MutableMapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import logging
+import re
+
+import attr
+
+from .abstract_database import DocId
+from .abstract_database import QueryDatabase
+from .abstract_database import WriteOperation
+from .abstract_database import WriteResult
+from .database_error import *
+from .write_behind import DocIdLocks
+from qa_backend.util import Paragraph
+from qa_backend.util import Passage
+
+log = logging.getLogger('database')
+
+# a sentence ends with punctuation (and maybe closing quotes or brackets)
+# followed by whitespace, or with a line, so list items are sentences
+SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+|\n\s*')
+# words and punctuation marks, close to what a wordpiece tokenizer splits on
+TOKEN = re.compile(r'\w+|[^\w\s]')
+PASSAGE_ID = re.compile(r'(.+)--p(\d+)(.{4})')
+
+Span = Tuple[int,int]
+
+def sentence_spans(text: str) -> List[Span]:
+    """(start, end) of consecutive sentences covering text"""
+    boundaries = [0] + [match.end() for match in SENTENCE_END.finditer(text)]
+    if boundaries[-1] != len(text):
+        boundaries.append(len(text))
+    return list(zip(boundaries, boundaries[1:]))
+
+def split_passages(
+        text: str,
+        max_tokens: int,
+        max_sentences: Optional[int] = None,
+    ) -> List[Span]:
+    """(start, end) of consecutive passages covering text.  Sentences longer
+    than max_tokens are split between tokens."""
+    # sentences, and pieces of long sentences, with their number of tokens
+    pieces: List[Tuple[int,int,int]] = []
+    for start, end in sentence_spans(text):
+        tokens = [match.start()
+                  for match in TOKEN.finditer(text, start, end)]
+        cuts = [start] + tokens[max_tokens::max_tokens] + [end]
+        for i, (cut, next_cut) in enumerate(zip(cuts, cuts[1:])):
+            n = min(max_tokens, len(tokens) - i * max_tokens)
+            pieces.append((cut, next_cut, n))
+    passages: List[Span] = []
+    start, total, count = 0, 0, 0
+    for piece_start, _, n in pieces:
+        full = total + n > max_tokens or (max_sentences is not None
+                                          and count >= max_sentences)
+        if count > 0 and full:
+            passages.append((start, piece_start))
+            start, total, count = piece_start, 0, 0
+        total += n
+        count += 1
+    passages.append((start, len(text)))
+    return passages
+
+def passage_id(docId: DocId, i: int) -> DocId:
+    # keeps the extension, so the passage is a valid Paragraph docId
+    return f'{docId[:-4]}--p{i:04d}{docId[-4:]}'
+
+def parse_passage_id(passageId: DocId) -> Optional[Tuple[DocId,int]]:
+    match = PASSAGE_ID.fullmatch(passageId)
+    if match is None:
+        return None
+    return match.group(1) + match.group(3), int(match.group(2))
+
+# passage docId, and its offsets in the document
+PassageSpan = Tuple[DocId,int,int]
+
+def stored_spans(
+        paragraphs: Iterable[Paragraph]
+    ) -> Dict[DocId,List[PassageSpan]]:
+    """The passages of each document among paragraphs, which aren't
+    passages are left out"""
+    found: Dict[DocId,List[Tuple[int,DocId,int]]] = {}
+    for paragraph in paragraphs:
+        parsed = parse_passage_id(paragraph.docId)
+        if parsed is not None:
+            docId, i = parsed
+            found.setdefault(docId, []).append(
+                (i, paragraph.docId, len(paragraph.text)))
+    documents = {}
+    for docId, passages in found.items():
+        spans: List[PassageSpan] = []
+        start = 0
+        for _, passageId, length in sorted(passages):
+            spans.append((passageId, start, start + length))
+            start += length
+        documents[docId] = spans
+    return documents
+
+def rounds(operations: Sequence[WriteOperation]) -> Iterator[
+                                                    List[WriteOperation]]:
+    """Consecutive runs of operations with at most one per docId"""
+    round_: List[WriteOperation] = []
+    docIds = set()
+    for op in operations:
+        if op.docId in docIds:
+            yield round_
+            round_, docIds = [], set()
+        round_.append(op)
+        docIds.add(op.docId)
+    if len(round_) > 0:
+        yield round_
+
+@attr.s(slots=True, auto_attribs=True)
+class PassageConfig:
+    max_tokens: int = attr.ib(default=200, kw_only=True, converter=int)
+    max_sentences: Optional[int] = attr.ib(
+                                default=None, kw_only=True,
+                                converter=attr.converters.optional(int)
+                            )
+
+class PassageDatabase(QueryDatabase):
+    database: QueryDatabase
+    config: PassageConfig
+    # the passages of each document, in order
+    passages: Dict[DocId,List[PassageSpan]]
+    # passage docId -> document docId, start, end
+    spans: Dict[DocId,PassageSpan]
+    # held by writes from planning through set_passages
+    docId_locks: DocIdLocks
+
+    def __init__(self, database: QueryDatabase, config: PassageConfig):
+        log.info(f'storing passages: {config}')
+        self.database = database
+        self.config = config
+        self.passages = {}
+        self.spans = {}
+        self.docId_locks = DocIdLocks()
+
+    @staticmethod
+    def wrap_from_config(
+            database: QueryDatabase,
+            config: MutableMapping[str,str]
+        ) -> 'PassageDatabase':
+        return PassageDatabase(database, PassageConfig(**config))
+
+    def split(self, docId: DocId, text: str) -> List[PassageSpan]:
+        spans = split_passages(text, self.config.max_tokens,
+                               self.config.max_sentences)
+        return [(passage_id(docId, i), start, end)
+                for i, (start, end) in enumerate(spans)]
+
+    def set_passages(
+            self,
+            docId: DocId,
+            passages: Optional[List[PassageSpan]]
+        ) -> None:
+        for passageId, _, _ in self.passages.pop(docId, []):
+            del self.spans[passageId]
+        if passages is not None:
+            self.passages[docId] = passages
+            for passageId, start, end in passages:
+                self.spans[passageId] = (docId, start, end)
+
+    async def load(self) -> None:
+        """Find the passages of each document in the wrapped database, and
+        split documents stored whole.  A document stored whole next to its
+        passages (indexed again on startup) replaces them."""
+        passages: List[Paragraph] = []
+        whole: List[Paragraph] = []
+        async for paragraph in self.database.iter_all():
+            if parse_passage_id(paragraph.docId) is None:
+                whole.append(paragraph)
+            else:
+                passages.append(paragraph)
+        for docId, spans in stored_spans(passages).items():
+            self.set_passages(docId, spans)
+        log.info(f'found {len(self.spans)} passages of '
+                 f'{len(self.passages)} documents')
+        if len(whole) == 0:
+            return
+        log.info(f'splitting {len(whole)} documents stored whole')
+        operations = []
+        for paragraph in whole:
+            # the update deletes the whole document and any passages it
+            # doesn't reuse
+            old = self.passages.get(paragraph.docId, [])
+            self.set_passages(paragraph.docId, old + [(paragraph.docId, 0,
+                                                       len(paragraph.text))])
+            operations.append(WriteOperation('update', paragraph.docId,
+                                             paragraph.text))
+        for result in await self.write_many(operations):
+            if not result.ok:
+                log.error(f'failed to split {result.docId}: {result.error}')
+        await self.database.refresh()
+
+    async def start(self) -> None:
+        await self.database.start()
+        await self.load()
+
+    async def shutdown(self) -> None:
+        await self.database.shutdown()
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats = self.database.get_stats()
+        stats['passages'] = {'documents': len(self.passages),
+                             'passages': len(self.spans)}
+        return stats
+
+    async def refresh(self) -> None:
+        await self.database.refresh()
+
+    #
+    # writes
+    #
+
+    async def write_many(
+            self,
+            operations: Sequence[WriteOperation]
+        ) -> List[WriteResult]:
+        """The passages of the operations are written with one write_many
+        of the wrapped database per round of operations on distinct
+        documents, so each operation is planned against the outcome of the
+        ones before it"""
+        results: List[WriteResult] = []
+        async with self.docId_locks.locked(op.docId for op in operations):
+            for round_ in rounds(operations):
+                results.extend(await self.write_round(round_))
+        return results
+
+    async def write_round(
+            self,
+            operations: List[WriteOperation]
+        ) -> List[WriteResult]:
+        """Write operations on distinct documents, holding their locks"""
+        passage_ops: List[WriteOperation] = []
+        # for each operation: its result if it failed here, otherwise the
+        # range of its passage operations and the document's new passages
+        planned: List[Tuple[WriteOperation,Optional[WriteResult],
+                            int,int,Optional[List[PassageSpan]]]] = []
+        for op in operations:
+            old = self.passages.get(op.docId)
+            first = len(passage_ops)
+            new: Optional[List[PassageSpan]] = None
+            failed: Optional[WriteResult] = None
+            if op.operation == 'create' and old is not None:
+                failed = WriteResult(op.operation, op.docId, 409,
+                                     f'docId: {op.docId} already exists')
+            elif op.operation != 'create' and old is None:
+                failed = WriteResult(op.operation, op.docId, 404,
+                                     f"docId: {op.docId} doesn't exist")
+            else:
+                old_ids = set() if old is None else {p for p, _, _ in old}
+                if op.operation != 'delete':
+                    text = op.text or ''
+                    new = self.split(op.docId, text)
+                    for passageId, start, end in new:
+                        operation = 'update' if passageId in old_ids \
+                                    else 'create'
+                        passage_ops.append(WriteOperation(
+                            operation, passageId, text[start:end]))
+                new_ids = set() if new is None else {p for p, _, _ in new}
+                for passageId in sorted(old_ids - new_ids):
+                    passage_ops.append(WriteOperation('delete', passageId))
+            planned.append((op, failed, first, len(passage_ops), new))
+        passage_results = await self.database.write_many(passage_ops)
+        results = []
+        for op, failed, first, last, new in planned:
+            if failed is not None:
+                results.append(failed)
+                continue
+            errors = [result for result in passage_results[first:last]
+                      if not result.ok]
+            if len(errors) > 0:
+                await self.recover(op, passage_ops[first:last],
+                                   passage_results[first:last])
+                results.append(WriteResult(op.operation, op.docId,
+                                           errors[0].status,
+                                           errors[0].error))
+                continue
+            self.set_passages(op.docId, new)
+            status = 201 if op.operation == 'create' else 200
+            results.append(WriteResult(op.operation, op.docId, status))
+        return results
+
+    async def recover(
+            self,
+            op: WriteOperation,
+            passage_ops: List[WriteOperation],
+            passage_results: List[WriteResult],
+        ) -> None:
+        """After some of the passage operations of op failed, undo those of
+        a create and make the passages still stored the document's"""
+        log.warning(f'{op.operation} of {op.docId} partly failed')
+        if op.operation == 'create':
+            undo = [WriteOperation('delete', passage_op.docId)
+                    for passage_op, result
+                    in zip(passage_ops, passage_results) if result.ok]
+            await self.database.write_many(undo)
+        candidates = {passage_op.docId for passage_op in passage_ops}
+        candidates.update(passageId for passageId, _, _
+                          in self.passages.get(op.docId, []))
+        stored = await self.database.read_many(sorted(candidates))
+        self.set_passages(op.docId, stored_spans(stored).get(op.docId))
+
+    async def write(self, op: WriteOperation) -> None:
+        """Write a document and make it searchable, raising on failure"""
+        result, = await self.write_many([op])
+        if result.ok:
+            await self.database.refresh()
+        elif result.status == 409:
+            raise DatabaseAlreadyExistsError(result.error) # type: ignore
+        elif result.status == 404 and op.operation == 'update':
+            raise DatabaseUpdateNotFoundError(result.error) # type: ignore
+        elif result.status == 404 or op.operation == 'delete':
+            raise DatabaseDeleteError(result.error) # type: ignore
+        elif op.operation == 'create':
+            raise DatabaseCreateError(result.error) # type: ignore
+        else:
+            raise DatabaseUpdateError(result.error) # type: ignore
+
+    async def create(self, paragraph: Paragraph) -> None:
+        await self.write(WriteOperation('create', paragraph.docId,
+                                        paragraph.text))
+
+    async def update(self, paragraph: Paragraph) -> None:
+        await self.write(WriteOperation('update', paragraph.docId,
+                                        paragraph.text))
+
+    async def delete(self, docId: DocId) -> None:
+        await self.write(WriteOperation('delete', docId))
+
+    #
+    # reads
+    #
+
+    async def read(self, docId: DocId) -> List[Paragraph]:
+        if docId == '*':
+            return [paragraph async for paragraph in self.iter_all()]
+        return await self.read_many([docId])
+
+    async def read_many(
+            self,
+            docIds: Sequence[DocId]
+        ) -> List[Paragraph]:
+        docIds = [docId for docId in dict.fromkeys(docIds)
+                  if docId in self.passages]
+        passageIds = [passageId for docId in docIds
+                      for passageId, _, _ in self.passages[docId]]
+        texts = {paragraph.docId: paragraph.text for paragraph
+                 in await self.database.read_many(passageIds)}
+        if len(texts) < len(passageIds):
+            log.warning(f'{len(passageIds) - len(texts)} passages missing '
+                        f'from the wrapped database')
+        return [Paragraph(docId, ''.join(texts.get(passageId, '')
+                                         for passageId, _, _
+                                         in self.passages[docId]))
+                for docId in docIds]
+
+    async def read_page(
+            self,
+            after: Optional[DocId],
+            size: int
+        ) -> List[Paragraph]:
+        docIds = sorted(docId for docId in self.passages
+                        if after is None or docId > after)
+        return await self.read_many(docIds[:size])
+
+    #
+    # queries
+    #
+
+    def to_passage(self, paragraph: Paragraph) -> Passage:
+        # offsets of the text in the passage, if the wrapped database
+        # narrowed it
+        if isinstance(paragraph, Passage):
+            start, end = paragraph.start, paragraph.end
+        else:
+            start, end = 0, len(paragraph.text)
+        span = self.spans.get(paragraph.docId)
+        if span is None:
+            # written to the wrapped database by someone else
+            return Passage(paragraph.docId, paragraph.text, start, end)
+        docId, offset, _ = span
+        return Passage(docId, paragraph.text, offset + start, offset + end)
+
+    async def query(
+            self,
+            query_string: str,
+            size: int,
+            qid: str = ''
+        ) -> List[Passage]:
+        paragraphs = await self.database.query(query_string, size, qid)
+        return [self.to_passage(paragraph) for paragraph in paragraphs]
+
+    async def query_many(
+            self,
+            query_strings: Sequence[str],
+            size: int,
+            qid: str = ''
+        ) -> List[List[Paragraph]]:
+        results = await self.database.query_many(query_strings, size, qid)
+        return [[self.to_passage(paragraph) for paragraph in paragraphs]
+                for paragraphs in results]
@@ -0,0 +1,200 @@
+# services/database/segment.py
+"""
+Read-only inverted index segments, stored as flat files and memory-mapped.
+
+A segment holds, for documents numbered 0 to n-1:
+
+    terms.json         term -> term number
+    offsets.i64        postings of term t are postings[offsets[t]:offsets[t+1]]
+    slots.i32          document numbers of the postings, ascending per term
+    tfs.f32            frequency of the term in each of those documents
+    lengths.f32        number of tokens in each document
+    docIds.json        docId of each document
+    text_offsets.i64   text of document i is text[text_offsets[i]:...[i+1]]
+    text.bin           utf-8 texts, concatenated
+    meta.json          counts, written last
+
+Loading maps the arrays instead of reading them, so it takes as long as
+parsing the two json files, and processes serving the same snapshot share
+its pages through the page cache.
+
+Snapshots are directories inside a snapshot directory whose `current` file
+holds the name of the newest one.
+"""
+
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
+import logging
+import os
+import shutil
+
+import numpy as np # type: ignore
+
+from .abstract_database import DocId
+
+log = logging.getLogger('database')
+
+FORMAT = 1
+CURRENT = 'current'
+
+def map_array(path: Path, dtype: Any, count: int) -> np.ndarray:
+    # mmap refuses empty files
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+def fsync_path(path: Path) -> None:
+    """Sync a file, or a directory's entries, to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Segment:
+    terms: Dict[str,int]
+    offsets: np.ndarray
+    slots: np.ndarray
+    tfs: np.ndarray
+    lengths: np.ndarray
+    docIds: List[DocId]
+    text_offsets: np.ndarray
+    text: np.ndarray
+    # the snapshot it was loaded from
+    path: Optional[Path] = None
+
+    def __init__(
+            self,
+            terms: Dict[str,int],
+            offsets: np.ndarray,
+            slots: np.ndarray,
+            tfs: np.ndarray,
+            lengths: np.ndarray,
+            docIds: List[DocId],
+            text_offsets: np.ndarray,
+            text: np.ndarray,
+        ):
+        self.terms = terms
+        self.offsets = offsets
+        self.slots = slots
+        self.tfs = tfs
+        self.lengths = lengths
+        self.docIds = docIds
+        self.text_offsets = text_offsets
+        self.text = text
+
+    @staticmethod
+    def empty() -> 'Segment':
+        return Segment({}, np.zeros(1, dtype=np.int64),
+                       np.zeros(0, dtype=np.int32),
+                       np.zeros(0, dtype=np.float32),
+                       np.zeros(0, dtype=np.float32), [],
+                       np.zeros(1, dtype=np.int64),
+                       np.zeros(0, dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.docIds)
+
+    def df(self, term: str) -> int:
+        t = self.terms.get(term)
+        if t is None:
+            return 0
+        return int(self.offsets[t + 1] - self.offsets[t])
+
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray,np.ndarray]]:
+        t = self.terms.get(term)
+        if t is None:
+            return None
+        start, end = self.offsets[t], self.offsets[t + 1]
+        return self.slots[start:end], self.tfs[start:end]
+
+    def get_text(self, i: int) -> str:
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+        return bytes(self.text[start:end]).decode()
+
+    def write(self, path: Path) -> None:
+        path.mkdir(parents=True)
+        with open(path / 'terms.json', 'w') as file:
+            json.dump(self.terms, file)
+        with open(path / 'docIds.json', 'w') as file:
+            json.dump(self.docIds, file)
+        np.asarray(self.offsets, dtype=np.int64).tofile(path / 'offsets.i64')
+        np.asarray(self.slots, dtype=np.int32).tofile(path / 'slots.i32')
+        np.asarray(self.tfs, dtype=np.float32).tofile(path / 'tfs.f32')
+        np.asarray(self.lengths, dtype=np.float32) \
+            .tofile(path / 'lengths.f32')
+        np.asarray(self.text_offsets, dtype=np.int64) \
+            .tofile(path / 'text_offsets.i64')
+        np.asarray(self.text, dtype=np.uint8).tofile(path / 'text.bin')
+        # meta.json marks the segment complete, so everything else must be
+        # on disk before it is
+        for data in path.iterdir():
+            fsync_path(data)
+        fsync_path(path)
+        meta = {'format': FORMAT, 'terms': len(self.terms),
+                'postings': len(self.slots), 'documents': len(self.docIds),
+                'text_bytes': len(self.text)}
+        with open(path / 'meta.json.tmp', 'w') as file:
+            json.dump(meta, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path / 'meta.json.tmp', path / 'meta.json')
+        fsync_path(path)
+
+    @staticmethod
+    def load(path: Path) -> 'Segment':
+        with open(path / 'meta.json') as file:
+            meta = json.load(file)
+        if meta['format'] != FORMAT:
+            raise ValueError(f'{path} has format {meta["format"]}, '
+                             f'expected {FORMAT}')
+        with open(path / 'terms.json') as file:
+            terms = json.load(file)
+        with open(path / 'docIds.json') as file:
+            docIds = json.load(file)
+        n_terms, n_postings = meta['terms'], meta['postings']
+        n_documents = meta['documents']
+        segment = Segment(
+            terms,
+            map_array(path / 'offsets.i64', np.int64, n_terms + 1),
+            map_array(path / 'slots.i32', np.int32, n_postings),
+            map_array(path / 'tfs.f32', np.float32, n_postings),
+            map_array(path / 'lengths.f32', np.float32, n_documents),
+            docIds,
+            map_array(path / 'text_offsets.i64', np.int64, n_documents + 1),
+            map_array(path / 'text.bin', np.uint8, meta['text_bytes']))
+        segment.path = path
+        return segment
+
+def current_snapshot(directory: Path) -> Optional[Path]:
+    current = directory / CURRENT
+    if not current.exists():
+        return None
+    return directory / current.read_text().strip()
+
+def write_snapshot(directory: Path, segment: Segment, keep: int = 2) -> Path:
+    """Write segment as the current snapshot, and remove all but the newest
+    keep snapshots.  Processes that still map a removed snapshot keep their
+    pages until they unmap them."""
+    directory.mkdir(parents=True, exist_ok=True)
+    name = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    tmp = directory / (name + '.tmp')
+    segment.write(tmp)
+    os.replace(tmp, directory / name)
+    current = directory / (CURRENT + '.tmp')
+    current.write_text(name + '\n')
+    fsync_path(current)
+    os.replace(current, directory / CURRENT)
+    fsync_path(directory)
+    snapshots = sorted(path for path in directory.iterdir()
+                       if path.is_dir() and not path.name.endswith('.tmp'))
+    for path in snapshots[:-keep]:
+        log.info(f'removing old snapshot: {path}')
+        shutil.rmtree(path)
+    return directory / name
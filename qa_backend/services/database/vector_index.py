@@ -0,0 +1,220 @@
+# services/database/vector_index.py
+"""
+Approximate nearest neighbour search over unit vectors, by inner product.
+
+Vectors are rows of one contiguous matrix, float32 or int8 with a scale per
+row.  Once there are enough of them, an IVF index is trained: k-means
+centroids, and for each centroid the list of rows closest to it.  A search
+scores only the rows in the lists of the `nprobe` centroids closest to the
+query.  Rows are added to their list as they are written; deleted rows stay
+in the matrix until the index is retrained, which also happens as the
+number of rows grows past what it was trained on.
+"""
+
+from array import array
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import logging
+import math
+
+import numpy as np # type: ignore
+
+from .abstract_database import DocId
+
+log = logging.getLogger('database')
+
+# rows per centroid needed to train, and rows sampled to train on
+MIN_TRAIN_PER_LIST = 8
+MAX_TRAIN_SAMPLE = 20000
+
+def kmeans(
+        vectors: np.ndarray,
+        k: int,
+        iterations: int = 10,
+        seed: int = 0,
+    ) -> np.ndarray:
+    """Spherical k-means: k unit centroids"""
+    random = np.random.default_rng(seed)
+    centroids = vectors[random.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        # an empty cluster keeps its centroid
+        filled = norms > 0
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids
+
+class VectorIndex:
+    dim: int
+    quantize: bool
+    # centroids to train, None for about the square root of the rows
+    nlist: Optional[int]
+    nprobe: int
+    vectors: np.ndarray
+    # int8 rows are vectors[i] * scales[i]
+    scales: np.ndarray
+    alive: np.ndarray
+    docIds: List[Optional[DocId]]
+    slots: Dict[DocId,int]
+    centroids: Optional[np.ndarray] = None
+    lists: List[array]
+    # live rows when last trained
+    trained_size: int = 0
+    dead: int = 0
+
+    def __init__(
+            self,
+            dim: int,
+            quantize: bool = False,
+            nlist: Optional[int] = None,
+            nprobe: int = 8,
+        ):
+        self.dim = dim
+        self.quantize = quantize
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.clear()
+
+    def clear(self) -> None:
+        dtype = np.int8 if self.quantize else np.float32
+        self.vectors = np.zeros((16, self.dim), dtype=dtype)
+        self.scales = np.ones(16, dtype=np.float32)
+        self.alive = np.zeros(16, dtype=bool)
+        self.docIds = []
+        self.slots = {}
+        self.centroids = None
+        self.lists = []
+        self.trained_size = 0
+        self.dead = 0
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def rows(self, slots: np.ndarray) -> np.ndarray:
+        """float32 rows"""
+        if not self.quantize:
+            return self.vectors[slots]
+        return self.vectors[slots].astype(np.float32) \
+               * self.scales[slots, None]
+
+    def add(self, docIds: Sequence[DocId], vectors: np.ndarray) -> None:
+        """Add or replace the vectors of docIds"""
+        for docId in docIds:
+            if docId in self.slots:
+                self.remove(docId)
+        n = len(self.docIds)
+        needed = n + len(docIds)
+        if needed > len(self.vectors):
+            capacity = max(needed, 2 * len(self.vectors))
+            self.vectors = np.resize(self.vectors, (capacity, self.dim))
+            self.scales = np.resize(self.scales, capacity)
+            self.alive = np.resize(self.alive, capacity)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.quantize:
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self.vectors[n:needed] = np.round(vectors / scales[:, None])
+            self.scales[n:needed] = scales
+        else:
+            self.vectors[n:needed] = vectors
+        self.alive[n:needed] = True
+        for i, docId in enumerate(docIds):
+            self.slots[docId] = n + i
+        self.docIds.extend(docIds)
+        if self.centroids is not None:
+            assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+            for i, centroid in enumerate(assignment.tolist()):
+                self.lists[centroid].append(n + i)
+        if self.should_train():
+            self.train()
+
+    def remove(self, docId: DocId) -> None:
+        slot = self.slots.pop(docId)
+        self.docIds[slot] = None
+        self.alive[slot] = False
+        self.dead += 1
+
+    def should_train(self) -> bool:
+        live = len(self.slots)
+        if live < MIN_TRAIN_PER_LIST * self.n_lists(live) or live < 2:
+            return False
+        return self.centroids is None or live > 4 * self.trained_size \
+               or self.dead > live
+
+    def n_lists(self, live: int) -> int:
+        if self.nlist is not None:
+            return self.nlist
+        return max(1, int(math.sqrt(live)))
+
+    def compact(self) -> None:
+        """Drop the rows of deleted vectors"""
+        live = np.flatnonzero(self.alive[:len(self.docIds)])
+        vectors, scales = self.vectors[live], self.scales[live]
+        docIds = [self.docIds[slot] for slot in live.tolist()]
+        n = len(live)
+        self.vectors = np.resize(vectors, (max(16, n), self.dim))
+        self.scales = np.resize(scales, max(16, n))
+        self.alive = np.zeros(len(self.vectors), dtype=bool)
+        self.alive[:n] = True
+        self.docIds = docIds # type: ignore
+        self.slots = {docId: slot for slot, docId in enumerate(docIds)} # type: ignore
+        self.dead = 0
+
+    def train(self) -> None:
+        self.compact()
+        live = len(self.docIds)
+        k = self.n_lists(live)
+        log.info(f'training IVF index: {live} vectors, {k} lists')
+        random = np.random.default_rng(0)
+        sample = np.arange(live)
+        if live > MAX_TRAIN_SAMPLE:
+            sample = random.choice(live, MAX_TRAIN_SAMPLE, replace=False)
+        self.centroids = kmeans(self.rows(sample), k)
+        assignment = np.argmax(self.rows(np.arange(live)) @ self.centroids.T,
+                               axis=1)
+        self.lists = [array('i') for _ in range(k)]
+        for slot, centroid in enumerate(assignment.tolist()):
+            self.lists[centroid].append(slot)
+        self.trained_size = live
+
+    def candidates(self, query: np.ndarray) -> np.ndarray:
+        n = len(self.docIds)
+        if self.centroids is None:
+            return np.flatnonzero(self.alive[:n])
+        probes = np.argsort(-(self.centroids @ query))[:self.nprobe]
+        slots = np.concatenate([np.frombuffer(self.lists[probe],
+                                              dtype=np.int32)
+                                for probe in probes.tolist()])
+        return slots[self.alive[slots]]
+
+    def search(
+            self,
+            query: np.ndarray,
+            size: int,
+        ) -> List[Tuple[DocId,float]]:
+        """docIds and scores of about the size nearest vectors"""
+        slots = self.candidates(np.asarray(query, dtype=np.float32))
+        if len(slots) == 0:
+            return []
+        scores = self.rows(slots) @ query
+        if len(scores) > size:
+            top = np.argpartition(-scores, size)[:size]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.docIds[slot], float(scores[i])) # type: ignore
+                for i, slot in zip(top.tolist(), slots[top].tolist())]
+
+    def get_stats(self) -> Dict[str,Any]:
+        return {'vectors': len(self.slots),
+                'dead': self.dead,
+                'dim': self.dim,
+                'dtype': str(self.vectors.dtype),
+                'lists': len(self.lists),
+                'trained_size': self.trained_size}
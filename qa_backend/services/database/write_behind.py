@@ -0,0 +1,333 @@
+# services/database/write_behind.py
+"""
+Write-behind for databases whose writes are expensive to make visible.
+
+Writes are appended to a local write-ahead log, fsynced, and acknowledged.
+A background task then applies the pending writes to the database in
+batches, every `interval` seconds or once `batch_size` writes are pending,
+so the database can make a whole batch searchable with one refresh.  Until a
+write is applied, it is visible through `lookup`.
+
+Entries record the state of a document after the write (its text, or None if
+it was deleted), so applying an entry twice has the same effect as applying
+it once.  The log is replayed on startup, after a crash, and rewritten with
+only the pending entries after every batch.
+
+Writers that check a document's state before writing hold its lock, from
+`locked`, until the write is durable, so two creates of one docId can't both
+find it missing.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any
+from typing import AsyncContextManager
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import TextIO
+from typing import Tuple
+import asyncio
+import json
+import logging
+import os
+import time
+
+import attr
+
+from .abstract_database import DocId
+
+log = logging.getLogger('database')
+
+@attr.s(slots=True, auto_attribs=True)
+class WalEntry:
+    seq: int
+    docId: DocId
+    # None deletes the document
+    text: Optional[str]
+
+class WriteAheadLog:
+    """Append-only jsonl file of WalEntrys, synced to disk on every append.
+    Its methods block, and are called from a single thread."""
+    filename: str
+    _file: TextIO
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, 'a')
+
+    def read(self) -> List[WalEntry]:
+        entries = []
+        with open(self.filename) as file:
+            for line in file:
+                try:
+                    entries.append(WalEntry(**json.loads(line)))
+                except (TypeError, ValueError):
+                    # the last line may be torn by a crash while appending
+                    log.warning(f'skipping bad line in {self.filename}')
+        return entries
+
+    def append(self, entries: Sequence[WalEntry]) -> None:
+        self._file.write(''.join(json.dumps(attr.asdict(entry)) + '\n'
+                                 for entry in entries))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def rewrite(self, entries: Sequence[WalEntry]) -> None:
+        """Replace the log with entries"""
+        tmp = f'{self.filename}.tmp'
+        with open(tmp, 'w') as file:
+            file.write(''.join(json.dumps(attr.asdict(entry)) + '\n'
+                               for entry in entries))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.filename)
+        self._file.close()
+        self._file = open(self.filename, 'a')
+
+    def close(self) -> None:
+        self._file.close()
+
+@attr.s(slots=True)
+class WriteBehindStats:
+    # fsyncs of the log, each covering one or more writes
+    syncs: int = attr.ib(default=0)
+    writes: int = attr.ib(default=0)
+    flushes: int = attr.ib(default=0)
+    flushed: int = attr.ib(default=0)
+    # flushes that failed and will be retried
+    errors: int = attr.ib(default=0)
+    replayed: int = attr.ib(default=0)
+    last_flush_seconds: float = attr.ib(default=0.)
+
+Apply = Callable[[List[WalEntry]], Awaitable[None]]
+
+class DocIdLocks:
+    """A lock per docId, kept while it's held or awaited"""
+    locks: Dict[DocId,asyncio.Lock]
+    users: Dict[DocId,int]
+
+    def __init__(self):
+        self.locks = {}
+        self.users = {}
+
+    @asynccontextmanager
+    async def locked(self, docIds: Iterable[DocId]) -> AsyncIterator[None]:
+        # always acquired in the same order, so writers can't deadlock
+        docIds = sorted(set(docIds))
+        for docId in docIds:
+            if docId not in self.locks:
+                self.locks[docId] = asyncio.Lock()
+            self.users[docId] = self.users.get(docId, 0) + 1
+        acquired: List[DocId] = []
+        try:
+            for docId in docIds:
+                await self.locks[docId].acquire()
+                acquired.append(docId)
+            yield
+        finally:
+            for docId in acquired:
+                self.locks[docId].release()
+            for docId in docIds:
+                self.users[docId] -= 1
+                if self.users[docId] == 0:
+                    del self.users[docId]
+                    del self.locks[docId]
+
+class WriteBehind:
+    wal: WriteAheadLog
+    # called with the entries to write to the database, raises to retry
+    apply: Apply
+    interval: float
+    batch_size: int
+    # latest pending entry for each docId
+    pending: Dict[DocId,WalEntry]
+    stats: WriteBehindStats
+    docId_locks: DocIdLocks
+    seq: int = 0
+    _executor: ThreadPoolExecutor
+    _to_sync: List[WalEntry]
+    _synced: List['asyncio.Future[None]']
+    _syncing: bool = False
+    _lock: Optional[asyncio.Lock] = None
+    _wakeup: Optional[asyncio.Event] = None
+    _task: Optional['asyncio.Future[None]'] = None
+
+    def __init__(
+            self,
+            filename: str,
+            apply: Apply,
+            interval: float = 1.,
+            batch_size: int = 1000,
+        ):
+        self.wal = WriteAheadLog(filename)
+        self.apply = apply
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.stats = WriteBehindStats()
+        self.docId_locks = DocIdLocks()
+        # the log is only touched from this thread, so its operations run in
+        # the order they are submitted
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='wal')
+        self._to_sync = []
+        self._synced = []
+
+    def lookup(self, docId: DocId) -> Optional[WalEntry]:
+        return self.pending.get(docId)
+
+    def locked(self, docIds: Iterable[DocId]) -> AsyncContextManager[None]:
+        """Hold the locks of docIds, to check their state and write them
+        without another writer in between"""
+        return self.docId_locks.locked(docIds)
+
+    async def write(self, docId: DocId, text: Optional[str]) -> None:
+        await self.write_many([(docId, text)])
+
+    async def write_many(
+            self,
+            writes: Sequence[Tuple[DocId,Optional[str]]]
+        ) -> None:
+        """Returns once the writes are durable, raises if they failed"""
+        entries = []
+        # the pending entries the writes replace
+        replaced: Dict[DocId,Optional[WalEntry]] = {}
+        for docId, text in writes:
+            self.seq += 1
+            entry = WalEntry(self.seq, docId, text)
+            replaced.setdefault(docId, self.pending.get(docId))
+            # pending before they are synced, so the log isn't rewritten
+            # without them
+            self.pending[docId] = entry
+            entries.append(entry)
+        self.stats.writes += len(entries)
+        if len(self.pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+        try:
+            await self._sync(entries)
+        except Exception:
+            # reported as failed, so must not be applied by a flush, unlike
+            # the acknowledged writes they replaced
+            for entry in entries:
+                if self.pending.get(entry.docId) is entry:
+                    previous = replaced[entry.docId]
+                    if previous is None:
+                        del self.pending[entry.docId]
+                    else:
+                        self.pending[entry.docId] = previous
+            raise
+
+    async def _sync(self, entries: List[WalEntry]) -> None:
+        """Group commit: writes arriving during a sync share the next one"""
+        synced = asyncio.get_event_loop().create_future()
+        self._to_sync.extend(entries)
+        self._synced.append(synced)
+        if not self._syncing:
+            self._syncing = True
+            # a task of its own, so cancelling a writer doesn't strand the
+            # others
+            asyncio.ensure_future(self._sync_all())
+        await synced
+
+    async def _sync_all(self) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            while len(self._to_sync) > 0:
+                batch, waiters = self._to_sync, self._synced
+                self._to_sync, self._synced = [], []
+                try:
+                    await loop.run_in_executor(self._executor,
+                                               self.wal.append, batch)
+                    self.stats.syncs += 1
+                except Exception as e:
+                    log.exception('failed to append to write-ahead log')
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                else:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+        finally:
+            self._syncing = False
+
+    async def flush(self) -> None:
+        """Apply the pending entries, then drop them from the log"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            entries = list(self.pending.values())
+            if len(entries) == 0:
+                return
+            start = time.monotonic()
+            await self.apply(entries)
+            for entry in entries:
+                if self.pending.get(entry.docId) is entry:
+                    del self.pending[entry.docId]
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self._executor, self.wal.rewrite,
+                                       list(self.pending.values()))
+            self.stats.flushes += 1
+            self.stats.flushed += len(entries)
+            self.stats.last_flush_seconds = time.monotonic() - start
+
+    async def replay(self) -> None:
+        """Apply what's left in the log by a crash"""
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(self._executor, self.wal.read)
+        latest: Dict[DocId,WalEntry] = {}
+        for entry in sorted(entries, key=lambda entry: entry.seq):
+            latest[entry.docId] = entry
+            self.seq = max(self.seq, entry.seq)
+        if len(latest) == 0:
+            return
+        log.info(f'replaying {len(latest)} writes from {self.wal.filename}')
+        self.pending.update(latest)
+        await self.flush()
+        self.stats.replayed += len(latest)
+
+    async def run(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.stats.errors += 1
+                log.exception(f'write-behind flush failed: {e}')
+
+    def start(self) -> None:
+        """Flush in the background, in the running loop"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        """Stop flushing in the background, and flush what's pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self.wal.close()
+
+    def get_stats(self) -> Dict[str,Any]:
+        stats = attr.asdict(self.stats)
+        stats['pending'] = len(self.pending)
+        return stats
@@ -2,6 +2,9 @@
 
 from abc import abstractmethod
 from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
 import logging
 
 from qa_backend.util import Configurable
@@ -25,14 +28,33 @@ class QAQueryError(RuntimeError):
 
 class QA(Configurable):
     _requires_context: bool
+    _supports_batch: bool = False
+    # upper bound on concurrent queries to this service, None -> server default
+    max_concurrency: Optional[int] = None
 
     @abstractmethod
     async def query(self, question: str, **kwargs) -> List[QAAnswer]:
         ...
 
+    async def query_many(
+            self,
+            questions: Sequence[Tuple[str,str]]
+        ) -> List[List[QAAnswer]]:
+        """Answer (question, context) pairs, one list of answers per pair.
+
+        Services which can answer a batch more efficiently than one query at a
+        time override this and set `_supports_batch`.
+        """
+        return [await self.query(question, context=context)
+                for question, context in questions]
+
     @property
     def requires_context(self) -> bool:
         return self._requires_context
 
+    @property
+    def supports_batch(self) -> bool:
+        return self._supports_batch
+
     async def shutdown(self):
         ...
@@ -4,12 +4,18 @@ Adapter for a transformers_micro endpoint
 """
 
 from json.decoder import JSONDecodeError
+from typing import Any
 from typing import List
 from typing import MutableMapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import asyncio
 import logging
 
 from aiohttp import ClientSession
 from aiohttp import ContentTypeError
+from attr.converters import optional
 import attr
 
 from .abstract_qa import QA
@@ -30,19 +36,29 @@ class MicroAdapterQAConfig:
     host: str = attr.ib(default='0.0.0.0')
     port: int = attr.ib(default=8081, converter=int)
     path: str = attr.ib(default='question',converter=strip_leading_slash)
+    max_concurrency: Optional[int] = attr.ib(default=None,
+                                             converter=optional(int))
+    # maximum number of (question, context) pairs sent in one batch request
+    batch_size: int = attr.ib(default=32, converter=int)
 
     @property
     def url(self) -> str:
         return f'http://{self.host}:{self.port}/{self.path}'
 
+    @property
+    def batch_url(self) -> str:
+        return f'{self.url}/batch'
+
 class MicroAdapterQA(QA):
     session: ClientSession
     config: MicroAdapterQAConfig
     _requires_context = True
+    _supports_batch = True
 
     def __init__(self, config: MicroAdapterQAConfig):
         log.info(f'creating MicroAdapterQA: {config}')
         self.config = config
+        self.max_concurrency = config.max_concurrency
         self.session = ClientSession()
 
     @staticmethod
@@ -60,22 +76,57 @@ class MicroAdapterQA(QA):
         if not isinstance(context, str):
             raise QAQueryError("context must be a string")
         body = {'question': question, 'context': context}
-        log.info(f'about to query: {self.config.url}')
-        async with self.session.post(self.config.url, json=body) as response:
+        resp_json = await self.post(self.config.url, body)
+        try:
+            return [QAAnswer(**answer) for answer in resp_json]
+        except (KeyError, TypeError) as e:
+            raise QAQueryError(str(e))
+
+    async def query_many(
+            self,
+            questions: Sequence[Tuple[str,str]]
+        ) -> List[List[QAAnswer]]:
+        log.info(f'[MicroAdapterQA] {len(questions)} questions')
+        for _, context in questions:
+            if context == '':
+                raise QAQueryError("context required")
+            if not isinstance(context, str):
+                raise QAQueryError("context must be a string")
+        size = self.config.batch_size
+        chunks = [questions[i:i+size] for i in range(0, len(questions), size)]
+        bodies = [{'questions': [{'question': question, 'context': context}
+                                 for question, context in chunk]}
+                  for chunk in chunks]
+        posts = [self.post(self.config.batch_url, body) for body in bodies]
+        answers: List[List[QAAnswer]] = []
+        for chunk, resp_json in zip(chunks, await asyncio.gather(*posts)):
+            # answers are matched to their questions by position
+            if not isinstance(resp_json, list) or len(resp_json) != len(chunk):
+                msg = f'expected answers to {len(chunk)} questions from ' \
+                      f'{self.config.batch_url}'
+                raise QAQueryError(msg)
+            try:
+                answers.extend([QAAnswer(**answer) for answer in answers_]
+                               for answers_ in resp_json)
+            except (KeyError, TypeError) as e:
+                raise QAQueryError(str(e))
+        return answers
+
+    async def post(self, url: str, body: Any) -> Any:
+        """Post json to the micro service and return the decoded response"""
+        log.info(f'about to query: {url}')
+        async with self.session.post(url, json=body) as response:
             status = response.status
             log.info(f'got response: {response}')
             if status != 200:
-                msg = f'got {status} from {self.config.url}: {response.reason}'
+                msg = f'got {status} from {url}: {response.reason}'
                 raise QAQueryError(msg)
             try:
-                resp_json = await response.json()
-                return [QAAnswer(**answer) for answer in resp_json]
+                return await response.json()
             except JSONDecodeError as e:
                 text = await response.text()
-                msg = f"error decoding json:\n{self.config.url}\n{text}\n{str(e)}"
+                msg = f"error decoding json:\n{url}\n{text}\n{str(e)}"
                 raise QAQueryError(msg)
-            except KeyError as e:
-                raise QAQueryError(str(e))
             except ContentTypeError as e:
                 raise QAQueryError(str(e))
 
@@ -1,10 +1,13 @@
 # transformers_qa.py
 
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import MutableMapping
 from typing import Optional
+from typing import Sequence
+from typing import Tuple
 from typing import Union
-from typing import cast
 import logging
 import os
 
@@ -20,15 +23,24 @@ from qa_backend.util import ConfigurationError
 from qa_backend.util import QAAnswer
 from qa_backend.util import complete_sentence
 from qa_backend.util import convert_bool
+from qa_backend.util.metrics import registry
+from qa_backend.util.metrics import timed
 
 log = logging.getLogger('qa')
 
+PIPELINE_SECONDS = registry.histogram('qa_pipeline_duration_seconds',
+                                      'Time taken by the reader pipeline',
+                                      ['operation'])
+
 @attr.s(kw_only=True)
 class TransformersQAConfig:
     model_name: str = attr.ib(default='twmkn9/distilbert-base-uncased-squad2',
                               validator=instance_of(str))
     device: int = attr.ib(default=0, converter=int)
     use_gpu: bool = attr.ib(default=True, converter=convert_bool)
+    # passed to the pipeline for batched queries when set
+    batch_size: Optional[int] = attr.ib(default=None,
+                                        converter=attr.converters.optional(int))
 
 def create_pipeline(config: TransformersQAConfig) -> QuestionAnsweringPipeline:
     log.info(f'creating pipeline: {config}')
@@ -75,6 +87,7 @@ class TransformersQA(QA):
     pipeline: Union[QuestionAnsweringPipeline, LazyPipeline]
     config: Optional[TransformersQAConfig] = None
     _requires_context = True
+    _supports_batch = True
 
     def __init__(
             self,
@@ -84,6 +97,7 @@ class TransformersQA(QA):
         if isinstance(pipeline, QuestionAnsweringPipeline) and config is None:
             self.pipeline = pipeline
         elif isinstance(config, TransformersQAConfig) and pipeline is None:
+            self.config = config
             self.pipeline = LazyPipeline(config)
         else:
             msg = 'Either a config or pipeline must be specified'
@@ -110,8 +124,42 @@ class TransformersQA(QA):
         log.debug(f'context: {context}')
         question_ = {'question': question, 'context': context}
         question_args = {'handle_impossible_answer':True, 'topk':1}
-        answer = self.pipeline(**question_, **question_args)
+        with timed(PIPELINE_SECONDS, 'pipeline', operation='query'):
+            answer = self.pipeline(**question_, **question_args)
         log.debug(f'answer: {answer}')
+        return [self.to_qa_answer(question, context, answer)]
+
+    async def query_many(
+            self,
+            questions: Sequence[Tuple[str,str]]
+        ) -> List[List[QAAnswer]]:
+        log.debug(f'[TransformersQA] {len(questions)} questions')
+        if len(questions) == 0:
+            return []
+        for _, context in questions:
+            if context == '':
+                raise QAQueryError("context required")
+        question_ = {'question': [question for question, _ in questions],
+                     'context': [context for _, context in questions]}
+        question_args: Dict[str,Any] = {'handle_impossible_answer':True,
+                                        'topk':1}
+        if self.config is not None and self.config.batch_size is not None:
+            question_args['batch_size'] = self.config.batch_size
+        with timed(PIPELINE_SECONDS, 'pipeline', operation='query_many'):
+            answers = self.pipeline(**question_, **question_args)
+        # the pipeline unwraps the result for a single example
+        if isinstance(answers, dict):
+            answers = [answers]
+        log.debug(f'answers: {answers}')
+        return [[self.to_qa_answer(question, context, answer)]
+                for (question, context), answer in zip(questions, answers)]
+
+    @staticmethod
+    def to_qa_answer(
+            question: str,
+            context: str,
+            answer: Dict[str,Any]
+        ) -> QAAnswer:
         # check for "no answer"
         if answer['start'] == answer['end']:
             answer_ = ''
@@ -119,7 +167,7 @@ class TransformersQA(QA):
         else:
             start,end = answer['start'], answer['end']
             original_span = answer['answer']
-            answer_ = complete_sentence(cast(str,context),start, end)
+            answer_ = complete_sentence(context, start, end)
         log.debug(f'answer_: {answer_}')
-        return [QAAnswer(question, answer_, answer['score'],
-                         original_span=original_span)]
+        return QAAnswer(question, answer_, answer['score'],
+                        original_span=original_span)
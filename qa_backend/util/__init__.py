@@ -21,12 +21,17 @@ import sys
 
 from .api_error import APIError
 from .api_error import exception_middleware
+from .from_request import JsonBulkOperation
 from .from_request import JsonCrudOperation
 from .from_request import JsonQuestion
+from .from_request import JsonQuestionBatch
 from .from_request import JsonQuestionOptionalContext
+from .from_request import JsonQuestions
 from .logging_ import set_all_loglevels
+from .serialization import DOC_ID_PATTERN
 from .serialization import JsonRepresentation
 from .serialization import Paragraph
+from .serialization import Passage
 from .serialization import QAAnswer
 
 log = logging.getLogger('util')
@@ -19,6 +19,8 @@ from aiohttp.web import StreamResponse
 from aiohttp.web import middleware
 from aiohttp.web_middlewares import _Handler # type: ignore
 
+from .metrics import ERRORS
+
 log = logging.getLogger('server')
 
 class APIError(RuntimeError):
@@ -55,11 +57,14 @@ async def exception_middleware(
         return result
     except APIError as e:
         log.info(f'[API ERROR]: {str(e)}')
+        ERRORS.inc(category='api_error')
         return Response(status=400, text=str(e))
     except HTTPException as e:
         log.warn(f'{e.__class__.__name__}: {e}')
+        ERRORS.inc(category='http_exception')
         return e
     except Exception as e:
         log.exception(e,exc_info=True,stack_info=True)
+        ERRORS.inc(category='internal')
         msg = 'an internal error has occurred'
         return Response(text=msg, status=500)
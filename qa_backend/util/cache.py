@@ -0,0 +1,132 @@
+# util/cache.py
+"""
+Bounded LRU cache with optional expiry and memory accounting
+"""
+
+from collections import OrderedDict
+from typing import Callable
+from typing import Dict
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+import logging
+import time
+
+import attr
+
+log = logging.getLogger('util')
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+@attr.s(slots=True)
+class CacheStats:
+    hits: int = attr.ib(default=0)
+    misses: int = attr.ib(default=0)
+    evictions: int = attr.ib(default=0)
+    expirations: int = attr.ib(default=0)
+    invalidations: int = attr.ib(default=0)
+
+class LRUCache(Generic[K,V]):
+    """Least recently used cache.
+
+    Entries are evicted when there are more than `max_size` of them, or when
+    the sum of `sizeof` over the entries exceeds `max_bytes`.  Entries older
+    than `ttl` seconds are never returned.  `on_remove` is called with every
+    key that leaves the cache, whatever the reason.
+    """
+    max_size: int
+    ttl: Optional[float]
+    max_bytes: Optional[int]
+    nbytes: int
+    stats: CacheStats
+    _entries: 'OrderedDict[K,Tuple[V,float,int]]'
+
+    def __init__(
+            self,
+            max_size: int,
+            ttl: Optional[float] = None,
+            max_bytes: Optional[int] = None,
+            sizeof: Optional[Callable[[V],int]] = None,
+            on_remove: Optional[Callable[[K],None]] = None,
+            clock: Callable[[],float] = time.monotonic,
+        ):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError('max_bytes requires sizeof')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_remove = on_remove
+        self.clock = clock
+        self.nbytes = 0
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key: K) -> Optional[V]:
+        try:
+            value, expires, _ = self._entries[key]
+        except KeyError:
+            self.stats.misses += 1
+            return None
+        if expires < self.clock():
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        if not self.enabled:
+            return
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            log.debug(f'not caching entry of {size} bytes')
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires = self.clock() + self.ttl if self.ttl is not None \
+                                          else float('inf')
+        self._entries[key] = (value, expires, size)
+        self.nbytes += size
+        while len(self._entries) > self.max_size or self._over_budget():
+            oldest = next(iter(self._entries))
+            self.stats.evictions += 1
+            self._remove(oldest)
+
+    def invalidate(self, key: K) -> None:
+        if key in self._entries:
+            self.stats.invalidations += 1
+            self._remove(key)
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self.invalidate(key)
+
+    def _over_budget(self) -> bool:
+        return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+    def _remove(self, key: K) -> None:
+        _, _, size = self._entries.pop(key)
+        self.nbytes -= size
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def get_stats(self) -> Dict[str,int]:
+        stats = attr.asdict(self.stats)
+        stats.update({'size': len(self), 'bytes': self.nbytes})
+        return stats
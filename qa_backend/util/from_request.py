@@ -6,9 +6,12 @@ Classes which are designed to be constructed from Requests
 from json.decoder import JSONDecodeError
 from typing import Any
 from typing import Generic
+from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import TypeVar
 from typing import cast
+import json
 import logging
 
 from aiohttp.web import Request
@@ -19,6 +22,7 @@ from attr.validators import optional
 import attr
 
 from .api_error import APIError
+from .serialization import DOC_ID_PATTERN
 
 log = logging.getLogger('server')
 T = TypeVar('T')
@@ -71,11 +75,81 @@ class JsonQuestionOptionalContext(FromRequest['JsonQuestionOptionalContext']):
 JsonQuestionOptionalContext._api_error_message = \
         'Question Format: {"question":str, "context": Optional[str]}'
 
+def to_questions(questions: Any) -> List[JsonQuestionOptionalContext]:
+    if not isinstance(questions, list):
+        raise ValueError('questions must be a list')
+    return [JsonQuestionOptionalContext(**question) for question in questions]
+
+@attr.s
+class JsonQuestions(FromRequest['JsonQuestions']):
+    questions: List[JsonQuestionOptionalContext] = attr.ib(
+                                                    converter=to_questions)
+
+JsonQuestions._api_error_message = \
+    'Questions Format: {"questions":[{"question":str, "context": Optional[str]}]}'
+
 @attr.s
 class JsonCrudOperation(FromRequest['JsonCrudOperation']):
     operation: str = attr.ib(validator=in_(['create','update']))
-    docId: str = attr.ib(validator=matches_re(r'.*\.txt'))
+    docId: str = attr.ib(validator=matches_re(DOC_ID_PATTERN))
     text: str = attr.ib(validator=instance_of(str))
 
 JsonCrudOperation._api_error_message = \
     'Json CRUD Operation: {"operation":{create|update}, "docId":str, "text":str}'
+
+@attr.s
+class JsonBulkOperation:
+    """One line of the NDJSON body of /index/bulk"""
+    operation: str = attr.ib(validator=in_(['create','update','delete']))
+    docId: str = attr.ib(validator=matches_re(DOC_ID_PATTERN))
+    text: Optional[str] = attr.ib(default=None,
+                                  validator=optional(instance_of(str)))
+
+    def __attrs_post_init__(self):
+        if self.operation != 'delete' and self.text is None:
+            raise ValueError(f'{self.operation} requires text')
+
+    @classmethod
+    def from_line(cls, line: bytes) -> 'JsonBulkOperation':
+        """Raises ValueError with the message for the client"""
+        try:
+            body = json.loads(line)
+            if not isinstance(body, dict):
+                raise ValueError('line must be a json object')
+            return cls(**body)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'{BULK_FORMAT}\nError: {e}')
+
+BULK_FORMAT = 'Json Bulk Operation: ' \
+    '{"operation":{create|update|delete}, "docId":str, "text":str}'
+
+@attr.s
+class JsonQuestionBatch(FromRequest['JsonQuestionBatch']):
+    """Either one question with many contexts, or many (question, context)"""
+    question: Optional[str] = attr.ib(default=None,
+                                      validator=optional(validate_question))
+    contexts: Optional[List[str]] = attr.ib(default=None)
+    questions: Optional[List[JsonQuestion]] = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        if self.questions is not None:
+            if self.question is not None or self.contexts is not None:
+                raise ValueError('give either questions or question/contexts')
+            if not isinstance(self.questions, list):
+                raise ValueError('questions must be a list')
+            self.questions = [JsonQuestion(**q) for q in self.questions]
+        else:
+            if self.question is None or not isinstance(self.contexts, list):
+                raise ValueError('question and contexts are required')
+            for context in self.contexts:
+                validate_context(self, None, context)
+
+    @property
+    def pairs(self) -> List[Tuple[str,str]]:
+        if self.questions is not None:
+            return [(q.question, q.context) for q in self.questions]
+        return [(cast(str,self.question), c) for c in cast(List[str],self.contexts)]
+
+JsonQuestionBatch._api_error_message = \
+    'Question Batch Format: {"question":str, "contexts":[str]} or ' +\
+    '{"questions":[{"question":str, "context":str}]}'
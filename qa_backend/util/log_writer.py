@@ -0,0 +1,173 @@
+# util/log_writer.py
+"""
+Append-only jsonl logs written from a background thread
+"""
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TextIO
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+import attr
+
+log = logging.getLogger('util')
+
+@attr.s(slots=True)
+class LogWriterStats:
+    written: int = attr.ib(default=0)
+    # entries dropped because the queue was full
+    dropped: int = attr.ib(default=0)
+    batches: int = attr.ib(default=0)
+    rotations: int = attr.ib(default=0)
+    errors: int = attr.ib(default=0)
+
+class LogWriter:
+    """Write entries as json lines to filename without blocking the caller.
+
+    Entries are queued and written in batches by a daemon thread.  When the
+    queue holds `queue_size` entries, new entries are dropped and counted
+    rather than making the caller wait.  The file is rotated once it reaches
+    `max_bytes` or has been open for `max_age` seconds; rotated segments are
+    renamed with a timestamp suffix and gzipped if `compress` is set.
+
+    Entries are turned into lines by `serialize` on the writer thread, so
+    expensive formatting can be handed off along with the I/O.
+    """
+    filename: str
+    stats: LogWriterStats
+    _queue: 'queue.Queue[Optional[Any]]'
+    _file: Optional[TextIO] = None
+    _size: int = 0
+    _opened: float = 0.
+
+    def __init__(
+            self,
+            filename: str,
+            queue_size: int = 10000,
+            batch_size: int = 256,
+            max_bytes: Optional[int] = None,
+            max_age: Optional[float] = None,
+            compress: bool = False,
+            flush_interval: float = 1.,
+            serialize: Callable[[Any],str] = json.dumps,
+            clock: Callable[[],float] = time.time,
+        ):
+        self.filename = filename
+        self.serialize = serialize
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.stats = LogWriterStats()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._open()
+        self._thread = threading.Thread(target=self._run,
+                                        name=f'log writer: {filename}',
+                                        daemon=True)
+        self._thread.start()
+
+    def write(self, entry: Any) -> bool:
+        """Queue entry to be written, returning whether it was accepted"""
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.stats.dropped += 1
+            return False
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Write the queued entries and stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        # the sentinel must not be dropped, so wait for room
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def get_stats(self) -> Dict[str,int]:
+        stats = attr.asdict(self.stats)
+        stats['queued'] = self._queue.qsize()
+        return stats
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            batch: List[Any] = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+            try:
+                if self._should_rotate():
+                    self._rotate()
+                if len(batch) > 0:
+                    self._write_batch(batch)
+            except Exception as e:
+                self.stats.errors += 1
+                log.exception(f'error writing {self.filename}: {e}')
+        if self._file is not None:
+            self._file.close()
+
+    def _write_batch(self, batch: List[Any]) -> None:
+        assert self._file is not None
+        lines: List[str] = []
+        for entry in batch:
+            try:
+                lines.append(self.serialize(entry) + '\n')
+            except Exception as e:
+                self.stats.errors += 1
+                log.error(f'failed to serialize entry for {self.filename}: {e}')
+        text = ''.join(lines)
+        self._file.write(text)
+        self._file.flush()
+        self._size += len(text.encode())
+        self.stats.written += len(lines)
+        self.stats.batches += 1
+
+    def _open(self) -> None:
+        self._file = open(self.filename, 'a')
+        self._size = self._file.tell()
+        self._opened = self.clock()
+
+    def _should_rotate(self) -> bool:
+        if self._size == 0:
+            return False
+        if self.max_bytes is not None and self._size >= self.max_bytes:
+            return True
+        return self.max_age is not None \
+                and self.clock() - self._opened >= self.max_age
+
+    def _rotate(self) -> None:
+        assert self._file is not None
+        self._file.close()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.clock()))
+        rotated = f'{self.filename}.{stamp}'
+        n = 1
+        while os.path.exists(rotated) or os.path.exists(f'{rotated}.gz'):
+            rotated = f'{self.filename}.{stamp}.{n}'
+            n += 1
+        os.rename(self.filename, rotated)
+        log.info(f'rotated {self.filename} to {rotated}')
+        self.stats.rotations += 1
+        self._open()
+        if self.compress:
+            with open(rotated, 'rb') as f_in:
+                with gzip.open(f'{rotated}.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.remove(rotated)
@@ -0,0 +1,276 @@
+# util/metrics.py
+"""
+Prometheus-style metrics, and per-request stage timings for Server-Timing.
+
+Metrics are registered on the module's `registry` and served in the
+Prometheus text format by `metrics_handler`.  `timed` observes a histogram
+and also adds the duration to the current request's stage timings, which
+`metrics_middleware` sends back in a Server-Timing header.  The stage timings
+live in a context variable, so they follow the request into the tasks it
+creates, including calls into the database and qa services.
+"""
+
+from abc import ABC
+from abc import abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import logging
+import time
+
+from aiohttp.web import Request
+from aiohttp.web import Response
+from aiohttp.web import StreamResponse
+from aiohttp.web import middleware
+from aiohttp.web_middlewares import _Handler # type: ignore
+
+log = logging.getLogger('util')
+
+LabelValues = Tuple[str,...]
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5,
+                   5., 10.)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ''
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric(ABC):
+    kind: str
+    name: str
+    help: str
+    labels: Tuple[str,...]
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def label_values(self, labels: Dict[str,str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            msg = f'{self.name} takes labels {self.labels}, got {tuple(labels)}'
+            raise ValueError(msg)
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str,str,float]]:
+        """(suffix, formatted labels, value) for each sample"""
+        ...
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+    values: Dict[LabelValues,float]
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self.label_values(labels), 0)
+
+    def samples(self) -> List[Tuple[str,str,float]]:
+        return [('', _format_labels(self.labels, key), value)
+                for key, value in sorted(self.values.items())]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self.label_values(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+    buckets: Tuple[float,...]
+    # per label values: counts for each bucket (not cumulative), sum, count
+    values: Dict[LabelValues,Tuple[List[int],float,int]]
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+        ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.label_values(labels)
+        counts, sum_, count = self.values.get(key) \
+                              or ([0] * len(self.buckets), 0., 0)
+        counts[bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, sum_ + value, count + 1)
+
+    def get_count(self, **labels: str) -> int:
+        values = self.values.get(self.label_values(labels))
+        return 0 if values is None else values[2]
+
+    def samples(self) -> List[Tuple[str,str,float]]:
+        samples: List[Tuple[str,str,float]] = []
+        for key, (counts, sum_, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ('le',),
+                                        key + (_format_value(bound),))
+                samples.append(('_bucket', labels, cumulative))
+            labels = _format_labels(self.labels, key)
+            samples.append(('_sum', labels, sum_))
+            samples.append(('_count', labels, count))
+        return samples
+
+class Registry:
+    metrics: Dict[str,Metric]
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Register metric, or return the one already registered by name"""
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) != type(metric) \
+                    or existing.labels != metric.labels:
+                raise ValueError(f'{metric.name} is already registered')
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+            self, name: str, help: str, labels: Sequence[str] = ()
+        ) -> Counter:
+        return self.register(Counter(name, help, labels)) # type: ignore
+
+    def gauge(
+            self, name: str, help: str, labels: Sequence[str] = ()
+        ) -> Gauge:
+        return self.register(Gauge(name, help, labels)) # type: ignore
+
+    def histogram(
+            self,
+            name: str,
+            help: str,
+            labels: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+        ) -> Histogram:
+        return self.register( # type: ignore
+                    Histogram(name, help, labels, buckets))
+
+    def expose(self) -> str:
+        return '\n'.join(metric.expose()
+                         for _, metric in sorted(self.metrics.items())) + '\n'
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+                        'qa_request_duration_seconds',
+                        'Time to respond to requests',
+                        ['method', 'route', 'status'])
+REQUESTS_IN_FLIGHT = registry.gauge(
+                        'qa_requests_in_flight',
+                        'Requests currently being handled')
+ERRORS = registry.counter(
+                        'qa_http_errors_total',
+                        'Error responses by exception_middleware category',
+                        ['category'])
+
+#
+# stage timings
+#
+
+_stage_timings: ContextVar[Optional[Dict[str,float]]] = \
+        ContextVar('stage_timings', default=None)
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Add seconds to stage in the current request's Server-Timing"""
+    timings = _stage_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.) + seconds
+
+@contextmanager
+def timed(
+        histogram: Histogram,
+        stage: Optional[str] = None,
+        **labels: str
+    ) -> Iterator[None]:
+    """Observe the duration of the block, and record it as stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        histogram.observe(seconds, **labels)
+        if stage is not None:
+            record_stage(stage, seconds)
+
+def server_timing(timings: Dict[str,float]) -> str:
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}'
+                     for stage, seconds in timings.items())
+
+def route_name(request: Request) -> str:
+    """Route template of the request, so paths don't multiply the labels"""
+    resource = request.match_info.route.resource
+    return 'unmatched' if resource is None else resource.canonical
+
+@middleware
+async def metrics_middleware(
+        request: Request,
+        handler: _Handler
+        ) -> StreamResponse:
+    """Count and time requests, and send back their stage timings"""
+    timings: Dict[str,float] = {}
+    token = _stage_timings.set(timings)
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        # streamed responses have sent their headers already
+        if not response.prepared and len(timings) > 0:
+            timings['total'] = time.perf_counter() - start
+            response.headers['Server-Timing'] = server_timing(timings)
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                method=request.method,
+                                route=route_name(request),
+                                status=str(status))
+        _stage_timings.reset(token)
+
+async def metrics_handler(request: Request) -> Response:
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return Response(body=registry.expose().encode(),
+                    headers={'Content-Type': content_type})
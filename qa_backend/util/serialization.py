@@ -20,11 +20,20 @@ class JsonRepresentation:
     def to_json(self) -> str:
         return json.dumps(attr.asdict(self))
 
+# docIds are also file names, when documents are read from a directory
+DOC_ID_PATTERN = r'[a-zA-Z_\-0-9]+\.txt'
+
 @attr.s(auto_attribs=True, slots=True)
 class Paragraph(JsonRepresentation):
-    docId: str = attr.ib(validator=matches_re(r'[a-zA-Z_\-0-9]+.txt'))
+    docId: str = attr.ib(validator=matches_re(DOC_ID_PATTERN))
     text: str
 
+@attr.s(auto_attribs=True, slots=True)
+class Passage(Paragraph):
+    """A span of the paragraph docId: its text is the parent's text[start:end]"""
+    start: int = 0
+    end: int = 0
+
 @attr.s(auto_attribs=True, slots=True)
 class QAAnswer(JsonRepresentation):
     question: str
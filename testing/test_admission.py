@@ -0,0 +1,52 @@
+# test_admission.py
+
+import asyncio
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.server.admission import AdmissionController
+
+loop = asyncio.get_event_loop()
+
+class AdmissionController_Test(unittest.TestCase):
+    def test_shed_when_queue_full(self):
+        async def _test():
+            admission = AdmissionController(max_in_flight=1, max_queued=1)
+            self.assertTrue(await admission.acquire())
+            queued = asyncio.ensure_future(admission.acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(admission.queued, 1)
+            self.assertFalse(await admission.acquire())
+            admission.release()
+            self.assertTrue(await queued)
+            self.assertEqual(admission.in_flight, 1)
+            admission.release()
+            self.assertEqual(admission.in_flight, 0)
+            return admission.get_stats()
+        stats = loop.run_until_complete(_test())
+        self.assertEqual(stats['admitted'], 2)
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['shed'], 1)
+
+    def test_queue_timeout(self):
+        async def _test():
+            admission = AdmissionController(max_in_flight=1, max_queued=1,
+                                            max_queue_wait=0.01)
+            self.assertTrue(await admission.acquire())
+            self.assertFalse(await admission.acquire())
+            self.assertEqual(admission.queued, 0)
+            admission.release()
+            self.assertEqual(admission.in_flight, 0)
+            return admission.get_stats()
+        stats = loop.run_until_complete(_test())
+        self.assertEqual(stats['queue_timeouts'], 1)
+
+    def test_disabled(self):
+        admission = AdmissionController()
+        handler = lambda request: None
+        self.assertIs(admission.admitted(handler), handler)
+
+if __name__ == '__main__':
+    unittest.main()
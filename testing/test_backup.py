@@ -0,0 +1,83 @@
+# test_backup.py
+
+from tempfile import TemporaryDirectory
+from typing import Dict
+from typing import List
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.services.database import BackupManager
+from qa_backend.services.database import Database
+from qa_backend.services.database import DatabaseAlreadyExistsError
+from qa_backend.util import Paragraph
+
+loop = asyncio.get_event_loop()
+
+class MemoryDatabase(Database):
+    def __init__(self, texts: Dict[str,str] = {}):
+        self.texts = dict(texts)
+
+    async def create(self, paragraph: Paragraph) -> None:
+        if paragraph.docId in self.texts:
+            raise DatabaseAlreadyExistsError(paragraph.docId) # type: ignore
+        self.texts[paragraph.docId] = paragraph.text
+
+    async def read(self, docId: str) -> List[Paragraph]:
+        if docId == '*':
+            return [Paragraph(k, v) for k, v in self.texts.items()]
+        return [Paragraph(docId, self.texts[docId])] \
+               if docId in self.texts else []
+
+    async def update(self, paragraph: Paragraph) -> None:
+        self.texts[paragraph.docId] = paragraph.text
+
+    async def delete(self, docId: str) -> None:
+        del self.texts[docId]
+
+class BackupManager_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.directory = self.tmp.name
+        texts = {f'{i}.txt': f'text {i}' for i in range(10)}
+        self.database = MemoryDatabase(texts)
+        self.backups = BackupManager(self.directory, self.database,
+                                     full_every=3, keep_chains=1, page_size=4)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def restored(self) -> Dict[str,str]:
+        database = MemoryDatabase()
+        backups = BackupManager(self.directory, database)
+        report = loop.run_until_complete(backups.restore())
+        self.assertEqual(report.failed, {})
+        return database.texts
+
+    def test_incremental(self):
+        full = loop.run_until_complete(self.backups.backup())
+        self.assertEqual(full.changed, 10)
+        self.assertIsNone(loop.run_until_complete(self.backups.backup()))
+        self.database.texts['1.txt'] = 'changed'
+        del self.database.texts['2.txt']
+        delta = loop.run_until_complete(self.backups.backup())
+        self.assertEqual((delta.changed, delta.deleted), (1, 1))
+        self.assertEqual(delta.parent, full.name)
+        self.assertEqual(self.restored(), self.database.texts)
+
+    def test_prune(self):
+        for i in range(4):
+            self.database.texts['new.txt'] = f'version {i}'
+            loop.run_until_complete(self.backups.backup())
+        archives = sorted(name for name in os.listdir(self.directory)
+                          if name.endswith('.tar.gz'))
+        # the fourth backup started a new chain, and the old one was removed
+        self.assertEqual(len(archives), 1)
+        self.assertTrue(archives[0].endswith('.full.tar.gz'))
+        self.assertEqual(self.restored(), self.database.texts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# test_bm25_db.py
+
+from tempfile import TemporaryDirectory
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.services.database import BM25Database
+from qa_backend.services.database import BM25DatabaseConfig
+from qa_backend.services.database import DatabaseAlreadyExistsError
+from qa_backend.services.database import DatabaseDeleteError
+from qa_backend.services.database import DatabaseUpdateNotFoundError
+from qa_backend.services.database import WriteOperation
+from qa_backend.util import Paragraph
+
+loop = asyncio.get_event_loop()
+
+PARAGRAPHS = [
+    Paragraph('parking.txt', 'Parking permits are sold at the parking office.'),
+    Paragraph('library.txt', 'The library is open until midnight.'),
+    Paragraph('dining.txt', 'The dining hall serves breakfast, lunch and '
+                            'dinner.  Parking is behind the dining hall.'),
+]
+
+class BM25Database_Test(unittest.TestCase):
+    def setUp(self):
+        self.database = BM25Database(BM25DatabaseConfig())
+        loop.run_until_complete(self.database.create_many(PARAGRAPHS))
+
+    def query(self, query_string, size=10):
+        results = loop.run_until_complete(
+                    self.database.query(query_string, size))
+        return [paragraph.docId for paragraph in results]
+
+    def test_query(self):
+        self.assertEqual(self.query('where do I buy a parking permit?'),
+                         ['parking.txt', 'dining.txt'])
+        self.assertEqual(self.query('parking', size=1), ['parking.txt'])
+        self.assertEqual(self.query('LIBRARY hours'), ['library.txt'])
+        self.assertEqual(self.query('chemistry'), [])
+
+    def test_crud(self):
+        database = self.database
+        with self.assertRaises(DatabaseAlreadyExistsError):
+            loop.run_until_complete(database.create(PARAGRAPHS[0]))
+        updated = Paragraph('library.txt', 'The library sells parking permits.')
+        loop.run_until_complete(database.update(updated))
+        self.assertEqual(loop.run_until_complete(database.read('library.txt')),
+                         [updated])
+        self.assertEqual(self.query('library'), ['library.txt'])
+        self.assertEqual(self.query('midnight'), [])
+        loop.run_until_complete(database.delete('parking.txt'))
+        self.assertEqual(self.query('permits'), ['library.txt'])
+        self.assertEqual(loop.run_until_complete(database.read('parking.txt')),
+                         [])
+        with self.assertRaises(DatabaseUpdateNotFoundError):
+            loop.run_until_complete(database.update(PARAGRAPHS[0]))
+        with self.assertRaises(DatabaseDeleteError):
+            loop.run_until_complete(database.delete('parking.txt'))
+        docIds = [p.docId for p in loop.run_until_complete(database.read('*'))]
+        self.assertEqual(sorted(docIds), ['dining.txt', 'library.txt'])
+
+    def test_write_many_invalid(self):
+        operations = [WriteOperation('create', 'bad id.txt', 'bad'),
+                      WriteOperation('create', 'gym.txt', 'The gym.')]
+        results = loop.run_until_complete(
+                    self.database.write_many(operations))
+        self.assertEqual([result.status for result in results], [400, 201])
+        self.assertEqual(self.query('gym'), ['gym.txt'])
+
+    def test_compact(self):
+        database = self.database
+        for i in range(10):
+            text = f'version {i} of the parking rules'
+            loop.run_until_complete(
+                database.update(Paragraph('parking.txt', text)))
+        stats = database.get_stats()
+        self.assertLessEqual(stats['dead_postings'], stats['postings'] / 2)
+        self.assertEqual(self.query('version 9'), ['parking.txt'])
+
+    def test_snapshot(self):
+        with TemporaryDirectory() as directory:
+            config = BM25DatabaseConfig(snapshot_dir=directory)
+            database = BM25Database(config)
+            loop.run_until_complete(database.create_many(PARAGRAPHS))
+            loop.run_until_complete(database.shutdown())
+            # written since the snapshot, on top of the mapped segment
+            mapped = BM25Database(config)
+            self.assertIsNotNone(mapped.base.path)
+            loop.run_until_complete(mapped.delete('parking.txt'))
+            loop.run_until_complete(mapped.create(
+                Paragraph('permits.txt', 'Permits for parking.')))
+            self.assertEqual(
+                [p.docId for p in loop.run_until_complete(
+                    mapped.query('parking permits'))],
+                ['permits.txt', 'dining.txt'])
+            loop.run_until_complete(mapped.shutdown())
+            reloaded = BM25Database(config)
+            self.assertEqual(reloaded.get_stats()['base_paragraphs'], 3)
+            self.assertEqual(
+                loop.run_until_complete(reloaded.read('permits.txt')),
+                [Paragraph('permits.txt', 'Permits for parking.')])
+
+    def test_add_directory(self):
+        with TemporaryDirectory() as directory:
+            for name in ['gym.txt', 'bad name.txt']:
+                with open(os.path.join(directory, name), 'w') as file:
+                    file.write('The gym opens at six.')
+            database = BM25Database(BM25DatabaseConfig())
+            report = loop.run_until_complete(
+                        database.add_directory(directory))
+        self.assertEqual(report.created, 1)
+        self.assertEqual(list(report.failed), ['bad name.txt'])
+        self.assertEqual(
+            [p.docId for p in loop.run_until_complete(database.query('gym'))],
+            ['gym.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# test_cache.py
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.server.answer_cache import AnswerCache
+from qa_backend.util.cache import LRUCache
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self) -> float:
+        return self.now
+
+class LRUCache_Test(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache: LRUCache[str,int] = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats.evictions, 1)
+        self.assertEqual(cache.stats.hits, 3)
+        self.assertEqual(cache.stats.misses, 1)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache: LRUCache[str,int] = LRUCache(2, ttl=10, clock=clock)
+        cache.put('a', 1)
+        clock.now = 5
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats.expirations, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_max_bytes(self):
+        cache: LRUCache[str,str] = LRUCache(10, max_bytes=10, sizeof=len)
+        cache.put('a', 'x'*6)
+        cache.put('b', 'x'*6)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.nbytes, 6)
+        cache.put('c', 'x'*11)
+        self.assertNotIn('c', cache)
+
+    def test_disabled(self):
+        cache: LRUCache[str,int] = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+class AnswerCache_Test(unittest.TestCase):
+    def test_normalized_key(self):
+        self.assertEqual(AnswerCache.key('What  is HTTP?'),
+                         AnswerCache.key(' what is http? '))
+        self.assertNotEqual(AnswerCache.key('what is http?', 'context'),
+                            AnswerCache.key('what is http?'))
+
+    def test_invalidate(self):
+        cache = AnswerCache(10)
+        foo = AnswerCache.key('foo?')
+        bar = AnswerCache.key('bar?')
+        cache.put(foo, {'answers': []}, ['foo.txt', 'both.txt'])
+        cache.put(bar, {'answers': []}, ['bar.txt', 'both.txt'])
+        cache.invalidate('foo.txt')
+        self.assertIsNone(cache.get(foo))
+        self.assertIsNotNone(cache.get(bar))
+        cache.invalidate('both.txt')
+        self.assertIsNone(cache.get(bar))
+        self.assertEqual(cache.dependents, {})
+
+    def test_eviction_forgets_dependencies(self):
+        cache = AnswerCache(1)
+        cache.put(AnswerCache.key('foo?'), {}, ['foo.txt'])
+        cache.put(AnswerCache.key('bar?'), {}, ['bar.txt'])
+        self.assertNotIn('foo.txt', cache.dependents)
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_put_after_invalidate(self):
+        clock = Clock()
+        cache = AnswerCache(10, settle=1., clock=clock)
+        foo = AnswerCache.key('foo?')
+        generation = cache.begin()
+        cache.invalidate('foo.txt')
+        cache.put(foo, {}, ['foo.txt'], generation)
+        self.assertIsNone(cache.get(foo))
+        # the database may still return the old text
+        cache.put(foo, {}, ['foo.txt'], cache.begin())
+        self.assertIsNone(cache.get(foo))
+        clock.now = 2.
+        cache.put(foo, {}, ['bar.txt'], generation)
+        self.assertIsNotNone(cache.get(foo))
+        cache.put(foo, {}, ['foo.txt'], cache.begin())
+        self.assertIsNotNone(cache.get(foo))
+        self.assertEqual(cache.get_stats()['stale'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
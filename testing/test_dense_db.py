@@ -0,0 +1,106 @@
+# test_dense_db.py
+
+from tempfile import TemporaryDirectory
+import asyncio
+import os
+import sys
+import unittest
+
+import numpy as np # type: ignore
+
+sys.path.append('..')
+
+from qa_backend.services.database import BM25Database
+from qa_backend.services.database import BM25DatabaseConfig
+from qa_backend.services.database import DenseConfig
+from qa_backend.services.database import DenseDatabase
+from qa_backend.services.database import HashingEncoder
+from qa_backend.services.database import VectorIndex
+from qa_backend.util import Paragraph
+
+loop = asyncio.get_event_loop()
+
+PARAGRAPHS = [
+    Paragraph('parking.txt', 'Parked cars are towed after midnight.'),
+    Paragraph('library.txt', 'The library is open until midnight.'),
+    Paragraph('dining.txt', 'The dining hall serves breakfast and lunch.'),
+]
+
+class CountingEncoder(HashingEncoder):
+    def __init__(self):
+        super().__init__()
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded.extend(texts)
+        return super().encode(texts)
+
+class VectorIndex_Test(unittest.TestCase):
+    def vectors(self, n, dim=32, seed=0):
+        random = np.random.default_rng(seed)
+        vectors = random.normal(size=(n, dim)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def test_ivf(self):
+        vectors = self.vectors(2000)
+        for quantize in [False, True]:
+            index = VectorIndex(32, quantize=quantize, nprobe=45)
+            index.add([f'{i}.txt' for i in range(2000)], vectors)
+            self.assertGreater(len(index.lists), 1)
+            for i in range(20):
+                docId, score = index.search(vectors[i], 1)[0]
+                self.assertEqual(docId, f'{i}.txt')
+                self.assertAlmostEqual(score, 1., places=1)
+
+    def test_replace_remove(self):
+        vectors = self.vectors(3)
+        index = VectorIndex(32)
+        index.add(['a.txt', 'b.txt', 'c.txt'], vectors)
+        index.add(['a.txt'], vectors[1:2])
+        index.remove('b.txt')
+        self.assertEqual([docId for docId, _ in index.search(vectors[1], 3)],
+                         ['a.txt', 'c.txt'])
+
+class DenseDatabase_Test(unittest.TestCase):
+    def setUp(self):
+        self.inner = BM25Database(BM25DatabaseConfig())
+        self.database = DenseDatabase(self.inner, DenseConfig(batch_size=2))
+        loop.run_until_complete(self.database.create_many(PARAGRAPHS))
+
+    def query(self, query_string, size=3):
+        return [p.docId for p in loop.run_until_complete(
+                    self.database.query(query_string, size))]
+
+    def test_hybrid(self):
+        # no word in common, but trigrams of park
+        self.assertEqual(loop.run_until_complete(self.inner.query('park', 3)),
+                         [])
+        self.assertEqual(self.query('park', 1), ['parking.txt'])
+        self.assertEqual(self.query('open until midnight')[0], 'library.txt')
+
+    def test_crud(self):
+        database = self.database
+        loop.run_until_complete(database.update(
+            Paragraph('parking.txt', 'Breakfast is served at eight.')))
+        self.assertEqual(self.query('served at eight', 1), ['parking.txt'])
+        self.assertNotEqual(self.query('park', 1), ['parking.txt'])
+        loop.run_until_complete(database.delete('dining.txt'))
+        self.assertNotIn('dining.txt', self.query('breakfast'))
+        self.assertEqual(len(database.index), 2)
+
+    def test_vectors_file(self):
+        with TemporaryDirectory() as directory:
+            config = DenseConfig(vectors_file=os.path.join(directory, 'v.npz'))
+            database = DenseDatabase(self.inner, config)
+            loop.run_until_complete(database.load())
+            database.save_vectors()
+            encoder = CountingEncoder()
+            loop.run_until_complete(self.inner.update(
+                Paragraph('library.txt', 'Closed on Sundays.')))
+            restarted = DenseDatabase(self.inner, config, encoder)
+            loop.run_until_complete(restarted.load())
+            self.assertEqual(encoder.encoded, ['Closed on Sundays.'])
+            self.assertEqual(len(restarted.index), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 # test_es_db.py
 
 from pathlib import Path
+from typing import List
 from typing import Optional
 from typing import cast
 import asyncio
@@ -8,6 +9,7 @@ import sys
 import unittest
 
 from elasticsearch import Elasticsearch # type: ignore
+import attr
 import yaml
 
 sys.path.append('..')
@@ -163,6 +165,78 @@ class ElasticsearchDatabase_TestDelete(unittest.TestCase):
 
 # TODO: Test query
 
+class ElasticsearchDatabase_TestQueryCache(unittest.TestCase):
+    es_database: Optional[ElasticsearchDatabase] = None
+
+    def setUp(self) -> None:
+        cache_config = attr.evolve(config, query_cache_size=10,
+                                   refresh_interval=0)
+        self.es_database = ElasticsearchDatabase(cache_config)
+        self.paragraph_0 = Paragraph('foo.txt','foo: this is a test')
+        self.paragraph_1 = Paragraph('foo.txt','foo: this was a test')
+        loop.run_until_complete(
+            self.es_database.create(self.paragraph_0)
+        )
+
+    def query(self) -> List[Paragraph]:
+        es_database = cast(ElasticsearchDatabase, self.es_database)
+        return list(loop.run_until_complete(es_database.query('foo', 1)))
+
+    def test_query_cached(self) -> None:
+        es_database = cast(ElasticsearchDatabase, self.es_database)
+        first = self.query()
+        second = self.query()
+        self.assertEqual(first, second)
+        self.assertEqual(es_database.query_cache.stats.hits, 1)
+
+    def test_write_invalidates(self) -> None:
+        es_database = cast(ElasticsearchDatabase, self.es_database)
+        self.query()
+        loop.run_until_complete(es_database.update(self.paragraph_1))
+        es.indices.refresh(es_database.index)
+        paragraphs = self.query()
+        self.assertEqual(es_database.query_cache.stats.hits, 0)
+        self.assertEqual(paragraphs[0].text, self.paragraph_1.text)
+
+class ElasticsearchDatabase_TestAddDirectory(unittest.TestCase):
+    es_database: Optional[ElasticsearchDatabase] = None
+
+    def setUp(self) -> None:
+        self.es_database = ElasticsearchDatabase(config)
+        loop.run_until_complete(
+            self.es_database.create(Paragraph('foo.txt', 'foo: existing'))
+        )
+
+    def test_add_directory(self) -> None:
+        es_database = cast(ElasticsearchDatabase, self.es_database)
+        report = loop.run_until_complete(
+            es_database.add_directory('es_test_data', chunk_size=1)
+        )
+        self.assertEqual(report.created, 1)
+        self.assertEqual(report.skipped, ['foo.txt'])
+        self.assertEqual(report.failed, {})
+        # searchable without waiting for the refresh_interval
+        paragraphs = loop.run_until_complete(es_database.query('bar', 1))
+        self.assertEqual([p.docId for p in paragraphs], ['bar.txt'])
+
+class ElasticsearchDatabase_TestIterAll(unittest.TestCase):
+    es_database: Optional[ElasticsearchDatabase] = None
+
+    def setUp(self) -> None:
+        self.es_database = ElasticsearchDatabase(config)
+        self.paragraphs = [Paragraph(f'{i}.txt', f'paragraph {i}')
+                           for i in range(5)]
+        loop.run_until_complete(
+            self.es_database.create_many(self.paragraphs)
+        )
+        loop.run_until_complete(self.es_database.refresh())
+
+    def test_iter_all(self) -> None:
+        es_database = cast(ElasticsearchDatabase, self.es_database)
+        async def iter_all() -> List[Paragraph]:
+            return [p async for p in es_database.iter_all(page_size=2)]
+        self.assertEqual(loop.run_until_complete(iter_all()), self.paragraphs)
+
 if __name__ == '__main__':
     unittest.main()
 
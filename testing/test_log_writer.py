@@ -0,0 +1,73 @@
+# test_log_writer.py
+
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.util.log_writer import LogWriter
+
+def read_lines(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as f:
+        return [json.loads(line) for line in f]
+
+class LogWriter_Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'qa_log.jsonl')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write(self):
+        writer = LogWriter(self.filename)
+        for i in range(100):
+            self.assertTrue(writer.write({'i': i}))
+        writer.close()
+        self.assertEqual(read_lines(self.filename),
+                         [{'i': i} for i in range(100)])
+        self.assertEqual(writer.get_stats()['written'], 100)
+
+    def test_rotate(self):
+        writer = LogWriter(self.filename, batch_size=1, max_bytes=20,
+                           compress=True)
+        for i in range(10):
+            writer.write({'i': i})
+        writer.close()
+        segments = sorted(os.listdir(self.dir.name))
+        self.assertGreater(len(segments), 1)
+        entries = []
+        for segment in segments:
+            entries.extend(read_lines(os.path.join(self.dir.name, segment)))
+        self.assertEqual(sorted(entry['i'] for entry in entries),
+                         list(range(10)))
+        self.assertEqual(writer.get_stats()['rotations'], len(segments) - 1)
+
+    def test_drop_when_full(self):
+        writer = LogWriter(self.filename, queue_size=1)
+        # hold the writer thread up so the queue fills
+        release = threading.Event()
+        write_batch = writer._write_batch
+        def blocked_write_batch(batch):
+            release.wait()
+            write_batch(batch)
+        writer._write_batch = blocked_write_batch
+        self.assertTrue(writer.write({'i': 0}))
+        while writer._queue.qsize() > 0:
+            time.sleep(0.01)
+        self.assertTrue(writer.write({'i': 1}))
+        self.assertFalse(writer.write({'i': 2}))
+        release.set()
+        writer.close()
+        self.assertEqual(writer.get_stats()['dropped'], 1)
+        self.assertEqual(read_lines(self.filename), [{'i': 0}, {'i': 1}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ from typing import Any
 from typing import Tuple
 import asyncio
 import atexit
+import json
 import logging
 import multiprocessing
 import os
@@ -201,6 +202,21 @@ def read_test_doc() -> Tuple[int,Any]:
             return response.status, await response.json()
     return loop.run_until_complete(_read())
 
+def bulk_operations(operations) -> Tuple[int,Any]:
+    async def _bulk():
+        body = '\n'.join(json.dumps(operation) for operation in operations)
+        uri = f'{index_uri()}/bulk'
+        async with session.post(uri,data=body.encode()) as response:
+            return response.status, await response.json()
+    return loop.run_until_complete(_bulk())
+
+def read_docs(docIds) -> Tuple[int,Any]:
+    async def _read():
+        params = [('docId', docId) for docId in docIds]
+        async with session.get(index_uri(),params=params) as response:
+            return response.status, await response.json()
+    return loop.run_until_complete(_read())
+
 def answer_question(question) -> Tuple[int,Any]:
     async def _answer_question():
         body = {'question': question}
@@ -208,6 +224,30 @@ def answer_question(question) -> Tuple[int,Any]:
             return response.status, await response.json()
     return loop.run_until_complete(_answer_question())
 
+def answer_questions(questions) -> Tuple[int,Any]:
+    async def _answer_questions():
+        body = {'questions': [{'question': question} for question in questions]}
+        async with session.post(f'{get_host()}/questions',json=body) as response:
+            return response.status, await response.json()
+    return loop.run_until_complete(_answer_questions())
+
+def answer_question_timeout(question, timeout) -> Tuple[int,Any]:
+    async def _answer_question():
+        body = {'question': question}
+        uri = f'{question_uri()}?timeout={timeout}'
+        async with session.post(uri,json=body) as response:
+            return response.status, await response.json()
+    return loop.run_until_complete(_answer_question())
+
+def answer_question_stream(question) -> Tuple[int,Any]:
+    async def _answer_question():
+        body = {'question': question}
+        uri = f'{question_uri()}?stream=ndjson'
+        async with session.post(uri,json=body) as response:
+            frames = [json.loads(line) async for line in response.content]
+            return response.status, frames
+    return loop.run_until_complete(_answer_question())
+
 def check_body(body, doc) -> bool:
     return all([len(body) == 1,
                body[0]['docId'] == doc['docId'],
@@ -246,6 +286,26 @@ class MainServer_CRUD(unittest.TestCase):
         d_status = delete_test_doc()
         self.assertEqual(d_status, 200)
 
+    def test_bulk(self):
+        delete_test_doc()
+        operations = [
+            test_doc,
+            {'operation':'create', 'docId':'bar.txt', 'text':'bar'},
+            test_doc_updated,
+            {'operation':'delete', 'docId':'bar.txt'},
+            {'operation':'delete', 'docId':'bar.txt'},
+            {'operation':'create', 'docId':'bad id.txt', 'text':'bad'},
+        ]
+        status, body = bulk_operations(operations)
+        self.assertEqual(status, 200)
+        statuses = [item['status'] for item in body['items']]
+        self.assertEqual(statuses, [201, 201, 200, 200, 404, 400])
+        self.assertEqual(body['errors'], 2)
+        r_status, r_body = read_docs([test_doc['docId'], 'bar.txt'])
+        self.assertEqual(r_status, 200)
+        self.assertTrue(check_body(r_body, test_doc_updated))
+        delete_test_doc()
+
 class MainServer_QA(unittest.TestCase):
     def test_RegexQA(self):
         log.info('test_RegexQA')
@@ -269,6 +329,44 @@ class MainServer_QA(unittest.TestCase):
         d_status = delete_context()
         self.assertEqual(d_status, 200)
 
+    def test_batch(self):
+        log.info('test_batch')
+        c_status = create_context()
+        self.assertEqual(c_status, 200)
+        questions = ['what is http?', 'do you think that jelena is happy?']
+        status, results = answer_questions(questions)
+        self.assertEqual(status, 200)
+        self.assertEqual([result['question'] for result in results], questions)
+        for question, result in zip(questions, results):
+            with self.subTest(question=question):
+                _, single = answer_question(question)
+                self.assertEqual(result['chosen_answer'],
+                                 single['chosen_answer'])
+        d_status = delete_context()
+        self.assertEqual(d_status, 200)
+
+    def test_stream(self):
+        log.info('test_stream')
+        c_status = create_context()
+        self.assertEqual(c_status, 200)
+        status, frames = answer_question_stream('what is http?')
+        self.assertEqual(status, 200)
+        events = [frame['event'] for frame in frames]
+        log.info(events)
+        self.assertEqual(events[0], 'retrieved')
+        self.assertEqual(events[-1], 'chosen_answer')
+        self.assertTrue(all(event == 'answer' for event in events[1:-1]))
+        d_status = delete_context()
+        self.assertEqual(d_status, 200)
+
+    def test_timeout(self):
+        log.info('test_timeout')
+        status, result = answer_question_timeout('what is http?', 0.001)
+        self.assertEqual(status, 200)
+        self.assertTrue(result['partial'])
+        status, _ = answer_question_timeout('what is http?', -1)
+        self.assertEqual(status, 400)
+
 if __name__ == '__main__':
     try:
         if sys.argv[1] == '-r':
@@ -0,0 +1,46 @@
+# test_metrics.py
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.util.metrics import Registry
+from qa_backend.util.metrics import server_timing
+
+class Metrics_Test(unittest.TestCase):
+    def test_counter(self):
+        registry = Registry()
+        errors = registry.counter('errors_total', 'errors', ['category'])
+        errors.inc(category='internal')
+        errors.inc(2, category='internal')
+        self.assertEqual(errors.get(category='internal'), 3)
+        self.assertIn('errors_total{category="internal"} 3.0',
+                      registry.expose())
+        with self.assertRaises(ValueError):
+            errors.inc(kind='internal')
+
+    def test_histogram(self):
+        registry = Registry()
+        seconds = registry.histogram('seconds', 'time', buckets=[.1, 1.])
+        for value in [.05, .5, 5.]:
+            seconds.observe(value)
+        exposed = registry.expose()
+        self.assertIn('seconds_bucket{le="0.1"} 1.0', exposed)
+        self.assertIn('seconds_bucket{le="1.0"} 2.0', exposed)
+        self.assertIn('seconds_bucket{le="+Inf"} 3.0', exposed)
+        self.assertIn('seconds_count 3.0', exposed)
+
+    def test_register_twice(self):
+        registry = Registry()
+        first = registry.histogram('seconds', 'time')
+        self.assertIs(registry.histogram('seconds', 'time'), first)
+        with self.assertRaises(ValueError):
+            registry.counter('seconds', 'time')
+
+    def test_server_timing(self):
+        self.assertEqual(server_timing({'es': .0123, 'qa': .5}),
+                         'es;dur=12.3, qa;dur=500.0')
+
+if __name__ == '__main__':
+    unittest.main()
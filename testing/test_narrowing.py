@@ -0,0 +1,48 @@
+# test_narrowing.py
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.services.database.narrowing import HIGHLIGHT_END
+from qa_backend.services.database.narrowing import HIGHLIGHT_START
+from qa_backend.services.database.narrowing import highlight_spans
+from qa_backend.services.database.narrowing import narrow
+from qa_backend.services.database.narrowing import query_spans
+from qa_backend.util import Paragraph
+from qa_backend.util import Passage
+
+TEXT = ('The library opens at eight.  It closes at midnight on weekdays.  '
+        'Parking permits are sold at the parking office.  '
+        'Permits cost forty dollars a semester.  '
+        'The gym is next to the parking office.  '
+        'Lockers are free.')
+
+class Narrowing_Test(unittest.TestCase):
+    def test_highlight_spans(self):
+        highlighted = TEXT.replace('permits',
+                                   f'{HIGHLIGHT_START}permits{HIGHLIGHT_END}')
+        spans = highlight_spans(highlighted, TEXT)
+        self.assertEqual([TEXT[start:end] for start, end in spans],
+                         ['permits'])
+        self.assertIsNone(highlight_spans(highlighted, 'another text'))
+
+    def test_narrow(self):
+        paragraph = Paragraph('campus.txt', TEXT)
+        matches = query_spans('How much does a permit cost?', TEXT)
+        narrowed = narrow(paragraph, matches, window=0)
+        self.assertEqual(narrowed.text.strip(),
+                         'Permits cost forty dollars a semester.')
+        self.assertEqual(TEXT[narrowed.start:narrowed.end], narrowed.text)
+        self.assertEqual(narrowed.docId, 'campus.txt')
+        wider = narrow(paragraph, matches, window=1)
+        self.assertTrue(wider.text.startswith('Parking permits'))
+        # offsets stay relative to the document
+        passage = Passage('campus.txt', TEXT[29:], 29, len(TEXT))
+        narrowed = narrow(passage, query_spans('permit cost', passage.text), 0)
+        self.assertEqual(TEXT[narrowed.start:narrowed.end], narrowed.text)
+        self.assertIs(narrow(paragraph, []), paragraph)
+
+if __name__ == '__main__':
+    unittest.main()
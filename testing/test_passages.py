@@ -0,0 +1,196 @@
+# test_passages.py
+
+import asyncio
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.services.database import BM25Database
+from qa_backend.services.database import BM25DatabaseConfig
+from qa_backend.services.database import DatabaseAlreadyExistsError
+from qa_backend.services.database import PassageConfig
+from qa_backend.services.database import PassageDatabase
+from qa_backend.services.database import WriteOperation
+from qa_backend.services.database import WriteResult
+from qa_backend.services.database.narrowing import narrow
+from qa_backend.services.database.narrowing import query_spans
+from qa_backend.services.database.passages import split_passages
+from qa_backend.util import Paragraph
+
+loop = asyncio.get_event_loop()
+
+TEXT = ('The library opens at eight.  It closes at midnight on weekdays.\n\n'
+        'Parking permits are sold at the parking office, next to the gym.  '
+        'Permits cost forty dollars a semester.')
+
+class SplitPassages_Test(unittest.TestCase):
+    def test_partition(self):
+        for max_tokens in [1, 5, 12, 100]:
+            spans = split_passages(TEXT, max_tokens)
+            self.assertEqual(''.join(TEXT[start:end]
+                                     for start, end in spans), TEXT)
+        self.assertEqual(split_passages('', 10), [(0, 0)])
+
+    def test_sentences(self):
+        spans = split_passages(TEXT, 100, max_sentences=2)
+        self.assertEqual([TEXT[start:end].strip() for start, end in spans],
+                         TEXT.split('\n\n'))
+        # a sentence longer than max_tokens is cut between tokens
+        self.assertEqual(split_passages('a b c d e', 2),
+                         [(0, 4), (4, 8), (8, 9)])
+
+class NarrowingDatabase(BM25Database):
+    """Narrows its hits to one sentence, like ElasticsearchDatabase does with
+    narrow_context"""
+    async def query(self, query_string, size=10, qid=''):
+        return [narrow(paragraph, query_spans(query_string, paragraph.text),
+                       window=0)
+                for paragraph in await super().query(query_string, size)]
+
+class FlakyDatabase(BM25Database):
+    """Fails the writes of the docIds in failing, and lets other tasks run
+    during write_many"""
+    def __init__(self, config):
+        super().__init__(config)
+        self.failing = set()
+
+    async def write_many(self, operations):
+        await asyncio.sleep(0)
+        valid = [op for op in operations if op.docId not in self.failing]
+        written = iter(await super().write_many(valid))
+        return [WriteResult(op.operation, op.docId, 500, 'failed')
+                if op.docId in self.failing else next(written)
+                for op in operations]
+
+class PassageDatabase_Test(unittest.TestCase):
+    def setUp(self):
+        self.inner = BM25Database(BM25DatabaseConfig())
+        self.database = PassageDatabase(self.inner,
+                                        PassageConfig(max_tokens=15))
+        loop.run_until_complete(self.database.create(
+            Paragraph('campus.txt', TEXT)))
+
+    def test_query(self):
+        passage, = loop.run_until_complete(
+                        self.database.query('what do permits cost', 1))
+        self.assertEqual(passage.docId, 'campus.txt')
+        self.assertIn('forty dollars', passage.text)
+        self.assertEqual(TEXT[passage.start:passage.end], passage.text)
+
+    def test_narrowed(self):
+        text = TEXT + '  The gym opens at six.  Lockers are free.'
+        database = PassageDatabase(NarrowingDatabase(BM25DatabaseConfig()),
+                                   PassageConfig(max_tokens=40))
+        loop.run_until_complete(database.create(
+            Paragraph('campus.txt', text)))
+        self.assertGreater(len(database.passages['campus.txt']), 1)
+        passage, = loop.run_until_complete(
+                        database.query('what do permits cost', 1))
+        self.assertEqual(passage.text.strip(),
+                         'Permits cost forty dollars a semester.')
+        self.assertEqual(text[passage.start:passage.end], passage.text)
+
+    def test_crud(self):
+        database = self.database
+        self.assertEqual(loop.run_until_complete(database.read('campus.txt')),
+                         [Paragraph('campus.txt', TEXT)])
+        with self.assertRaises(DatabaseAlreadyExistsError):
+            loop.run_until_complete(database.create(
+                Paragraph('campus.txt', 'again')))
+        loop.run_until_complete(database.update(
+            Paragraph('campus.txt', 'Closed for the summer.')))
+        # the passages of the old text are gone
+        self.assertEqual(
+            [p.docId for p in loop.run_until_complete(self.inner.read('*'))],
+            ['campus--p0000.txt'])
+        loop.run_until_complete(database.delete('campus.txt'))
+        self.assertEqual(loop.run_until_complete(database.read('*')), [])
+        self.assertEqual(loop.run_until_complete(self.inner.read('*')), [])
+
+    def test_load(self):
+        # documents stored whole before passages were enabled
+        loop.run_until_complete(self.inner.create(Paragraph('old.txt', TEXT)))
+        database = PassageDatabase(self.inner, PassageConfig(max_tokens=15))
+        loop.run_until_complete(database.start())
+        self.assertEqual(set(database.passages), {'campus.txt', 'old.txt'})
+        self.assertEqual(loop.run_until_complete(database.read('old.txt')),
+                         [Paragraph('old.txt', TEXT)])
+        self.assertEqual(loop.run_until_complete(self.inner.read('old.txt')),
+                         [])
+
+    def test_load_again(self):
+        # indexed again on startup, next to its passages
+        text = TEXT.replace('midnight', 'ten')
+        loop.run_until_complete(self.inner.create(
+            Paragraph('campus.txt', text)))
+        for _ in range(2):
+            database = PassageDatabase(self.inner,
+                                       PassageConfig(max_tokens=15))
+            loop.run_until_complete(database.start())
+            self.assertEqual(
+                loop.run_until_complete(database.read('campus.txt')),
+                [Paragraph('campus.txt', text)])
+            self.assertEqual(
+                loop.run_until_complete(self.inner.read('campus.txt')), [])
+            passages = loop.run_until_complete(
+                            database.query('when does the library close', 10))
+            self.assertEqual(len(passages), len(set(
+                (passage.start, passage.end) for passage in passages)))
+
+class PassageDatabase_TestWrites(unittest.TestCase):
+    def setUp(self):
+        self.inner = FlakyDatabase(BM25DatabaseConfig())
+        self.database = PassageDatabase(self.inner,
+                                        PassageConfig(max_tokens=15))
+
+    def stored(self):
+        return sorted(p.docId for p in loop.run_until_complete(
+                                        self.inner.read('*')))
+
+    def write(self, *operations):
+        results = loop.run_until_complete(
+                    self.database.write_many(operations))
+        return [result.status for result in results]
+
+    def test_concurrent(self):
+        self.write(WriteOperation('create', 'campus.txt', TEXT))
+        short = 'Closed for the summer.'
+        loop.run_until_complete(asyncio.gather(
+            self.database.update(Paragraph('campus.txt', short)),
+            self.database.update(Paragraph('campus.txt', TEXT))))
+        self.assertEqual(loop.run_until_complete(
+                            self.database.read('campus.txt')),
+                         [Paragraph('campus.txt', TEXT)])
+        self.assertEqual(self.stored(), sorted(self.database.spans))
+
+    def test_retry_create(self):
+        self.inner.failing = {'campus--p0001.txt'}
+        self.assertEqual(self.write(
+            WriteOperation('create', 'campus.txt', TEXT),
+            WriteOperation('update', 'campus.txt', TEXT)), [500, 404])
+        self.assertEqual(self.stored(), [])
+        self.inner.failing = set()
+        self.assertEqual(self.write(
+            WriteOperation('create', 'campus.txt', TEXT)), [201])
+        self.assertEqual(loop.run_until_complete(
+                            self.database.read('campus.txt')),
+                         [Paragraph('campus.txt', TEXT)])
+
+    def test_retry_update(self):
+        self.write(WriteOperation('create', 'campus.txt', 'Closed.'))
+        self.inner.failing = {'campus--p0001.txt'}
+        self.assertEqual(self.write(
+            WriteOperation('update', 'campus.txt', TEXT)), [500])
+        # what was written is the document's
+        self.assertEqual(self.stored(), sorted(self.database.spans))
+        self.inner.failing = set()
+        self.assertEqual(self.write(
+            WriteOperation('update', 'campus.txt', TEXT)), [200])
+        self.assertEqual(loop.run_until_complete(
+                            self.database.read('campus.txt')),
+                         [Paragraph('campus.txt', TEXT)])
+        self.assertEqual(self.stored(), sorted(self.database.spans))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# test_qa_server.py
+
+from typing import List
+import asyncio
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.server.qa_server import QAServer
+from qa_backend.server.qa_server import QAServerConfig
+from qa_backend.services.database import BM25Database
+from qa_backend.services.database import BM25DatabaseConfig
+from qa_backend.services.qa import QA
+from qa_backend.util import Paragraph
+from qa_backend.util import QAAnswer
+
+loop = asyncio.get_event_loop()
+
+class ReaderQA(QA):
+    """Answers with the first sentence of the context, once released"""
+    _requires_context = True
+
+    def __init__(self):
+        self.questions: List[str] = []
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def query(self, question, context=None, **kwargs):
+        self.questions.append(question)
+        await self.released.wait()
+        return [QAAnswer(question, context.split('.')[0] + '.', 0.5)]
+
+class CannedQA(QA):
+    """Answers every question the same, without context"""
+    _requires_context = False
+
+    def __init__(self, score):
+        self.score = score
+
+    async def query(self, question, **kwargs):
+        return [QAAnswer(question, 'Ask the front desk.', self.score)]
+
+class CountingDatabase(BM25Database):
+    def __init__(self, config):
+        super().__init__(config)
+        self.queries = 0
+
+    async def query(self, query_string, size=10, qid=''):
+        self.queries += 1
+        return await super().query(query_string, size, qid)
+
+class QAServer_Test(unittest.TestCase):
+    def setUp(self):
+        self.database = CountingDatabase(BM25DatabaseConfig())
+        loop.run_until_complete(self.database.create(
+            Paragraph('library.txt', 'The library is open until midnight.')))
+        self.reader = ReaderQA()
+
+    def server(self, qas=(), **config):
+        return QAServer(self.database, [*qas, self.reader],
+                        QAServerConfig(**config))
+
+    def answer(self, server, question):
+        response = loop.run_until_complete(
+                    server.get_response(question, None, 'qid', 5))
+        return response['chosen_answer']['answer']
+
+    def test_invalidated_while_answering(self):
+        server = self.server(answer_cache_size=10)
+        self.reader.released.clear()
+        async def update_meanwhile():
+            request = asyncio.ensure_future(
+                        server.get_response('library hours?', None, 'qid', 5))
+            while len(self.reader.questions) == 0:
+                await asyncio.sleep(0)
+            # the reader has the old text
+            await self.database.update(Paragraph(
+                'library.txt', 'The library closes at ten.'))
+            server.answer_cache.invalidate('library.txt')
+            self.reader.released.set()
+            return await request
+        old = loop.run_until_complete(update_meanwhile())
+        self.assertEqual(old['chosen_answer']['answer'],
+                         'The library is open until midnight.')
+        self.assertEqual(self.answer(server, 'library hours?'),
+                         'The library closes at ten.')
+        # computed after the write, so cached
+        self.assertEqual(len(server.answer_cache.cache), 1)
+
+    def test_short_circuit(self):
+        server = self.server([CannedQA(0.95)], short_circuit_score=0.9)
+        self.assertEqual(self.answer(server, 'library hours?'),
+                         'Ask the front desk.')
+        self.assertEqual(self.database.queries, 0)
+        self.assertEqual(self.reader.questions, [])
+
+    def test_short_circuit_below_threshold(self):
+        server = self.server([CannedQA(0.2)], short_circuit_score=0.9)
+        self.assertEqual(self.answer(server, 'library hours?'),
+                         'The library is open until midnight.')
+        self.assertEqual(self.database.queries, 1)
+        self.assertEqual(self.reader.questions, ['library hours?'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# test_response_encoding.py
+
+import json
+import sys
+import unittest
+
+sys.path.append('..')
+
+import attr
+
+from qa_backend.server.response_encoding import ResponseEncoder
+from qa_backend.server.response_encoding import ResponseFormat
+from qa_backend.util import Paragraph
+from qa_backend.util import Passage
+from qa_backend.util import QAAnswer
+
+paragraph = Paragraph('http.txt', 'HTTP is a protocol. It is used on the web.')
+answers = [attr.asdict(QAAnswer('what is http?', 'HTTP is a protocol.', 0.9,
+                                'http.txt', paragraph)),
+           attr.asdict(QAAnswer('what is http?', 'It is used on the web.',
+                                0.5, 'http.txt', paragraph))]
+response = {'chosen_answer': answers[0], 'answers': answers,
+            'question': 'what is http?', 'partial': False}
+
+class ResponseEncoder_Test(unittest.TestCase):
+    def test_full(self):
+        encoder = ResponseEncoder(10)
+        encoded = encoder.encode(response, ResponseFormat())
+        self.assertEqual(json.loads(encoded), response)
+        self.assertEqual(encoder.get_stats()['misses'], 1)
+
+    def test_compact(self):
+        encoder = ResponseEncoder(10)
+        encoded = json.loads(encoder.encode(response,
+                                            ResponseFormat(compact=True)))
+        self.assertEqual(encoded['paragraphs'], [attr.asdict(paragraph)])
+        self.assertEqual(encoded['answers'][0]['paragraph'], 0)
+        self.assertEqual(encoded['chosen_answer'], encoded['answers'][0])
+
+    def test_compact_passages(self):
+        text = 'HTTP is a protocol. It is used on the web.'
+        passages = [Passage('http.txt', text[:20], 0, 20),
+                    Passage('http.txt', text[20:], 20, len(text))]
+        answers = [attr.asdict(QAAnswer('what is http?', 'HTTP is a protocol.',
+                                        0.9, 'http.txt', passages[0])),
+                   attr.asdict(QAAnswer('what is http?', 'used on the web',
+                                        0.5, 'http.txt', passages[1]))]
+        response = {'chosen_answer': answers[0], 'answers': answers,
+                    'question': 'what is http?', 'partial': False}
+        encoder = ResponseEncoder(10)
+        encoded = json.loads(encoder.encode(response,
+                                            ResponseFormat(compact=True)))
+        self.assertEqual(len(encoded['paragraphs']), 2)
+        for answer, passage in zip(encoded['answers'], passages):
+            self.assertEqual(encoded['paragraphs'][answer['paragraph']],
+                             attr.asdict(passage))
+
+    def test_fields(self):
+        encoder = ResponseEncoder(10)
+        response_format = ResponseFormat(compact=True,
+                                         fields=('answer', 'docId'))
+        encoded = json.loads(encoder.encode(response, response_format))
+        self.assertNotIn('paragraphs', encoded)
+        self.assertEqual(encoded['answers'][1],
+                         {'answer': 'It is used on the web.',
+                          'docId': 'http.txt'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -86,6 +86,22 @@ class TransformersMicro_TestQuery(unittest.TestCase):
                          set(QAAnswer.__slots__))
         log.info(response_body)
 
+    def test_batch_answer(self):
+        async def get_answers():
+            body = {'question': 'what are fragile unit tests?',
+                    'contexts': [context, context]}
+            batch_url = f'{micro_config.url}/batch'
+            async with session.post(batch_url,json=body) as response:
+                status = response.status
+                response_body = await response.json()
+            return status, response_body
+        status, response_body = loop.run_until_complete(get_answers())
+        self.assertEqual(status, 200)
+        self.assertEqual(len(response_body), 2)
+        for answers in response_body:
+            self.assertEqual(set(answers[0].keys()), set(QAAnswer.__slots__))
+        log.info(response_body)
+
     def test_api_error(self):
         async def bad_method():
             async with session.get(micro_config.url) as response:
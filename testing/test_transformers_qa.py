@@ -68,5 +68,16 @@ class TransformersQA_Test(unittest.TestCase):
             self.assertEqual(answers[0].answer, '')
             log.info(answers)
 
+    def test_query_many(self):
+        questions = self.answerable_questions + self.impossible_questions
+        pairs = [(question, context) for question in questions]
+        coro = self.trasformers_qa.query_many(pairs)
+        answers = loop.run_until_complete(coro)
+        self.assertEqual(len(answers), len(questions))
+        for answers_ in answers[:len(self.answerable_questions)]:
+            self.assertNotEqual(answers_[0].answer, '')
+        self.assertEqual(answers[-1][0].answer, '')
+        log.info(answers)
+
 if __name__ == '__main__':
     unittest.main()
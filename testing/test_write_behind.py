@@ -0,0 +1,108 @@
+# test_write_behind.py
+
+from tempfile import TemporaryDirectory
+from typing import Dict
+from typing import List
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append('..')
+
+from qa_backend.services.database.write_behind import DocIdLocks
+from qa_backend.services.database.write_behind import WalEntry
+from qa_backend.services.database.write_behind import WriteBehind
+
+loop = asyncio.get_event_loop()
+
+class Store:
+    """Stands in for the database the writes are applied to"""
+    def __init__(self):
+        self.texts: Dict[str,str] = {}
+        self.batches = 0
+
+    async def apply(self, entries: List[WalEntry]) -> None:
+        self.batches += 1
+        for entry in entries:
+            if entry.text is None:
+                self.texts.pop(entry.docId, None)
+            else:
+                self.texts[entry.docId] = entry.text
+
+class WriteBehind_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'wal.jsonl')
+        self.store = Store()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pending_until_flush(self):
+        write_behind = WriteBehind(self.filename, self.store.apply)
+        writes = [write_behind.write(f'{i}.txt', f'text {i}')
+                  for i in range(20)]
+        loop.run_until_complete(asyncio.gather(*writes))
+        loop.run_until_complete(write_behind.write('3.txt', None))
+        # concurrent writes share fsyncs
+        self.assertLess(write_behind.stats.syncs, 21)
+        self.assertEqual(self.store.texts, {})
+        self.assertEqual(write_behind.lookup('1.txt').text, 'text 1')
+        self.assertIsNone(write_behind.lookup('3.txt').text)
+        loop.run_until_complete(write_behind.flush())
+        self.assertEqual(self.store.batches, 1)
+        self.assertEqual(len(self.store.texts), 19)
+        self.assertIsNone(write_behind.lookup('1.txt'))
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        write_behind.close()
+
+    def test_replay(self):
+        write_behind = WriteBehind(self.filename, self.store.apply)
+        loop.run_until_complete(write_behind.write('a.txt', 'first'))
+        loop.run_until_complete(write_behind.write('a.txt', 'second'))
+        loop.run_until_complete(write_behind.write('b.txt', 'b'))
+        # crash: the writes were never flushed
+        write_behind.close()
+        with open(self.filename, 'a') as file:
+            file.write('{"seq": 4, "docId": "torn')
+        replayed = WriteBehind(self.filename, self.store.apply)
+        loop.run_until_complete(replayed.replay())
+        self.assertEqual(self.store.texts, {'a.txt': 'second', 'b.txt': 'b'})
+        self.assertEqual(replayed.seq, 3)
+        self.assertEqual(len(replayed.pending), 0)
+        replayed.close()
+
+    def test_failed_append(self):
+        write_behind = WriteBehind(self.filename, self.store.apply)
+        loop.run_until_complete(write_behind.write('a.txt', 'a'))
+        def append(entries):
+            raise OSError('disk full')
+        write_behind.wal.append = append
+        with self.assertRaises(OSError):
+            loop.run_until_complete(write_behind.write_many(
+                [('a.txt', 'changed'), ('b.txt', 'b')]))
+        self.assertEqual(write_behind.lookup('a.txt').text, 'a')
+        self.assertIsNone(write_behind.lookup('b.txt'))
+        loop.run_until_complete(write_behind.flush())
+        self.assertEqual(self.store.texts, {'a.txt': 'a'})
+        write_behind.close()
+
+class DocIdLocks_Test(unittest.TestCase):
+    def test_check_then_write(self):
+        locks = DocIdLocks()
+        created: List[str] = []
+        async def create(name):
+            async with locks.locked(['a.txt', 'b.txt']):
+                exists = len(created) > 0
+                # a lookup of the database, another create may run meanwhile
+                await asyncio.sleep(0.01)
+                if not exists:
+                    created.append(name)
+        loop.run_until_complete(asyncio.gather(create('first'),
+                                               create('second')))
+        self.assertEqual(created, ['first'])
+        self.assertEqual(locks.locks, {})
+
+if __name__ == '__main__':
+    unittest.main()